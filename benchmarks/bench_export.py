@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# bench_export.py: Benchmark streaming export of structure files
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+from os import path
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from core import init_csg_db
+from molfile import EXPORT_FORMATS, open_output, write_structures
+
+
+CORPUS_PATH = path.join(path.dirname(path.abspath(__file__)), "corpus.txt")
+
+# Each list is the corpus, repeated up to this many formulas
+N_FORMULAS = [1000, 10000, 100000]
+
+# tracemalloc slows the export down several times over, so peak memory
+# is only measured up to this many formulas.
+MAX_TRACED_FORMULAS = 10000
+
+
+def read_corpus() -> list:
+    """
+    read_corpus():
+        Read the formulas from corpus.txt
+    """
+    with open(CORPUS_PATH) as f:
+        return [line.strip() for line in f
+                if line.strip() != "" and not line.startswith("#")]
+
+
+def formula_stream(corpus: list, n_formulas: int):
+    """
+    formula_stream():
+        Generate `n_formulas` formulas, cycling through the corpus
+    """
+    for i in range(n_formulas):
+        yield corpus[i % len(corpus)]
+
+
+def measure(fmt: str, n_formulas: int, compress: bool, corpus: list) -> None:
+    """
+    measure():
+        Export `n_formulas` structures, and print the throughput, the peak
+        memory and the size of the file
+    """
+    out_path = f"out.{fmt}" + (".gz" if compress else "")
+
+    def export() -> int:
+        out = open_output(out_path, compress)
+        n_written = write_structures(formula_stream(corpus, n_formulas),
+                                     out, fmt)
+        out.close()
+
+        return n_written
+
+    start = perf_counter()
+    n_written = export()
+    elapsed = perf_counter() - start
+
+    peak = "-"
+    if n_formulas <= MAX_TRACED_FORMULAS:
+        tracemalloc.start()
+        export()
+        peak = "{:.1f}".format(tracemalloc.get_traced_memory()[1] / 2**10)
+        tracemalloc.stop()
+
+    print("{:<4} {:<5} {:>8} {:>10.1f} {:>10} {:>10.2f}".format(
+        fmt, "gzip" if compress else "", n_written, n_written / elapsed,
+        peak, os.path.getsize(out_path) / 2**20))
+
+def main() -> None:
+    os.chdir(mkdtemp(prefix="csg-bench-"))
+    with redirect_stdout(sys.stderr):
+        init_csg_db()
+
+    corpus = read_corpus()
+
+    # Warm the analysis and geometry caches, so that they do not count
+    # towards the peak.
+    write_structures(corpus, open(os.devnull, "w"), "xyz", lambda *_: None)
+
+    print("{:<4} {:<5} {:>8} {:>10} {:>10} {:>10}".format(
+        "Fmt", "", "Records", "Records/s", "Peak KiB", "File MiB"))
+
+    for fmt in EXPORT_FORMATS:
+        for n_formulas in N_FORMULAS:
+            measure(fmt, n_formulas, False, corpus)
+
+        measure(fmt, N_FORMULAS[-1], True, corpus)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# bench_gui.py: Benchmark click-to-pixels latency of the graphical front-end
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Run without a display with: QT_QPA_PLATFORM=offscreen ./bench_gui.py
+
+import sys
+from os import path, chdir
+from tempfile import mkdtemp
+from time import perf_counter
+from statistics import median
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+import matplotlib
+matplotlib.use("Qt5Agg")
+import matplotlib.pyplot as plt
+from PyQt5.QtWidgets import QApplication
+
+from core import init_csg_db, analyze, draw_structure
+import ui
+
+
+# Cycled through, like a user clicking through the recents list
+FORMULAE = ["SF6", "H2O", "CO2", "XeF4", "NH3", "BF3", "PCl5", "ClF3"]
+
+
+def window_per_render(app: QApplication, chem_form: str) -> float:
+    """
+    window_per_render():
+        Open a new pyplot window for the formula, as the GUI used to, and
+        return the time until its pixels are on screen
+    """
+    start = perf_counter()
+
+    fig = plt.figure()
+    draw_structure(fig, analyze(chem_form), "dark")
+    fig.canvas.manager.show()
+    fig.canvas.draw()
+    app.processEvents()
+
+    return perf_counter() - start
+
+
+def embedded(app: QApplication, stackh: "ui.StackHolder",
+             chem_form: str) -> float:
+    """
+    embedded():
+        Redraw the embedded canvas for the formula, and return the time
+        until its pixels are on screen
+    """
+    start = perf_counter()
+
+    stackh.show_structure(analyze(chem_form))
+    app.processEvents()
+
+    return perf_counter() - start
+
+
+def report(name: str, times: list) -> float:
+    """
+    report():
+        Print the median and worst latency in milliseconds
+    """
+    med = median(times) * 1e3
+    print("{:<28} median {:>8.2f} ms   max {:>8.2f} ms".format(
+          name, med, max(times) * 1e3))
+
+    return med
+
+
+def main(rounds: int = 5) -> None:
+    # Keep the benchmark's databases out of the source tree.
+    chdir(mkdtemp(prefix="csg-bench-"))
+    init_csg_db()
+
+    app = QApplication(sys.argv)
+
+    old_times = []
+    for _ in range(rounds):
+        for chem_form in FORMULAE:
+            old_times.append(window_per_render(app, chem_form))
+
+        # The old front-end never closed these, but keep memory in check.
+        plt.close("all")
+
+    stackh = ui.StackHolder()
+    app.processEvents()
+
+    # The first render creates the canvas; count it separately.
+    first = embedded(app, stackh, FORMULAE[0])
+
+    new_times = []
+    for _ in range(rounds):
+        for chem_form in FORMULAE:
+            new_times.append(embedded(app, stackh, chem_form))
+
+    old = report("new window per render", old_times)
+    print("{:<28} {:>15.2f} ms".format("embedded canvas (first)",
+                                       first * 1e3))
+    new = report("embedded canvas", new_times)
+    print("Speedup: {:.1f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
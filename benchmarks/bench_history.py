@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# bench_history.py: Benchmark listing and searching a large history table
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+from os import path
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from core import init_csg_db
+from db import csg_db, iter_history
+
+
+# Far beyond HISTORY_MAX_ROWS, as if the limit had been raised
+N_ROWS = 300000
+
+ELEMENTS = ["H", "C", "N", "O", "F", "S", "Cl", "Xe", "P", "B"]
+
+
+def fill_history(n_rows: int) -> None:
+    """
+    fill_history():
+        Insert `n_rows` records, mostly formulas, bypassing pruning
+    """
+    def rows():
+        for i in range(n_rows):
+            if i % 10 == 0:
+                yield (f"/history search {ELEMENTS[i % 7]}", "builtin", i)
+
+            else:
+                el1 = ELEMENTS[i % len(ELEMENTS)]
+                el2 = ELEMENTS[(i // len(ELEMENTS)) % len(ELEMENTS)]
+                yield (f"{el1}{i}{el2}{i % 9 + 1}", "formula", i)
+
+    with csg_db().transaction() as db:
+        db.executemany("INSERT INTO history(command, type, last_used) "
+                       "VALUES(?, ?, ?);", rows())
+
+
+def legacy_history(cmd_type: str = None) -> list:
+    """
+    legacy_history():
+        Load the whole table, then format it, as /history used to
+    """
+    db = csg_db()
+    if cmd_type is None:
+        records = db.fetchall("SELECT * FROM history;")
+
+    else:
+        records = db.fetchall(f"SELECT * FROM history WHERE type='{cmd_type}';")
+
+    return ["{:>6}  {:<30}  {:<12}".format(str(rec[0]), rec[1], rec[2])
+            for rec in records]
+
+
+def legacy_history_rows() -> list:
+    """
+    legacy_history_rows():
+        The whole table, as a search without an index would see it
+    """
+    return csg_db().fetchall("SELECT number, command, type FROM history;")
+
+
+def measure(name: str, rows, limit: int = None) -> None:
+    """
+    measure():
+        Consume `rows`, and print the time to the first row, the total
+        time and the peak memory
+    """
+    tracemalloc.start()
+    start = perf_counter()
+    first = None
+    n_rows = 0
+
+    for row in rows():
+        if first is None:
+            first = perf_counter() - start
+
+        "{:>6}  {:<30}  {:<12}".format(str(row[0]), row[1], row[2])
+        n_rows += 1
+        if n_rows == limit:
+            break
+
+    total = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print("{:<34} {:>8} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+        name, n_rows, (first or 0) * 1e3, total * 1e3, peak / 2**20))
+
+
+def main() -> None:
+    os.chdir(mkdtemp(prefix="csg-bench-"))
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        init_csg_db()
+
+    start = perf_counter()
+    fill_history(N_ROWS)
+    print(f"Inserted {N_ROWS} rows in {perf_counter() - start:.2f}s\n")
+
+    print("{:<34} {:>8} {:>10} {:>10} {:>10}".format(
+        "Query", "Rows", "First ms", "Total ms", "Peak MiB"))
+
+    measure("fetchall, all (old)", legacy_history)
+    measure("streamed, all", iter_history)
+    measure("fetchall, select builtin (old)",
+            lambda: legacy_history("builtin"))
+    measure("streamed, select builtin",
+            lambda: iter_history("builtin"))
+    measure("streamed, page of 20 at the end",
+            lambda: iter_history("formula", 20, since=N_ROWS - 1000))
+    measure("search 'Xe1', full-text index",
+            lambda: iter_history(text="Xe1"))
+    measure("search 'Xe1', scan",
+            lambda: (row for row in legacy_history_rows()
+                     if "xe1" in row[1].lower()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# bench_molecule.py: Check Molecule parsing on known compounds, then
+#                    benchmark parsing, validation and geometry on large
+#                    molecules
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import tracemalloc
+from collections import Counter
+from os import path
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from core import analyze, init_csg_db
+from molecule import parse_molecule, validate_molecule, molecule_coordinates
+
+
+# Compounds that analyze() must accept, with the bonds they must have:
+# {(element, element, bond order): number of bonds}, with the two
+# elements in alphabetical order
+KNOWN_BONDS = {
+    # Oxoacids: hydrogen on oxygen, and the other oxygens double-bonded
+    "H2SO4": {("H", "O", 1): 2, ("O", "S", 1): 2, ("O", "S", 2): 2},
+    "H3PO4": {("H", "O", 1): 3, ("O", "P", 1): 3, ("O", "P", 2): 1},
+    "H2CO3": {("H", "O", 1): 2, ("C", "O", 1): 2, ("C", "O", 2): 1},
+
+    # Molecular formulae
+    "C2H4": {("C", "C", 2): 1, ("C", "H", 1): 4},
+    "C2H2": {("C", "C", 3): 1, ("C", "H", 1): 2},
+    "C3H8": {("C", "C", 1): 2, ("C", "H", 1): 8},
+    "C6H6": {("C", "C", 1): 3, ("C", "C", 2): 3, ("C", "H", 1): 6},
+    "C6H12": {("C", "C", 1): 6, ("C", "H", 1): 12},
+
+    # Condensed formulae
+    "CH3CH2OH": {("C", "C", 1): 1, ("C", "H", 1): 5, ("C", "O", 1): 1,
+                 ("H", "O", 1): 1},
+    "C(CH3)4": {("C", "C", 1): 4, ("C", "H", 1): 12},
+    "CH3C(O)OH": {("C", "C", 1): 1, ("C", "H", 1): 3, ("C", "O", 1): 1,
+                  ("C", "O", 2): 1, ("H", "O", 1): 1}
+}
+
+# Alkanes, CH3(CH2)nCH3, with 3n + 8 atoms
+CHAIN_LENGTHS = [100, 1000, 10000]
+
+N_RUNS = 3
+
+
+def object_molecule(mol) -> list:
+    """
+    object_molecule():
+        The same molecule as one dict per atom, with a list of bonded
+        atoms each, for the memory comparison.
+    """
+    atoms = [{"element": el, "bonds": []} for el in mol.symbols()]
+    for k in range(mol.n_bonds):
+        i, j = mol.edges[2 * k], mol.edges[2 * k + 1]
+        atoms[i]["bonds"].append((j, mol.orders[k]))
+        atoms[j]["bonds"].append((i, mol.orders[k]))
+
+    return atoms
+
+
+def retained_bytes(build) -> int:
+    """
+    retained_bytes():
+        Return the memory still allocated once `build` has returned, i.e.
+        the size of what it built.
+    """
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+
+    return size
+
+
+def best_time(func, *args) -> float:
+    """
+    best_time():
+        Return the best of N_RUNS calls to func(*args), in milliseconds
+    """
+    best = None
+    for _ in range(N_RUNS):
+        start = perf_counter()
+        func(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1e3
+
+
+def bond_counts(mol) -> dict:
+    """
+    bond_counts():
+        Return the bonds of a molecule in the form of KNOWN_BONDS
+    """
+    symbols = mol.symbols()
+    edges = mol.edges
+
+    return dict(Counter(
+        (*sorted((symbols[edges[2 * k]], symbols[edges[2 * k + 1]])), order)
+        for k, order in enumerate(mol.orders)))
+
+
+def check_known_bonds() -> bool:
+    """
+    check_known_bonds():
+        Check every compound in KNOWN_BONDS, through analyze(), and that
+        its bonds come out of unit length. Returns True if all of them
+        pass.
+    """
+    passed = True
+    for chem_form, expected in KNOWN_BONDS.items():
+        analysis = analyze(chem_form)
+        if analysis is None or analysis.molecule is None:
+            problem = "not a valid molecule"
+
+        elif bond_counts(analysis.molecule) != expected:
+            problem = f"bonds {bond_counts(analysis.molecule)}"
+
+        else:
+            mol = analysis.molecule
+            coords = molecule_coordinates(mol)
+            lengths = [((coords[mol.edges[2 * k]]
+                         - coords[mol.edges[2 * k + 1]]) ** 2).sum() ** 0.5
+                       for k in range(mol.n_bonds)]
+            problem = None if max(abs(x - 1) for x in lengths) < 1e-6 \
+                else "bonds are not of unit length"
+
+        print("{:<12} {}".format(chem_form, problem or "ok"))
+        if problem is not None:
+            passed = False
+
+    return passed
+
+
+def main() -> int:
+    os.chdir(mkdtemp(prefix="csg-bench-"))
+    sys.stdout = open(os.devnull, "w")
+    init_csg_db()
+    sys.stdout = sys.__stdout__
+
+    if not check_known_bonds():
+        return 1
+
+    print()
+
+    print("{:>7} {:>10} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+        "atoms", "bytes", "B/atom", "dicts B/at", "parse ms", "valid ms",
+        "coords ms"))
+
+    for n in CHAIN_LENGTHS:
+        chem_form = f"CH3(CH2){n}CH3"
+        mol = parse_molecule(chem_form)
+        assert validate_molecule(mol), chem_form
+
+        size = retained_bytes(lambda: parse_molecule(chem_form))
+        dict_size = retained_bytes(lambda: object_molecule(mol))
+
+        print("{:>7} {:>10} {:>10.1f} {:>12.1f} {:>10.2f} {:>10.2f} "
+              "{:>10.2f}".format(
+                  len(mol), size, size / len(mol), dict_size / len(mol),
+                  best_time(parse_molecule, chem_form),
+                  best_time(validate_molecule, mol),
+                  best_time(molecule_coordinates, mol)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# bench_parser.py: Benchmark the formula tokenizer against the old parser
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import re
+import sys
+from os import path
+from timeit import repeat
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from core import get_elements, get_elements_many, parse_formula
+
+
+FORMULAE = [
+    "H2O", "NH3", "CO2", "CH4", "PCl5", "SF6", "XeF4", "BF3", "BeCl2",
+    "ClF3", "IF7", "SO2", "HCl", "Xx2", "h2o", "H2O2x", "C12H22", "NaCl"
+]
+
+
+def legacy_get_elements(chem_form: str) -> dict:
+    """
+    legacy_get_elements():
+        The character-by-character parser that get_elements() replaced,
+        kept here as the baseline for the comparison.
+    """
+    if chem_form is None:
+        return
+
+    chem_form = chem_form.strip()
+
+    re_match = re.match("^([A-Z][a-z]?\\d*){2}", chem_form)
+    if re_match is None or re_match.group() != chem_form:
+        return
+
+    element_dict = {}
+    cur_el = ""
+    cur_el_num_str = "1"
+    found_digit = False
+
+    for ch in chem_form:
+        if ch.isupper():
+            if cur_el != "" and not found_digit:
+                element_dict[cur_el] = 1
+
+            cur_el = ch
+            found_digit = False
+
+        elif ch.islower():
+            cur_el += ch
+            found_digit = False
+
+        elif ch.isdigit():
+            if not found_digit:
+                found_digit = True
+                cur_el_num_str = ch
+                element_dict[cur_el] = int(cur_el_num_str)
+
+            else:
+                cur_el_num_str += ch
+                element_dict[cur_el] = int(cur_el_num_str)
+
+    if not found_digit:
+        element_dict[cur_el] = 1
+
+    return element_dict
+
+
+def bench(name: str, stmt, number: int) -> float:
+    """
+    bench():
+        Time `stmt` and print the best per-formula time in microseconds
+    """
+    best = min(repeat(stmt, number=number, repeat=5))
+    per_call = best / (number * len(FORMULAE)) * 1e6
+    print("{:<28} {:>8.3f} us/formula".format(name, per_call))
+
+    return per_call
+
+
+def main() -> None:
+    number = 2000
+
+    # Both parsers must agree before their speed is worth comparing.
+    for chem_form in FORMULAE:
+        assert get_elements(chem_form) == legacy_get_elements(chem_form), \
+            chem_form
+
+    legacy = bench("legacy get_elements()",
+                   lambda: [legacy_get_elements(f) for f in FORMULAE], number)
+
+    # The function underneath the LRU cache, i.e. a cache miss every time.
+    uncached = parse_formula.__wrapped__
+    cold = bench("parse_formula() (uncached)",
+                 lambda: [uncached(f) for f in FORMULAE], number)
+    warm = bench("get_elements() (warm cache)",
+                 lambda: [get_elements(f) for f in FORMULAE], number)
+    bulk = bench("get_elements_many()",
+                 lambda: get_elements_many(FORMULAE), number)
+
+    print()
+    print("Speedup (uncached): {:.1f}x".format(legacy / cold))
+    print("Speedup (warm): {:.1f}x".format(legacy / warm))
+    print("Speedup (bulk): {:.1f}x".format(legacy / bulk))
+
+
+if __name__ == "__main__":
+    main()
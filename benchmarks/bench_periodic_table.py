@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# bench_periodic_table.py: Benchmark PeriodicTable lookups
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sys
+from os import path
+from timeit import repeat
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from chemistry import pt, Stats, PeriodicTable
+
+
+# Spread over the groups, since the old lookups scanned them in order.
+ELEMENTS = ["H", "Be", "B", "C", "N", "O", "F", "Cl", "Br", "Xe", "Rn", "Zz"]
+
+
+class LegacyLookups:
+    """
+    Group-scanning lookups that PeriodicTable used to do, kept here as the
+    baseline for the comparison.
+    """
+    def __init__(self):
+        self.groups = {n_grp: dict.fromkeys(pt.get_group_elements(n_grp))
+                       for n_grp in pt.get_group_numbers()}
+        self.valencies = {n_grp: pt.get_valency(pt.get_group_elements(n_grp)[0])
+                          for n_grp in self.groups}
+        self.colors = {el: tuple(round(c * 255) for c in pt.get_markercolor(el))
+                       for el in ELEMENTS if pt.check(el)}
+
+    def check(self, element: str) -> bool:
+        for i in self.groups:
+            if element in self.groups[i]:
+                return True
+
+        return False
+
+    def get_valency(self, element: str) -> int:
+        for n_grp in self.groups:
+            if element in self.groups[n_grp]:
+                return self.valencies[n_grp]
+
+    def get_markercolor(self, element: str) -> list:
+        color_list = []
+        for rgb in list(self.colors[element]):
+            color_list.append(rgb / 255)
+
+        return color_list
+
+
+def bench(name: str, stmt, number: int = 20000) -> float:
+    """
+    bench():
+        Time `stmt` and print the best per-call time in nanoseconds
+    """
+    best = min(repeat(stmt, number=number, repeat=5))
+    per_call = best / number * 1e9
+    print("{:<36} {:>8.1f} ns".format(name, per_call))
+
+    return per_call
+
+
+def main() -> None:
+    legacy = LegacyLookups()
+    known = [el for el in ELEMENTS if pt.check(el)]
+    n = len(ELEMENTS)
+
+    bench("legacy check() x{}".format(n),
+          lambda: [legacy.check(el) for el in ELEMENTS])
+    bench("check() x{}".format(n),
+          lambda: [pt.check(el) for el in ELEMENTS])
+
+    bench("legacy get_valency() x{}".format(n),
+          lambda: [legacy.get_valency(el) for el in ELEMENTS])
+    bench("get_valency() x{}".format(n),
+          lambda: [pt.get_valency(el) for el in ELEMENTS])
+    bench("get_nvalence_electrons() x{}".format(n),
+          lambda: [pt.get_nvalence_electrons(el) for el in ELEMENTS])
+
+    bench("legacy get_markercolor() x{}".format(len(known)),
+          lambda: [legacy.get_markercolor(el) for el in known])
+    bench("get_markercolor() x{}".format(len(known)),
+          lambda: [pt.get_markercolor(el) for el in known])
+
+    bench("PeriodicTable()", PeriodicTable, 2000)
+    bench("Stats()", lambda: Stats({"Xe": 1}, {"F": 4}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# bench_render.py: Benchmark rebuilding vs. reusing the render scene
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sys
+from os import path, chdir
+from tempfile import mkdtemp
+from timeit import repeat
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from core import init_csg_db, analyze, draw_structure, RenderSession
+
+
+# Cycled through, like a user clicking through the recents list
+FORMULAE = ["SF6", "H2O", "CO2", "XeF4", "NH3", "BF3", "PCl5", "ClF3"]
+
+
+def rebuild(pixels: bool) -> None:
+    """
+    rebuild():
+        Render each formula on a brand-new figure, as render() used to
+    """
+    for chem_form in FORMULAE:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        draw_structure(fig, analyze(chem_form), "dark")
+        if pixels:
+            fig.canvas.draw()
+
+
+def reuse(session: RenderSession, pixels: bool) -> None:
+    """
+    reuse():
+        Render each formula on the same figure, through a RenderSession
+    """
+    for chem_form in FORMULAE:
+        session.draw(analyze(chem_form), "dark")
+        if pixels:
+            session.fig.canvas.draw()
+
+
+def bench(name: str, stmt, number: int = 10) -> float:
+    """
+    bench():
+        Time `stmt` and print the best per-render time in milliseconds
+    """
+    best = min(repeat(stmt, number=number, repeat=3))
+    per_render = best / (number * len(FORMULAE)) * 1e3
+    print("{:<44} {:>8.2f} ms/render".format(name, per_render))
+
+    return per_render
+
+
+def main() -> None:
+    # Keep the benchmark's databases out of the source tree.
+    chdir(mkdtemp(prefix="csg-bench-"))
+    init_csg_db()
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    session = RenderSession(fig)
+
+    for pixels in (False, True):
+        suffix = " (+ draw to pixels)" if pixels else " (scene only)"
+        old = bench("new figure per render" + suffix,
+                    lambda: rebuild(pixels))
+        new = bench("RenderSession" + suffix,
+                    lambda: reuse(session, pixels))
+        print("Speedup: {:.1f}x\n".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
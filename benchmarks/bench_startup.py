@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# bench_startup.py: Benchmark CLI startup and check what it imports
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sys
+import subprocess
+from os import path
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter
+
+CSG = path.join(path.dirname(path.abspath(__file__)), "..", "csg.py")
+
+# None of these may be imported on a path that does not render.
+FORBIDDEN = ("matplotlib", "mpl_toolkits", "PyQt5", "numpy")
+
+# (name, arguments, standard input)
+CASES = [
+    ("--version", ["--version"], ""),
+    ("--help", ["--help"], ""),
+    ("--cli, builtins only", ["--cli"], "/help\n/history\n"),
+    ("--cli, validation only", ["--cli"], "Xx2\nH3\n"),
+    ("--batch", ["--batch", "formulas.txt", "-j", "1"], "")
+]
+
+N_RUNS = 5
+
+
+def run_case(args: list, stdin: str, cwd: str) -> tuple:
+    """
+    run_case():
+        Run csg.py with -X importtime. Returns the wall time in seconds,
+        and a dict of imported modules with their cumulative import time
+        in microseconds.
+    """
+    start = perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", CSG, *args],
+                          input=stdin, cwd=cwd, capture_output=True,
+                          text=True)
+    elapsed = perf_counter() - start
+
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue
+
+        modules[fields[2].strip()] = int(fields[1])
+
+    return elapsed, modules
+
+
+def main() -> int:
+    cwd = mkdtemp(prefix="csg-bench-")
+    with open(path.join(cwd, "formulas.txt"), "w") as f:
+        f.write("H2O\nNH3\nXeF4\nXx2\n")
+
+    failed = False
+    for name, args, stdin in CASES:
+        runs = [run_case(args, stdin, cwd) for _ in range(N_RUNS)]
+        modules = runs[-1][1]
+
+        forbidden = sorted(mod for mod in modules
+                           if mod.split(".")[0] in FORBIDDEN)
+        status = "ok" if len(forbidden) == 0 else "FAIL"
+
+        print("{:<28} {:>8.1f} ms  {:>4} modules  {}".format(
+            name, median(run[0] for run in runs) * 1e3, len(modules),
+            status))
+
+        if len(forbidden) > 0:
+            failed = True
+            print("    imports: " + ", ".join(forbidden[:10]))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
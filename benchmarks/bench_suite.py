@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+# bench_suite.py: Benchmark each stage of CSG and check for regressions
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Usage: bench_suite.py [--output FILE] [--baseline FILE] [--threshold PCT]
+#                       [--update-baseline] [--stage NAME]...
+#
+# Times every stage over the formulas in corpus.txt and writes the results
+# as JSON. Each stage is then compared against the baseline, and the run
+# exits with status 1 if any stage is more than PCT percent (default: 50)
+# slower. Timings depend on the machine, so regenerate the baseline with
+# --update-baseline when moving to a different one.
+
+import json
+import os
+from contextlib import redirect_stdout
+import platform
+import sys
+from os import path, chdir
+from tempfile import mkdtemp
+from timeit import repeat
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(BENCH_DIR, ".."))
+
+import matplotlib
+matplotlib.use("Agg")
+
+from db import close_all, preferences
+from core import (init_csg_db, init_geometry_db, validate, get_elements,
+                  get_compound_stats, get_lp, classify_geometry, analyze,
+                  search_compounds, get_geometry_index, fetch_coordinates,
+                  render_image)
+from vsepr import STANDARD_CLASSES, solve
+
+
+CORPUS_PATH = path.join(BENCH_DIR, "corpus.txt")
+
+# Geometries looked up by the search_compounds stage
+SEARCH_GEOMETRIES = ["AB2", "AB2L2", "AB3", "AB3L", "AB4", "AB4L2", "AB5",
+                     "AB6"]
+BASELINE_PATH = path.join(BENCH_DIR, "baseline.json")
+DEFAULT_THRESHOLD = 50.0
+
+# Number of times stages that look slower are re-timed before failing
+RETRIES = 2
+
+
+def get_opt_value(opt: str, default: str = None) -> str:
+    """
+    get_opt_value():
+        Return the value following `opt` in argv
+    """
+    if opt in sys.argv:
+        i = sys.argv.index(opt)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+
+        print(f"[!] Option '{opt}' requires a value.")
+        sys.exit(2)
+
+    return default
+
+
+def load_corpus(path_name: str = CORPUS_PATH) -> list:
+    """
+    load_corpus():
+        Read the formula corpus. Blank lines and '#' comments are skipped,
+        but other whitespace is kept, since it makes a formula invalid.
+    """
+    with open(path_name) as f:
+        return [line.rstrip("\n") for line in f
+                if line.strip() != "" and not line.startswith("#")]
+
+
+def time_stage(stmt, n_items: int, number: int, repeats: int = 5) -> float:
+    """
+    time_stage():
+        Return the best time per item, in microseconds
+    """
+    best = min(repeat(stmt, number=number, repeat=repeats))
+    return best / (number * n_items) * 1e6
+
+
+def fresh_dir() -> str:
+    """
+    fresh_dir():
+        Switch to a new, empty working directory, so that the databases
+        are created from scratch
+    """
+    dir_path = mkdtemp(prefix="csg-bench-")
+    chdir(dir_path)
+
+    # Open connections and cached preferences still refer to the old
+    # directory. The geometry store is kept, since the coordinates are the
+    # same everywhere, and computing them again would dominate the run.
+    close_all()
+    preferences.clear()
+
+    return dir_path
+
+
+def run_stages(corpus: list, selected: list) -> dict:
+    """
+    run_stages():
+        Time each stage and return {stage: microseconds per item}
+    """
+    valid = [f for f in corpus if validate(f)]
+    element_dicts = [get_elements(f) for f in valid]
+    lps = [get_lp(d) for d in element_dicts]
+    geometries = [classify_geometry(d, lp)
+                  for d, lp in zip(element_dicts, lps)]
+
+    # Classes with too many domains have no coordinates.
+    drawable = []
+    for chem_form, geometry in zip(valid, geometries):
+        try:
+            fetch_coordinates(geometry)
+            drawable.append((chem_form, geometry))
+
+        except ValueError:
+            pass
+
+    pairs = list(zip(element_dicts, lps))
+
+    # The function underneath the memo cache, i.e. the full pipeline on
+    # every call
+    analyze_uncached = analyze.__wrapped__
+
+    # Queries are timed against an index that is already built.
+    get_geometry_index()
+
+    def run_init_csg_db():
+        fresh_dir()
+        init_csg_db()
+
+    def run_init_geometry_db():
+        fresh_dir()
+        os.mkdir(".db")
+        init_geometry_db()
+
+    # (name, statement, number of items per call, calls per timing)
+    stages = [
+        ("get_elements", lambda: [get_elements(f) for f in corpus],
+         len(corpus), 2000),
+        ("validate", lambda: [validate(f) for f in corpus],
+         len(corpus), 2000),
+        ("get_compound_stats",
+         lambda: [get_compound_stats(d) for d in element_dicts],
+         len(element_dicts), 500),
+        ("get_lp", lambda: [get_lp(d) for d in element_dicts],
+         len(element_dicts), 500),
+        ("classify_geometry",
+         lambda: [classify_geometry(d, lp) for d, lp in pairs],
+         len(pairs), 2000),
+        ("analyze", lambda: [analyze_uncached(f) for f in corpus],
+         len(corpus), 500),
+        ("search_compounds",
+         lambda: [search_compounds(g) for g in SEARCH_GEOMETRIES],
+         len(SEARCH_GEOMETRIES), 200),
+        ("fetch_coordinates",
+         lambda: [fetch_coordinates(g) for _, g in drawable],
+         len(drawable), 2000),
+        ("init_csg_db (fresh)", run_init_csg_db, 1, 3),
+        ("init_csg_db", init_csg_db, 1, 50),
+        ("init_geometry_db (fresh)", run_init_geometry_db, 1, 3),
+        ("init_geometry_db", init_geometry_db, 1, 50),
+        ("solve_geometries", lambda: solve(STANDARD_CLASSES),
+         len(STANDARD_CLASSES), 1),
+        ("render (headless)",
+         lambda: [render_image(f, "png", theme="dark", use_cache=False)
+                  for f, _ in drawable[:8]],
+         min(8, len(drawable)), 1)
+    ]
+
+    results = {}
+    for name, stmt, n_items, number in stages:
+        if selected and name.split()[0] not in selected:
+            continue
+
+        # The init stages leave the working directory elsewhere; always
+        # start each stage from a directory with initialized databases.
+        fresh_dir()
+        init_csg_db()
+
+        results[name] = time_stage(stmt, n_items, number,
+                                   repeats=5 if number < 10 else 9)
+        print("{:<28} {:>12.3f} us/item".format(name, results[name]),
+              file=sys.stderr)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    compare():
+        Return the stages that are more than `threshold` percent slower
+        than the baseline, as (stage, baseline, current) tuples
+    """
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        if current > base * (1 + threshold / 100):
+            regressions.append((name, base, current))
+
+    return regressions
+
+
+def main() -> None:
+    out_path = get_opt_value("--output")
+    baseline_path = get_opt_value("--baseline", BASELINE_PATH)
+    threshold = float(get_opt_value("--threshold", str(DEFAULT_THRESHOLD)))
+    selected = [sys.argv[i + 1] for i, arg in enumerate(sys.argv[:-1])
+                if arg == "--stage"]
+
+    # Resolve paths before the benchmark starts changing directories.
+    baseline_path = path.abspath(baseline_path)
+    if out_path is not None:
+        out_path = path.abspath(out_path)
+
+    corpus = load_corpus()
+
+    # The database setup code reports its progress on stdout, which would
+    # get mixed up with the JSON output.
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        # Keep the benchmark's databases out of the source tree.
+        fresh_dir()
+        init_csg_db()
+
+        results = run_stages(corpus, selected)
+
+    baseline = None
+    if "--update-baseline" not in sys.argv:
+        try:
+            with open(baseline_path) as f:
+                baseline = json.load(f)["stages"]
+
+        except FileNotFoundError:
+            print(f"[!] No baseline at '{baseline_path}'; "
+                  "run with --update-baseline to create one.", file=sys.stderr)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, threshold)
+
+    # Timings are noisy, so give stages that look slower another chance
+    # before failing the run.
+    for _ in range(RETRIES):
+        if not regressions:
+            break
+
+        names = [name.split()[0] for name, _, _ in regressions]
+        print(f"[!] Re-running: {', '.join(names)}", file=sys.stderr)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            retimed = run_stages(corpus, names)
+
+        for name, _, _ in regressions:
+            results[name] = min(results[name], retimed[name])
+
+        regressions = compare(results, baseline, threshold)
+
+    report = {
+        "unit": "us/item",
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "corpus_size": len(corpus),
+        "stages": results
+    }
+
+    if out_path is not None:
+        with open(out_path, "w") as f:
+            json.dump(report, f, indent=4)
+
+    else:
+        print(json.dumps(report, indent=4))
+
+    if "--update-baseline" in sys.argv:
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=4)
+            f.write("\n")
+
+        print(f"[✓] Baseline written to '{baseline_path}'", file=sys.stderr)
+        return
+
+    if baseline is None:
+        return
+
+    for name, base, current in regressions:
+        print("[!] {}: {:.3f} -> {:.3f} us/item (+{:.0f}%)".format(
+              name, base, current, (current / base - 1) * 100),
+              file=sys.stderr)
+
+    if regressions:
+        print(f"[!] {len(regressions)} stage(s) regressed by more than "
+              f"{threshold:g}%", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"[✓] No stage regressed by more than {threshold:g}%",
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# load_server.py: Load test a running `csg.py --serve`
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Usage: load_server.py [--host ADDR] [--port N] [--endpoint NAME]
+#                       [--connections N] [--requests N]
+#
+# Sends --requests requests, over --connections keep-alive connections,
+# cycling through the formulas in corpus.txt, and reports requests per
+# second and latency percentiles.
+
+import asyncio
+import sys
+from os import path
+from time import perf_counter
+from urllib.parse import quote
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+
+
+def get_opt_value(opt: str, default: str) -> str:
+    """
+    get_opt_value():
+        Return the value following `opt` in argv
+    """
+    if opt in sys.argv:
+        i = sys.argv.index(opt)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+
+        print(f"[!] Option '{opt}' requires a value.")
+        sys.exit(2)
+
+    return default
+
+
+def load_corpus() -> list:
+    """
+    load_corpus():
+        Read the formula corpus shared with bench_suite.py
+    """
+    with open(path.join(BENCH_DIR, "corpus.txt")) as f:
+        return [line.strip() for line in f
+                if line.strip() != "" and not line.startswith("#")]
+
+
+async def client(host: str, port: int, targets: list, latencies: list,
+                 statuses: dict) -> None:
+    """
+    client():
+        Send each request in `targets` over one keep-alive connection,
+        one at a time, recording the latency of each
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+
+    for target in targets:
+        start = perf_counter()
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n"
+                     .encode())
+
+        head = await reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":", 1)[1])
+
+        await reader.readexactly(length)
+        latencies.append(perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+        # The server is shutting down, or refused the request.
+        if b"connection: close" in head.lower():
+            reader, writer = await asyncio.open_connection(host, port)
+
+    writer.close()
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """
+    percentile():
+        Return the `pct`th percentile of a sorted list, by nearest rank
+    """
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+async def run(host: str, port: int, endpoint: str, n_connections: int,
+              n_requests: int) -> None:
+    corpus = load_corpus()
+    targets = [f"/{endpoint}?formula={quote(corpus[i % len(corpus)])}"
+               for i in range(n_requests)]
+
+    latencies = []
+    statuses = {}
+
+    start = perf_counter()
+    await asyncio.gather(*[
+        client(host, port, targets[i::n_connections], latencies, statuses)
+        for i in range(n_connections)])
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    print(f"{len(latencies)} requests to /{endpoint} over {n_connections} "
+          f"connection(s) in {elapsed:.3f}s")
+    print("{:<12} : {:.1f}".format("Requests/s", len(latencies) / elapsed))
+    for pct in (50, 90, 99, 99.9):
+        print("{:<12} : {:.3f} ms".format(
+            f"p{pct:g}", percentile(latencies, pct) * 1e3))
+
+    print("{:<12} : {:.3f} ms".format("max", latencies[-1] * 1e3))
+    print("{:<12} : {}".format("Statuses", dict(sorted(statuses.items()))))
+
+
+def main() -> None:
+    host = get_opt_value("--host", "127.0.0.1")
+    port = int(get_opt_value("--port", "8080"))
+    endpoint = get_opt_value("--endpoint", "analyze")
+    n_connections = int(get_opt_value("--connections", "16"))
+    n_requests = int(get_opt_value("--requests", "10000"))
+
+    asyncio.run(run(host, port, endpoint, n_connections, n_requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# stress_db.py: Run many CSG processes against one database directory
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Usage: stress_db.py [--processes N] [--writes N] [--baseline]
+#
+# Starts --processes fresh processes at once, against one new database
+# directory. Each initializes the databases, as if it had just started,
+# then adds --writes history records, half through the write-behind queue
+# and half directly, while paging through and searching the history.
+# Afterwards, every record must be there exactly once, and no process may
+# have seen a lock error.
+#
+# --baseline runs the same test without write-ahead logging, busy
+# timeout or retries, for comparison.
+
+import multiprocessing
+import sqlite3
+import sys
+from contextlib import redirect_stdout
+from io import StringIO
+from os import path
+from tempfile import mkdtemp
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+import db
+from db import HISTORY_MAX_ROWS
+
+
+N_PROCESSES = 8
+N_WRITES = 400
+
+# Pages through, and searches, the history once every this many writes
+READ_INTERVAL = 10
+
+
+def get_opt_value(opt: str, default: str) -> str:
+    """
+    get_opt_value():
+        Return the value following `opt` in argv
+    """
+    if opt in sys.argv:
+        i = sys.argv.index(opt)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+
+        print(f"[!] Option '{opt}' requires a value.")
+        sys.exit(2)
+
+    return default
+
+
+def worker(worker_id: int, n_writes: int, db_dir: str, baseline: bool,
+           start) -> dict:
+    """
+    worker():
+        Runs in its own process. Returns the number of errors, by kind,
+        and a few of their messages.
+    """
+    from core import init_csg_db
+    from db import (set_db_dir, add_history, queue_write, flush_writes,
+                    iter_history)
+
+    set_db_dir(db_dir)
+    if baseline:
+        db.DB_JOURNAL_MODE = "DELETE"
+        db.DB_BUSY_TIMEOUT = 0
+        db.DB_RETRIES = 0
+
+    errors = {"init": 0, "write": 0, "read": 0, "queued": 0}
+    messages = []
+
+    def failed(kind: str, ex: Exception) -> None:
+        errors[kind] += 1
+        if len(messages) < 3:
+            messages.append(f"{kind}: {ex}")
+
+    # The write queue reports failures on standard output.
+    log = StringIO()
+    start.wait()
+    t_start = perf_counter()
+
+    with redirect_stdout(log):
+        try:
+            init_csg_db()
+
+        except sqlite3.OperationalError as ex:
+            failed("init", ex)
+
+        since = 0
+        for i in range(n_writes):
+            command = f"/stress {worker_id} {i}"
+            if i % 2 == 0:
+                queue_write(add_history, command, "builtin")
+
+            else:
+                try:
+                    add_history(command, "builtin")
+
+                except sqlite3.OperationalError as ex:
+                    failed("write", ex)
+
+            if i % READ_INTERVAL == 0:
+                try:
+                    rows = list(iter_history("builtin", 20, since=since))
+                    if len(rows) > 0:
+                        since = rows[-1][0]
+
+                    list(iter_history(text=f"stress {worker_id} "))
+
+                except sqlite3.OperationalError as ex:
+                    failed("read", ex)
+
+        flush_writes()
+
+    errors["queued"] = log.getvalue().count("Failed to write")
+
+    return {"errors": errors, "messages": messages,
+            "elapsed": perf_counter() - t_start}
+
+
+def main() -> None:
+    n_processes = int(get_opt_value("--processes", str(N_PROCESSES)))
+    n_writes = int(get_opt_value("--writes", str(N_WRITES)))
+    baseline = "--baseline" in sys.argv
+
+    if n_processes * n_writes > HISTORY_MAX_ROWS:
+        print(f"[!] At most {HISTORY_MAX_ROWS} records in total, or older "
+              "ones are evicted.")
+        sys.exit(2)
+
+    db_dir = mkdtemp(prefix="csg-stress-")
+
+    # Fresh interpreters, so that every process starts up, and races to
+    # initialize the databases, like a separate CSG process would.
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Manager().Event()
+
+    with ctx.Pool(n_processes) as pool:
+        results = [pool.apply_async(worker, (i, n_writes, db_dir, baseline,
+                                             start))
+                   for i in range(n_processes)]
+
+        t_start = perf_counter()
+        start.set()
+        results = [result.get() for result in results]
+        elapsed = perf_counter() - t_start
+
+    conn = sqlite3.connect(path.join(db_dir, db.CSG_DB_NAME))
+    found = [rec[0] for rec in conn.execute(
+        "SELECT command FROM history WHERE command LIKE '/stress %';")]
+    journal_mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    conn.close()
+
+    expected = {f"/stress {w} {i}" for w in range(n_processes)
+                for i in range(n_writes)}
+    lost = len(expected - set(found))
+    duplicates = len(found) - len(set(found))
+
+    totals = {}
+    for result in results:
+        for kind, count in result["errors"].items():
+            totals[kind] = totals.get(kind, 0) + count
+
+    print(f"Processes: {n_processes}, writes per process: {n_writes}, "
+          f"journal mode: {journal_mode}")
+    print(f"Elapsed: {elapsed:.2f}s, "
+          f"{n_processes * n_writes / elapsed:.0f} writes/s")
+    print("Lock errors: " + ", ".join(f"{kind} {count}"
+                                      for kind, count in totals.items()))
+    print(f"Records: {len(found)} of {len(expected)}, {lost} lost, "
+          f"{duplicates} duplicated")
+
+    messages = [message for result in results
+                for message in result["messages"]]
+    for message in dict.fromkeys(messages):
+        print(f"    {message}")
+
+    if lost > 0 or duplicates > 0 or sum(totals.values()) > 0:
+        print("[!] FAILED")
+        sys.exit(1)
+
+    print("[✓] OK")
+
+
+if __name__ == "__main__":
+    main()
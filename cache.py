@@ -0,0 +1,218 @@
+# cache.py: On-disk cache for rendered images
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# The cache holds encoded images (PNG or SVG), so it serves the paths that
+# produce files or bytes: --export, --serve and "/cache warm". The GUI is
+# deliberately not routed through it. Its structure page is a live
+# matplotlib canvas, which can be rotated, not a picture, so it is
+# redrawn on every render; RenderSession keeps that cheap by updating the
+# existing artists in place.
+
+import os
+from hashlib import sha256
+
+
+# Name of the cache directory, inside the database directory
+IMAGE_CACHE_DIR_NAME = "image_cache"
+
+# Once the cache grows past IMAGE_CACHE_MAX_BYTES, the least recently used
+# images are evicted until it is down to IMAGE_CACHE_LOW_WATER of that.
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+IMAGE_CACHE_LOW_WATER = 0.9
+
+
+class ImageCache:
+    """
+    Content-addressed, size-bounded cache of rendered images. Each image
+    is a file named after the hash of everything that went into it. Reading
+    an image updates its modification time, which is what eviction goes
+    by, so the least recently used images are evicted first.
+
+    Without a directory, nothing is cached, and every lookup is a miss.
+    """
+    def __init__(self, dir_path: str = None,
+                 max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        """
+        Constructor.
+
+        Args:
+            dir_path: directory that holds the cached images, or None to
+                      cache nothing
+            max_bytes: maximum total size of the cached images
+        """
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Total size of the cached images, once known
+        self.__size = None
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+        Return the cache key for an image.
+
+        Args:
+            parts: everything the image depends on, eg. formula, theme,
+                   figure size, DPI, format and renderer version
+        """
+        return sha256(repr(parts).encode()).hexdigest()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.dir_path, key)
+
+    def get(self, key: str) -> bytes:
+        """
+        Return a cached image, or None if it is not in the cache.
+
+        Args:
+            key: key returned by make_key()
+        """
+        if self.dir_path is None:
+            self.misses += 1
+            return
+
+        path_name = self.__path(key)
+        try:
+            with open(path_name, "rb") as f:
+                data = f.read()
+
+            os.utime(path_name)
+
+        except OSError:
+            self.misses += 1
+            return
+
+        self.hits += 1
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Add an image to the cache, evicting older ones if necessary.
+
+        Args:
+            key: key returned by make_key()
+            data: the image
+        """
+        if self.dir_path is None:
+            return
+
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        # Write to a temporary file first, so that concurrent readers never
+        # see a half-written image.
+        path_name = self.__path(key)
+        tmp_path = f"{path_name}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        os.replace(tmp_path, path_name)
+
+        if self.__size is None:
+            self.__size = self.__scan_size()
+
+        else:
+            self.__size += len(data)
+
+        if self.__size > self.max_bytes:
+            self.evict(int(self.max_bytes * IMAGE_CACHE_LOW_WATER))
+
+    def __entries(self) -> list:
+        """Return (mtime, size, path) for each cached image."""
+        entries = []
+        if self.dir_path is None:
+            return entries
+
+        try:
+            with os.scandir(self.dir_path) as it:
+                for entry in it:
+                    if ".tmp" in entry.name:
+                        continue
+
+                    try:
+                        st = entry.stat()
+
+                    # Evicted by another process in the meantime
+                    except OSError:
+                        continue
+
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def __scan_size(self) -> int:
+        return sum(entry[1] for entry in self.__entries())
+
+    def evict(self, target_bytes: int) -> int:
+        """
+        Evict the least recently used images, until the cache is at most
+        `target_bytes` in size. Returns the number of images evicted.
+
+        Args:
+            target_bytes: size to shrink the cache to
+        """
+        # Other processes may have added or removed images, so start from
+        # what is actually on disk.
+        entries = sorted(self.__entries())
+        size = sum(entry[1] for entry in entries)
+        n_evicted = 0
+
+        for _, entry_size, path_name in entries:
+            if size <= target_bytes:
+                break
+
+            try:
+                os.remove(path_name)
+
+            except FileNotFoundError:
+                pass
+
+            size -= entry_size
+            n_evicted += 1
+
+        self.__size = size
+        self.evictions += n_evicted
+
+        return n_evicted
+
+    def clear(self) -> None:
+        """Remove every image from the cache."""
+        self.evict(0)
+
+    def stats(self) -> dict:
+        """Return the number of images, their total size and counters."""
+        entries = self.__entries()
+        self.__size = sum(entry[1] for entry in entries)
+
+        return {
+            "images": len(entries),
+            "bytes": self.__size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
@@ -19,13 +19,29 @@
 #   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+from array import array
+from collections import Counter
+from types import MappingProxyType
+from typing import Iterable
+
+
 class PeriodicTable:
     """
     Contains elements elements which can form compounds according to the
     VSEPR theory.
+
+    Element data is stored column-wise, in tuples indexed by atomic number,
+    so every lookup is a dict access followed by a tuple index. Instances
+    are immutable; use the shared instance `pt` instead of creating new
+    ones.
     """
+    __slots__ = (
+        "__groups", "__atomic_numbers", "__symbols", "__element_groups",
+        "__valencies", "__nvalence_electrons", "__markercolors", "__frozen"
+    )
+
     def __init__(self):
-        self.__groups = {
+        groups = {
             1:  {
                 'H':  1,  'Li': 3,  'Na': 11, 'K': 19,
                 'Rb': 37, 'Cs': 55, 'Fr': 87
@@ -34,7 +50,7 @@ class PeriodicTable:
                 'Be': 4, 'Mg': 12, 'Ca': 20, 'Sr': 38, 'Ba': 56, 'Ra': 88
             },
             13: {
-                'B':  5, 'Al': 13, 'Ga': 31, 'In': 49, 'Ti': 81
+                'B':  5, 'Al': 13, 'Ga': 31, 'In': 49, 'Tl': 81
             },
             14: {
                 'C':  6, 'Si': 14, 'Ge': 32, 'Sn': 50, 'Pb': 82
@@ -53,7 +69,7 @@ class PeriodicTable:
             }
         }
 
-        self.__group_valencies = {
+        group_valencies = {
             1:  1,
             2:  2,
             13: 3,
@@ -64,7 +80,7 @@ class PeriodicTable:
             18: 0
         }
 
-        self.__group_valence_electrons = {
+        group_valence_electrons = {
             1:  1,
             2:  2,
             13: 3,
@@ -75,33 +91,8 @@ class PeriodicTable:
             18: 8
         }
 
-        self.__atomic_numbers = {
-            'H':  1,
-            'He': 2,
-            'Li': 3,
-            'Be': 4,
-            'B':  5,
-            'C':  6,
-            'N':  7,
-            'O':  8,
-            'F':  9,
-            'Ne': 10,
-            'Na': 11,
-            'Mg': 12,
-            'Al': 13,
-            'Si': 14,
-            'P':  15,
-            'S':  16,
-            'Cl': 17,
-            'Ar': 18,
-            'K':  19,
-            'Ca': 20,
-            'Br': 35,
-            'I':  53,
-            'Xe': 54
-        }
-
-        self.__atomic_colors = [
+        # RGB colors, indexed by atomic number - 1
+        atomic_colors = [
             (135, 206, 235), (217, 255, 255), (204, 128, 255), (194, 255, 0),
             (255, 181, 181), (144, 144, 144), (48, 80, 248),   (255, 13, 13),
             (144, 224, 80),  (179, 227, 245), (171, 92, 242),  (138, 255, 0),
@@ -116,9 +107,57 @@ class PeriodicTable:
             (10, 125, 140),  (0, 105, 133),   (192, 192, 192), (255, 217, 143),
             (166, 117, 115), (102, 128, 128), (158, 99, 181),  (212, 122, 0),
             (148, 0, 148),   (66, 158, 176),  (87, 23, 143),   (0, 201, 0),
-            (112, 212, 255)
+            (112, 212, 255), (255, 255, 199), (217, 255, 199), (199, 255, 199),
+            (163, 255, 199), (143, 255, 199), (97, 255, 199),  (69, 255, 199),
+            (48, 255, 199),  (31, 255, 199),  (0, 255, 156),   (0, 230, 117),
+            (0, 212, 82),    (0, 191, 56),    (0, 171, 36),    (77, 194, 255),
+            (77, 166, 255),  (33, 148, 214),  (38, 125, 171),  (38, 102, 150),
+            (23, 84, 135),   (208, 208, 224), (255, 209, 35),  (184, 184, 208),
+            (166, 84, 77),   (87, 89, 97),    (158, 79, 181),  (171, 92, 0),
+            (117, 79, 69),   (66, 130, 150),  (66, 0, 102),    (0, 125, 0)
         ]
 
+        # Columns, indexed by atomic number. Index 0 is unused.
+        max_z = max(z for grp in groups.values() for z in grp.values())
+        symbols = [None] * (max_z + 1)
+        element_groups = [None] * (max_z + 1)
+        valencies = [None] * (max_z + 1)
+        nvalence_electrons = [None] * (max_z + 1)
+        atomic_numbers = {}
+
+        for n_grp, grp in groups.items():
+            for element, z in grp.items():
+                symbols[z] = element
+                element_groups[z] = n_grp
+                valencies[z] = group_valencies[n_grp]
+                nvalence_electrons[z] = group_valence_electrons[n_grp]
+                atomic_numbers[element] = z
+
+        # Helium is in group 18, but only has 2 valence electrons.
+        nvalence_electrons[atomic_numbers['He']] = 2
+
+        # Normalize colors once, instead of on every get_markercolor() call.
+        markercolors = [None]
+        markercolors += [tuple(rgb / 255 for rgb in color)
+                         for color in atomic_colors]
+
+        self.__groups = MappingProxyType({
+            n_grp: tuple(grp.keys()) for n_grp, grp in groups.items()
+        })
+        self.__atomic_numbers = MappingProxyType(atomic_numbers)
+        self.__symbols = tuple(symbols)
+        self.__element_groups = tuple(element_groups)
+        self.__valencies = tuple(valencies)
+        self.__nvalence_electrons = tuple(nvalence_electrons)
+        self.__markercolors = tuple(markercolors)
+        self.__frozen = True
+
+    def __setattr__(self, name: str, value) -> None:
+        if getattr(self, "_PeriodicTable__frozen", False):
+            raise AttributeError("PeriodicTable is immutable")
+
+        super().__setattr__(name, value)
+
     def check(self, element: str) -> bool:
         """
         Check if an element is present in the periodic table (as defined
@@ -127,11 +166,36 @@ class PeriodicTable:
         Args:
             element: the element which should be checked
         """
-        for i in self.__groups:
-            if element in self.__groups[i]:
-                return True
+        return element in self.__atomic_numbers
+
+    def get_atomic_number(self, element: str) -> int:
+        """
+        Get an element's atomic number.
 
-        return False
+        Args:
+            element: the element whose atomic number should be returned
+        """
+        return self.__atomic_numbers[element]
+
+    def get_symbol(self, atomic_number: int) -> str:
+        """
+        Get the symbol of the element with a given atomic number.
+
+        Args:
+            atomic_number: atomic number of the element
+        """
+        return self.__symbols[atomic_number]
+
+    def get_group(self, element: str) -> int:
+        """
+        Get the group number of an element.
+
+        Args:
+            element: the element whose group number should be returned
+        """
+        z = self.__atomic_numbers.get(element)
+        if z is not None:
+            return self.__element_groups[z]
 
     def get_valency(self, element: str) -> int:
         """
@@ -140,9 +204,9 @@ class PeriodicTable:
         Args:
             element: the element whose valency should be returned
         """
-        for n_grp in self.__groups:
-            if element in self.__groups[n_grp]:
-                return self.__group_valencies[n_grp]
+        z = self.__atomic_numbers.get(element)
+        if z is not None:
+            return self.__valencies[z]
 
     def get_nvalence_electrons(self, element: str) -> int:
         """
@@ -152,12 +216,24 @@ class PeriodicTable:
             element: the element whose number of valence electrons should be
                      returned.
         """
-        if element == 'He':
-            return 2
+        z = self.__atomic_numbers.get(element)
+        if z is not None:
+            return self.__nvalence_electrons[z]
 
-        for n_grp in self.__groups:
-            if element in self.__groups[n_grp]:
-                return self.__group_valence_electrons[n_grp]
+    def get_valency_table(self) -> tuple:
+        """Get the valencies of all elements, indexed by atomic number."""
+        return self.__valencies
+
+    def get_nvalence_electrons_table(self) -> tuple:
+        """
+        Get the numbers of valence electrons of all elements, indexed by
+        atomic number.
+        """
+        return self.__nvalence_electrons
+
+    def get_group_numbers(self) -> list:
+        """Get the numbers of all groups in the periodic table."""
+        return list(self.__groups.keys())
 
     def get_group_elements(self, num: int) -> list:
         """
@@ -166,7 +242,7 @@ class PeriodicTable:
         Args:
             num: group number
         """
-        return list(self.__groups[num].keys())
+        return list(self.__groups[num])
 
     def get_markersize(self, element: str) -> int:
         """
@@ -177,20 +253,15 @@ class PeriodicTable:
         """
         return self.__atomic_numbers[element] + 4
 
-    def get_markercolor(self, element: str) -> list:
+    def get_markercolor(self, element: str) -> tuple:
         """
-        Get an element's marker color for rendering purposes.
+        Get an element's marker color for rendering purposes, as a
+        normalized (r, g, b) tuple.
 
         Args:
             element: the element whose marker color should be returned.
         """
-        atomic_number = self.__atomic_numbers[element]
-        temp = list(self.__atomic_colors[atomic_number - 1])
-        color_list = []
-        for rgb in temp:
-            color_list.append(rgb / 255)
-
-        return color_list
+        return self.__markercolors[self.__atomic_numbers[element]]
 
 
 class Stats:
@@ -205,28 +276,15 @@ class Stats:
 
             nca_dict: dictionary of the form {"non central atom": subscript}
         """
-        pt = PeriodicTable()
-
         self.c_atom_dict = ca_dict
-        self.c_atom = list(ca_dict.keys())[0]
-        self.c_atom_sub = list(ca_dict.values())[0]
-        self.c_atom_val = 0
-        self.c_atom_nval_e = 0
-        for c_atom in ca_dict:
-            self.c_atom_val = pt.get_valency(c_atom)
-            self.c_atom_nval_e = pt.get_nvalence_electrons(c_atom)
-            break
+        self.c_atom, self.c_atom_sub = next(iter(ca_dict.items()))
+        self.c_atom_val = pt.get_valency(self.c_atom)
+        self.c_atom_nval_e = pt.get_nvalence_electrons(self.c_atom)
 
         self.nc_atom_dict = nca_dict
-        self.nc_atom = list(nca_dict.keys())[0]
-        self.nc_atom_sub = list(nca_dict.values())[0]
-        self.nc_atom_val = 0
-        self.nc_atom_nval_e = 0
-        for nc_atom in nca_dict:
-            self.nc_atom_val = pt.get_valency(nc_atom)
-            self.nc_atom_nval_e = pt.get_nvalence_electrons(nc_atom)
-            self.print_statsnc_atom_nval_e = pt.get_nvalence_electrons(nc_atom)
-            break
+        self.nc_atom, self.nc_atom_sub = next(iter(nca_dict.items()))
+        self.nc_atom_val = pt.get_valency(self.nc_atom)
+        self.nc_atom_nval_e = pt.get_nvalence_electrons(self.nc_atom)
 
     # This exists for debugging purposes
     def print_stats(self) -> None:
@@ -244,4 +302,193 @@ class Stats:
         print("\tNo. of valence electrons:\t", self.nc_atom_nval_e)
 
 
+def geometry_class(n_bonds: int, n_lp: int) -> str:
+    """
+    Return the name of a geometry class, in the form classify_geometry()
+    returns it, eg. "AB4L2" for 4 bonds and 2 lone pairs.
+
+    Args:
+        n_bonds: number of bonds
+        n_lp: number of lone pairs
+    """
+    name = "A"
+    for symbol, count in (("B", n_bonds), ("L", n_lp)):
+        if count == 1:
+            name += symbol
+
+        elif count > 1:
+            name += symbol + str(count)
+
+    return name
+
+
+class Molecule:
+    """
+    A molecule with any number of elements and central atoms, stored
+    compactly: atoms are atomic numbers in a typed array, and bonds are
+    pairs of atom indices in a flat edge array, with their bond orders in a
+    parallel array. There are no per-atom Python objects, so a molecule
+    with thousands of atoms is still just three small buffers.
+
+    Atoms are numbered from 0, in the order they were added. Bond i joins
+    atoms edges[2 * i] and edges[2 * i + 1].
+    """
+    __slots__ = ("atoms", "edges", "orders")
+
+    def __init__(self, atoms: Iterable[int] = (), edges: Iterable[int] = (),
+                 orders: Iterable[int] = None):
+        """
+        Constructor.
+
+        Args:
+            atoms: atomic numbers, one per atom
+            edges: flat sequence of bonded atom index pairs
+            orders: bond orders, one per bond; all single bonds if None
+        """
+        self.atoms = array("B", atoms)
+        self.edges = array("I", edges)
+        if len(self.edges) % 2 != 0:
+            raise ValueError("Bonds must be pairs of atom indices")
+
+        if orders is None:
+            self.orders = array("B", [1]) * (len(self.edges) // 2)
+
+        else:
+            self.orders = array("B", orders)
+
+        if len(self.orders) * 2 != len(self.edges):
+            raise ValueError("There must be one bond order per bond")
+
+    def __len__(self) -> int:
+        return len(self.atoms)
+
+    def __repr__(self) -> str:
+        return (f"Molecule('{self.formula()}', {len(self.atoms)} atoms, "
+                f"{self.n_bonds} bonds)")
+
+    @property
+    def n_bonds(self) -> int:
+        """Number of bonds."""
+        return len(self.orders)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the atom and bond buffers, in bytes."""
+        return sum(len(arr) * arr.itemsize
+                   for arr in (self.atoms, self.edges, self.orders))
+
+    def add_atom(self, element: str) -> int:
+        """
+        Add an atom, and return its index.
+
+        Args:
+            element: symbol of the element
+        """
+        self.atoms.append(pt.get_atomic_number(element))
+        return len(self.atoms) - 1
+
+    def add_bond(self, i: int, j: int, order: int = 1) -> int:
+        """
+        Add a bond between two atoms, and return its index.
+
+        Args:
+            i: index of the first atom
+            j: index of the second atom
+            order: bond order, eg. 2 for a double bond
+        """
+        self.edges.append(i)
+        self.edges.append(j)
+        self.orders.append(order)
+        return len(self.orders) - 1
+
+    def symbols(self) -> list:
+        """Return the element symbol of every atom."""
+        return [pt.get_symbol(z) for z in self.atoms]
+
+    def composition(self) -> dict:
+        """
+        Return a dictionary of elements, with the number of atoms of each,
+        in order of first appearance.
+        """
+        return {pt.get_symbol(z): n for z, n in Counter(self.atoms).items()}
+
+    def formula(self) -> str:
+        """Return the molecular formula, eg. "C2H6O" for ethanol."""
+        return "".join(el if n == 1 else f"{el}{n}"
+                       for el, n in self.composition().items())
+
+    def degrees(self) -> array:
+        """Return the number of atoms bonded to each atom."""
+        degrees = array("I", bytes(4 * len(self.atoms)))
+        for i, n in Counter(self.edges).items():
+            degrees[i] = n
+
+        return degrees
+
+    def bond_order_sums(self) -> array:
+        """
+        Return the sum of the bond orders of each atom, i.e. the number of
+        electrons it shares.
+        """
+        sums = array("I", bytes(4 * len(self.atoms)))
+        edges = self.edges
+        for k, order in enumerate(self.orders):
+            sums[edges[2 * k]] += order
+            sums[edges[2 * k + 1]] += order
+
+        return sums
+
+    def lone_pairs(self, sums: array = None) -> array:
+        """
+        Return the number of lone pairs on each atom. Negative for an atom
+        that has more bonds than valence electrons.
+
+        Args:
+            sums: bond_order_sums(), if it has already been computed
+        """
+        nval_e = pt.get_nvalence_electrons_table()
+        if sums is None:
+            sums = self.bond_order_sums()
+
+        return array("i", [(nval_e[z] - s) // 2
+                           for z, s in zip(self.atoms, sums)])
+
+    def adjacency(self) -> tuple:
+        """
+        Return the bonds as an adjacency list in compressed form: the atoms
+        bonded to atom i are neighbours[offsets[i]:offsets[i + 1]].
+        """
+        n = len(self.atoms)
+        offsets = array("I", bytes(4 * (n + 1)))
+        for i, count in Counter(self.edges).items():
+            offsets[i + 1] = count
+
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+
+        fill = array("I", offsets)
+        neighbours = array("I", bytes(4 * len(self.edges)))
+        edges = self.edges
+        for k in range(0, len(edges), 2):
+            i, j = edges[k], edges[k + 1]
+            neighbours[fill[i]] = j
+            fill[i] += 1
+            neighbours[fill[j]] = i
+            fill[j] += 1
+
+        return offsets, neighbours
+
+    def centres(self) -> list:
+        """
+        Return the (atom index, bonds, lone pairs) of each central atom,
+        i.e. each atom that is bonded to more than one other atom.
+        """
+        degrees = self.degrees()
+        lone_pairs = self.lone_pairs()
+
+        return [(i, degree, lone_pairs[i])
+                for i, degree in enumerate(degrees) if degree > 1]
+
+
+# The periodic table shared by all modules
 pt = PeriodicTable()
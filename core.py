@@ -19,16 +19,75 @@
 #   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-import sqlite3
 import re
-from os import path, mkdir
+import json
+import sqlite3
+from io import BytesIO
+from os import path, makedirs, replace, getpid
+from functools import lru_cache
+from hashlib import sha1
+from math import gcd
+from typing import Iterable, NamedTuple
 from chemistry import *
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
+from db import (Database, csg_db, geometry_db, table_exists, compact_db,
+                get_db_dir, persistent, db_file,
+                add_formula_to_history, queue_write, iter_history,
+                get_formula_history, clear_history, get_theme,
+                get_geometry_rows, add_geometry_rows)
+from cache import ImageCache, IMAGE_CACHE_DIR_NAME
+from tracing import span, traced
+import tracing
+
+
+class OxidationStates(dict):
+    """
+    Oxidation states of each element, kept as tuples. Any change to the
+    table drops the compound index (see invalidate_compound_index()), so
+    that validate() and analyze() never answer from a stale one.
+    """
+    def __init__(self, states: dict):
+        super().__init__((el, tuple(ox)) for el, ox in states.items())
+
+    def __setitem__(self, element: str, states) -> None:
+        super().__setitem__(element, tuple(states))
+        invalidate_compound_index()
+
+    def __delitem__(self, element: str) -> None:
+        super().__delitem__(element)
+        invalidate_compound_index()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs) -> None:
+        for element, states in dict(*args, **kwargs).items():
+            super().__setitem__(element, tuple(states))
+
+        invalidate_compound_index()
+
+    def setdefault(self, element: str, states=()):
+        if element not in self:
+            self[element] = states
+
+        return self[element]
 
+    def pop(self, *args):
+        states = super().pop(*args)
+        invalidate_compound_index()
+        return states
 
-oxidn_states = {
+    def popitem(self):
+        item = super().popitem()
+        invalidate_compound_index()
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        invalidate_compound_index()
+
+
+oxidn_states = OxidationStates({
     'H':  [-1, 1],
     'He': [0],
     'Li': [1],
@@ -52,200 +111,246 @@ oxidn_states = {
     'Br': [-1, 1, 3, 5, 7],
     'I':  [-1, 1, 3, 5, 7],
     'Xe': [2, 4, 6, 8]
-}
+})
 
 tick = '\u2713'
 
+# Formula should be of the form:
+#     <Element 1>[Subscript]<Element2>[Subscript]
+formula_re = re.compile(r"([A-Z][a-z]?)(\d*)([A-Z][a-z]?)(\d*)")
+
+# Bump CSG_SCHEMA_VERSION whenever the layout of the CSG database
+# changes; init_csg_db() migrates older databases.
+CSG_SCHEMA_VERSION = 2
+
+# Bump GEOMETRY_SCHEMA_VERSION whenever the layout of the geometry
+# database, or the way its coordinates are computed, changes;
+# init_geometry_db() migrates older databases.
+GEOMETRY_SCHEMA_VERSION = 3
+
+# Defaults for render_image() and render_to_file()
+EXPORT_DPI = 100
+EXPORT_FIGSIZE = (6.4, 4.8)
+
+# Part of every image cache key. Bump it whenever a change to the drawing
+# code changes what rendered images look like.
+RENDERER_VERSION = 4
+
+# Maximum number of parsed formulae kept by parse_formula()
+PARSE_CACHE_SIZE = 4096
+
+# Largest subscript covered by the compound index. Formulae with larger
+# subscripts are still validated, just not by a lookup.
+INDEX_MAX_SUBSCRIPT = 24
+
+# The compound index is saved here, if PERSIST_COMPOUND_INDEX is set.
+# Building the index takes about as long as parsing the saved copy, so
+# this is off by default. Bump COMPOUND_INDEX_VERSION whenever the file
+# format changes.
+COMPOUND_INDEX_NAME = "compound_index.json"
+COMPOUND_INDEX_VERSION = 1
+PERSIST_COMPOUND_INDEX = False
+
+# Number of results per page of /search
+SEARCH_PAGE_SIZE = 20
+
 
 def init_csg_db() -> None:
-    """Initialize the CSG database, if it does not exist."""
-    if not path.isdir(".db"):
+    """
+    Initialize the CSG database, if it does not exist. Safe to run from
+    several processes at once: each step checks again once it holds the
+    write lock.
+    """
+    db_dir = get_db_dir()
+    if persistent() and not path.isdir(db_dir):
         print("[!] Creating database directory...")
-        mkdir(".db")
+        makedirs(db_dir, exist_ok=True)
         print(f"[{tick}] Done!")
 
-    conn = sqlite3.connect(".db/csg_db.db")
-    cur = conn.cursor()
+    db = csg_db()
 
-    try:
-        cur.execute("SELECT * FROM history;")
+    if db.fetchone("PRAGMA user_version;")[0] != CSG_SCHEMA_VERSION:
+        init_history_table(db)
+
+    if not table_exists(db, "user_preferences"):
+        init_user_preferences_table(db)
 
-    except sqlite3.OperationalError as ex:
-        if "no such table" in str(ex):
+    compact_db(db)
+    init_geometry_db()
+
+
+def init_history_table(db: Database) -> None:
+    """
+    Create the history table, or bring an existing one up to date.
+
+    Args:
+        db: the CSG database
+    """
+    with db.transaction():
+        # Another process may have done it in the meantime.
+        if db.fetchone("PRAGMA user_version;")[0] == CSG_SCHEMA_VERSION:
+            return
+
+        if not table_exists(db, "history"):
             print("[!] Initializing History table...")
             table_str = "history("                                      \
                         "    number INTEGER PRIMARY KEY AUTOINCREMENT," \
                         "    command VARCHAR(32),"                      \
-                        "    type VARCHAR(32)"                          \
+                        "    type VARCHAR(32),"                         \
+                        "    last_used REAL NOT NULL DEFAULT 0"         \
                         ")"
 
-            cur.execute(f"CREATE TABLE {table_str};")
-            print(f"[{tick}] Done!")
+            db.execute(f"CREATE TABLE {table_str};")
 
         else:
-            raise
+            print("[!] Migrating History table...")
+            columns = [rec[1] for rec in db.fetchall(
+                "PRAGMA table_info(history);")]
+
+            # Existing records count as used before any new ones.
+            if "last_used" not in columns:
+                db.execute("ALTER TABLE history "
+                           "ADD COLUMN last_used REAL NOT NULL DEFAULT 0;")
+
+            # Keep the first occurrence of each formula, so that the
+            # unique index below can be created.
+            db.execute("DELETE FROM history WHERE type='formula' "
+                       "AND number NOT IN ("
+                       "    SELECT min(number) FROM history"
+                       "    WHERE type='formula' GROUP BY command"
+                       ");")
+
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS history_formula "
+                   "ON history(command) WHERE type='formula';")
+        db.execute("CREATE INDEX IF NOT EXISTS history_last_used "
+                   "ON history(last_used);")
+
+        # For paging through the commands of one type
+        db.execute("CREATE INDEX IF NOT EXISTS history_type_number "
+                   "ON history(type, number);")
+
+        init_history_fts(db)
+
+        # PRAGMA does not accept parameters.
+        db.execute(f"PRAGMA user_version = {int(CSG_SCHEMA_VERSION)};")
+
+    print(f"[{tick}] Done!")
+
+
+def init_user_preferences_table(db: Database) -> None:
+    """
+    Create the user preferences table, with the default preferences.
+
+    Args:
+        db: the CSG database
+    """
+    user_preferences_table = """
+        user_preferences (
+            theme TEXT NOT NULL
+        )
+    """
 
-    conn.close()
+    with db.transaction():
+        if table_exists(db, "user_preferences"):
+            return
+
+        print("[!] Initializing User Preferences table...")
+        db.execute(f"CREATE TABLE {user_preferences_table};")
+        db.execute("INSERT INTO user_preferences VALUES('dark');")
+
+    print(f"[{tick}] Done!")
+
+
+def init_history_fts(db: Database) -> None:
+    """
+    Create the full-text index on history commands, which /history search
+    uses, and fill it in from the history table. Triggers keep it up to
+    date from then on. Without FTS5, or its trigram tokenizer, there is
+    no index, and searches scan the table instead.
+
+    Args:
+        db: the CSG database
+    """
+    if table_exists(db, "history_fts"):
+        return
+
+    try:
+        db.execute("CREATE VIRTUAL TABLE history_fts USING fts5("
+                   "    command, content='history', content_rowid='number',"
+                   "    tokenize='trigram'"
+                   ");")
+
+    except sqlite3.OperationalError:
+        print("[!] Full-text search is not available; /history search will "
+              "scan the history table.")
+        return
+
+    db.execute("CREATE TRIGGER history_fts_insert AFTER INSERT ON history "
+               "BEGIN"
+               "    INSERT INTO history_fts(rowid, command)"
+               "    VALUES(new.number, new.command);"
+               "END;")
+    db.execute("CREATE TRIGGER history_fts_delete AFTER DELETE ON history "
+               "BEGIN"
+               "    INSERT INTO history_fts(history_fts, rowid, command)"
+               "    VALUES('delete', old.number, old.command);"
+               "END;")
+    db.execute("CREATE TRIGGER history_fts_update "
+               "AFTER UPDATE OF command ON history "
+               "BEGIN"
+               "    INSERT INTO history_fts(history_fts, rowid, command)"
+               "    VALUES('delete', old.number, old.command);"
+               "    INSERT INTO history_fts(rowid, command)"
+               "    VALUES(new.number, new.command);"
+               "END;")
+    db.execute("INSERT INTO history_fts(history_fts) VALUES('rebuild');")
 
 
 def init_geometry_db() -> None:
-    """Initialize the geometry database."""
-    conn = sqlite3.connect('.db/geometry.db')
-    cur = conn.cursor()
-
-    # compounds without lp
-    cur.execute('''create table AB(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB values('nca1', '0', '0', '1')''')
-
-    cur.execute('''create table AB2(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB2 values('nca1', '0', '-1', '0')''')
-    cur.execute('''insert into AB2 values('nca2', '0', '1', '0')''')
-
-    cur.execute('''create table AB3(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB3 values('nca1', '-0.67', '-0.5', '0')''')
-    cur.execute('''insert into AB3 values('nca2', '0.67', '-0.5', '0')''')
-    cur.execute('''insert into AB3 values('nca3', '0', '0.67', '0')''')
-
-    cur.execute('''create table AB4(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB4 values('nca1', '-0.4', '-0.5', '-0.5')''')
-    cur.execute('''insert into AB4 values('nca2', '0.4', '-0.5', '-0.5')''')
-    cur.execute('''insert into AB4 values('nca3', '0', '0', '1')''')
-    cur.execute('''insert into AB4 values('nca4', '0', '1', '-0.5')''')
-
-    cur.execute('''create table AB5(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB5 values('nca1', '0', '3', '0')''')
-    cur.execute('''insert into AB5 values('nca2', '0', '0', '-2')''')
-    cur.execute('''insert into AB5 values('nca3', '2', '0', '1')''')
-    cur.execute('''insert into AB5 values('nca4', '-2', '0', '1')''')
-    cur.execute('''insert into AB5 values('nca5', '0', '-3', '0')''')
-
-    cur.execute('''create table AB6(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB6 values('nca1', '0', '3', '0')''')
-    cur.execute('''insert into AB6 values('nca2', '2', '0', '2')''')
-    cur.execute('''insert into AB6 values('nca3', '-2', '0', '2')''')
-    cur.execute('''insert into AB6 values('nca4', '2', '0', '-2')''')
-    cur.execute('''insert into AB6 values('nca5', '-2', '0', '-2')''')
-    cur.execute('''insert into AB6 values('nca6', '0', '-3', '0')''')
-
-    # compounds with lp
-    cur.execute('''create table AB2L(
-                        atom text,
-                        x text,
-                        y text,
-                        z text)
-                        ''')
-    cur.execute('''insert into AB2L values('nca1', '-0.8', '-0.1', '0')''')
-    cur.execute('''insert into AB2L values('nca2', '0.8', '-0.1', '0')''')
-
-    cur.execute('''create table AB3L(
-                        atom text,
-                        x text,
-                        y text,
-                        z text)
-                        ''')
-    cur.execute('''insert into AB3L values('nca1', '-0.4', '-0.5', '-0.5')''')
-    cur.execute('''insert into AB3L values('nca2', '0.4', '-0.5', '-0.5')''')
-    cur.execute('''insert into AB3L values('nca4', '0', '1', '-0.5')''')
-
-    cur.execute('''create table AB4L(
-                           atom text,
-                           x text,
-                           y text,
-                           z text)
-                           ''')
-    cur.execute('''insert into AB4L values('nca1', '0', '3', '0')''')
-    cur.execute('''insert into AB4L values('nca3', '2', '0', '-1')''')
-    cur.execute('''insert into AB4L values('nca4', '-2', '0', '-1')''')
-    cur.execute('''insert into AB4L values('nca5', '0', '-3', '0')''')
-
-    cur.execute('''create table AB5L(
-                               atom text,
-                               x text,
-                               y text,
-                               z text)
-                               ''')
-    cur.execute('''insert into AB5L values('nca1', '0', '3', '0.5')''')
-    cur.execute('''insert into AB5L values('nca2', '2', '0', '2.5')''')
-    cur.execute('''insert into AB5L values('nca3', '-2', '0', '2')''')
-    cur.execute('''insert into AB5L values('nca5', '-2', '0', '-2.5')''')
-    cur.execute('''insert into AB5L values('nca6', '0', '-3', '0.5')''')
-
-    cur.execute('''create table AB6L(
-                                        atom text,
-                                        x text,
-                                        y text,
-                                        z text)
-                                        ''')
-    cur.execute('''insert into AB6L values('nca1', '0', '3', '-1')''')
-    cur.execute('''insert into AB6L values('nca2', '2', '0', '2')''')
-    cur.execute('''insert into AB6L values('nca3', '-2', '-1', '2')''')
-    cur.execute('''insert into AB6L values('nca4', '2', '0', '-2')''')
-    cur.execute('''insert into AB6L values('nca5', '-2', '0', '-2')''')
-    cur.execute('''insert into AB6L values('nca6', '0', '-3', '0')''')
-
-    # compounds with 2 lp
-    cur.execute('''create table AB2L2(
-                                     atom text,
-                                     x text,
-                                     y text,
-                                     z text)
-                                     ''')
-    cur.execute('''insert into AB2L2 values('nca1', '-5', '-3', '-4')''')
-    cur.execute('''insert into AB2L2 values('nca2', '5', '-3', '-4')''')
-
-    cur.execute('''create table AB3L2(
-                                atom text,
-                                x text,
-                                y text,
-                                z text)
-                                ''')
-    cur.execute('''insert into AB3L2 values('nca2', '0', '0', '-2')''')
-    cur.execute('''insert into AB3L2 values('nca3', '2', '0', '1')''')
-    cur.execute('''insert into AB3L2 values('nca4', '-2', '0', '1')''')
-
-    cur.execute('''create table AB4L2(
-                                    atom text,
-                                    x text,
-                                    y text,
-                                    z text)
-                                    ''')
-    cur.execute('''insert into AB4L2 values('nca1', '0', '3', '0')''')
-    cur.execute('''insert into AB4L2 values('nca2', '2', '0', '2')''')
-    cur.execute('''insert into AB4L2 values('nca5', '-2', '0', '-2')''')
-    cur.execute('''insert into AB4L2 values('nca6', '0', '-3', '0')''')
-
-    conn.commit()
-    conn.close()
+    """
+    Initialize the geometry database, if it is not up to date. Coordinates
+    from older databases, including the old table-per-class layout, are
+    dropped; they are computed again by load_geometries().
+    """
+    db = geometry_db()
+
+    if db.fetchone("PRAGMA user_version;")[0] == GEOMETRY_SCHEMA_VERSION:
+        return
+
+    with db.transaction():
+        # Check again, now that we hold the write lock: another process
+        # may have initialized the database in the meantime.
+        if db.fetchone("PRAGMA user_version;")[0] == GEOMETRY_SCHEMA_VERSION:
+            return
+
+        old_tables = [rec[0] for rec in db.fetchall(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND name NOT LIKE 'sqlite_%';")]
+
+        if len(old_tables) > 0:
+            print("[!] Migrating geometry database...")
+
+        # Table names come from sqlite_master, not from the user.
+        for table in old_tables:
+            db.execute(f"DROP TABLE {table};")
+
+        db.execute("""
+            CREATE TABLE geometry (
+                class TEXT NOT NULL,
+                atom TEXT NOT NULL,
+                x REAL NOT NULL,
+                y REAL NOT NULL,
+                z REAL NOT NULL
+            );
+        """)
+        db.execute("CREATE UNIQUE INDEX geometry_class "
+                   "ON geometry(class, atom);")
+
+        # PRAGMA does not accept parameters.
+        db.execute(f"PRAGMA user_version = {int(GEOMETRY_SCHEMA_VERSION)};")
+
+    if len(old_tables) > 0:
+        print(f"[{tick}] Done!")
 
 
 def run_builtin_cmd(cmd_argv: list) -> None:
@@ -262,6 +367,15 @@ def run_builtin_cmd(cmd_argv: list) -> None:
     elif cmd_argv[0] == "/help":
         csg_help(args)
 
+    elif cmd_argv[0] == "/cache":
+        image_cache(args)
+
+    elif cmd_argv[0] == "/stats":
+        stats(args)
+
+    elif cmd_argv[0] == "/search":
+        search(args)
+
     elif cmd_argv[0] in ("/quit", "/exit"):
         print("Exiting...")
         exit()
@@ -278,46 +392,198 @@ def history(args: list) -> None:
     Args:
         args: list containing arguments
     """
-    conn = sqlite3.connect(".db/csg_db.db")
-    cur = conn.cursor()
+    if args[:1] == ["clear"]:
+        print("[-] Clearing history...")
+        clear_history()
+        print(f"[{tick}] Done!")
+        return
+
+    cmd_type = None
+    text = None
+    options = {"--limit": None, "--offset": "0", "--since": None}
+    words = []
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in options:
+            if i + 1 >= len(args):
+                print(f"Please specify a value for '{arg}'.")
+                return
 
-    hist_query = "SELECT * FROM history"
-    show_hist = True
+            options[arg] = args[i + 1]
+            i += 2
+            continue
 
-    if len(args) > 0:
-        if args[0] == "clear":
-            show_hist = False
-            print("[-] Clearing history...")
-            cur.execute("DELETE FROM history;")
-            cur.execute("DELETE FROM sqlite_sequence WHERE name='history';")
-            conn.commit()
-            print(f"[{tick}] Done!")
+        words.append(arg)
+        i += 1
 
-        elif args[0] == "select":
-            if len(args) != 2:
+    if len(words) > 0:
+        if words[0] == "select":
+            if len(words) != 2:
                 print("Please specify a command type to select.")
                 return
 
-            elif args[1] not in ("formula", "builtin"):
-                print(f"Invalid command type: '{args[1]}'")
+            elif words[1] not in ("formula", "builtin"):
+                print(f"Invalid command type: '{words[1]}'")
                 return
 
-            else:
-                hist_query += f" WHERE type='{args[1]}';"
+            cmd_type = words[1]
+
+        elif words[0] == "search":
+            if len(words) < 2:
+                print("Please specify the text to search for.")
+                return
+
+            text = " ".join(words[1:])
+
+        else:
+            print(f"Invalid subcommand for '/history': {words[0]}")
+            return
+
+    try:
+        limit, offset, since = (None if value is None else int(value)
+                                for value in options.values())
+
+    except ValueError:
+        print("'--limit', '--offset' and '--since' take a number.")
+        return
+
+    # The hint below pages with --since; an --offset on top of it would
+    # skip records on every page.
+    if offset and since is not None:
+        print("'--offset' and '--since' cannot be used together.")
+        return
+
+    # Rows are printed as they are read, rather than once the whole table
+    # has been loaded.
+    print("{:>6}  {:<30}  {:<12}".format("No.", "Command", "Type"))
+    n_records = 0
+    last = None
+    for record in iter_history(cmd_type, limit, offset, since, text):
+        print("{:>6}  {:<30}  {:<12}".format(str(record[0]), record[1],
+                                             record[2]))
+        n_records += 1
+        last = record[0]
+
+    if limit is not None and n_records == limit:
+        print(f"(Use '--since {last}' for more)")
+
+
+def image_cache(args: list) -> None:
+    """
+    The /cache command.
+
+    Args:
+        args: list containing arguments
+    """
+    cache = get_image_cache()
+
+    if len(args) == 0:
+        stats = cache.stats()
+        print("{:<12} : {}".format("Images", stats["images"]))
+        print("{:<12} : {:.1f} / {:.1f} MiB".format(
+            "Size", stats["bytes"] / 2**20, stats["max_bytes"] / 2**20))
+        print("{:<12} : {}".format("Hits", stats["hits"]))
+        print("{:<12} : {}".format("Misses", stats["misses"]))
+        print("{:<12} : {}".format("Evictions", stats["evictions"]))
+
+    elif args[0] == "warm":
+        print("[-] Rendering history into the image cache...")
+        n_rendered = warm_image_cache()
+        print(f"[{tick}] Done! ({n_rendered} image(s) rendered)")
+
+    elif args[0] == "clear":
+        print("[-] Clearing image cache...")
+        cache.clear()
+        print(f"[{tick}] Done!")
+
+    else:
+        print(f"Invalid subcommand for '/cache': {args[0]}")
+
+
+def stats(args: list) -> None:
+    """
+    The /stats command.
+
+    Args:
+        args: list containing arguments
+    """
+    if not tracing.enabled:
+        print(f"[!] Tracing is disabled. Set {tracing.TRACE_ENV}=1 to enable it.")
+        return
+
+    if len(args) == 0:
+        print("{:<20} {:>8} {:>10} {:>10} {:>10}".format(
+            "Stage", "Count", "Mean (ms)", "p50 (ms)", "p99 (ms)"))
+
+        for name, stage in sorted(tracing.get_stats().items()):
+            print("{:<20} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                name, stage["count"], stage["mean"], stage["p50"],
+                stage["p99"]))
+
+    elif args[0] == "dump":
+        if len(args) != 2:
+            print("Please specify a file to dump the trace to.")
+            return
+
+        n_spans = tracing.dump_trace(args[1])
+        print(f"[{tick}] Wrote {n_spans} span(s) to '{args[1]}'")
+
+    elif args[0] == "clear":
+        tracing.clear()
+        print(f"[{tick}] Done!")
+
+    else:
+        print(f"Invalid subcommand for '/stats': {args[0]}")
+
+
+def search(args: list) -> None:
+    """
+    The /search command.
+
+    Args:
+        args: list containing arguments
+    """
+    geometry = None
+    criteria = {"lp": None, "ca": None, "page": "1"}
+
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if sep == "":
+            geometry = arg
+
+        elif name in criteria and value != "":
+            criteria[name] = value
 
         else:
-            print(f"Invalid subcommand for '/history': {args[0]}")
+            print(f"Invalid argument for '/search': {arg}")
+            return
 
-    if show_hist:
-        cur.execute(hist_query)
+    try:
+        lone_pairs = None if criteria["lp"] is None else float(criteria["lp"])
+        page = int(criteria["page"])
+
+    except ValueError:
+        print("Lone pairs and page must be numbers.")
+        return
 
-        print("{:>6}  {:<30}  {:<12}".format("No.", "Command", "Type"))
-        for record in cur.fetchall():
-            aligned = "{:>6}  {:<30}  {:<12}".format(str(record[0]), record[1],
-                                                     record[2])
-            print(aligned)
+    results = search_compounds(geometry, lone_pairs, criteria["ca"])
+    n_pages = max(1, -(-len(results) // SEARCH_PAGE_SIZE))
+    if not 1 <= page <= n_pages:
+        print(f"Invalid page: {page} (there are {n_pages})")
+        return
+
+    start = (page - 1) * SEARCH_PAGE_SIZE
+    print("{:>6}  {:<12}  {:<8}  {:>10}  {:<10}".format(
+        "No.", "Formula", "Central", "Lone Pairs", "Geometry"))
+    for i, analysis in enumerate(results[start:start + SEARCH_PAGE_SIZE],
+                                 start + 1):
+        print("{:>6}  {:<12}  {:<8}  {:>10}  {:<10}".format(
+            i, analysis.formula, analysis.central_atom,
+            analysis.lone_pairs, analysis.geometry))
 
-    conn.close()
+    print(f"Page {page} of {n_pages} ({len(results)} compound(s))")
 
 
 def csg_help(args: list) -> None:
@@ -330,6 +596,9 @@ def csg_help(args: list) -> None:
     if len(args) == 0:
         print("Valid commands:")
         print("\t{:<20}{:<20}".format("/history, /hist", "Print command history"))
+        print("\t{:<20}{:<20}".format("/cache", "Manage the rendered image cache"))
+        print("\t{:<20}{:<20}".format("/stats", "Show per-stage timings"))
+        print("\t{:<20}{:<20}".format("/search", "Find compounds by geometry"))
         print("\t{:<20}{:<20}".format("/exit, /quit", "Exit CSG"))
         print("\t{:<20}{:<20}".format("/help", "Display this help message"))
 
@@ -344,17 +613,62 @@ def csg_help(args: list) -> None:
                   "\t/help /history")
 
         elif arg in ("/hist", "/history"):
-            print("Usage: /history [subcommand]\n"
+            print("Usage: /history [subcommand] [options]\n"
                   "       Show command history. If 'sub-command' is specified, execute it.\n")
 
             print("Subcommands:\n"
                   "       clear                 : Clear history\n"
-                  "       select [command type] : Display history of specified command type only\n")
+                  "       select [command type] : Display history of specified command type only\n"
+                  "       search [text]         : Display commands containing the text only\n")
+
+            print("Options:\n"
+                  "       --limit N             : Display at most N commands\n"
+                  "       --offset N            : Skip the first N commands (not with --since)\n"
+                  "       --since N             : Display commands after command number N only\n")
 
             print("Examples\n"
                   "\t/history\n"
                   "\t/history clear\n"
-                  "\t/history select builtin")
+                  "\t/history select builtin --limit 20\n"
+                  "\t/history --since 120 --limit 20\n"
+                  "\t/history search XeF")
+
+        elif arg == "/cache":
+            print("Usage: /cache [subcommand]\n"
+                  "       Show image cache statistics. If 'sub-command' is specified, execute it.\n")
+
+            print("Subcommands:\n"
+                  "       warm                  : Render every formula in history into the cache\n"
+                  "       clear                 : Clear the image cache\n")
+
+            print("Examples\n"
+                  "\t/cache\n"
+                  "\t/cache warm")
+
+        elif arg == "/stats":
+            print("Usage: /stats [subcommand]\n"
+                  "       Show the count, mean, median and 99th percentile time of each\n"
+                  "       stage, if CSG was started with CSG_TRACE=1. If 'sub-command'\n"
+                  "       is specified, execute it.\n")
+
+            print("Subcommands:\n"
+                  "       dump [file]           : Write the spans to a Chrome trace file\n"
+                  "       clear                 : Forget all recorded spans\n")
+
+            print("Examples\n"
+                  "\t/stats\n"
+                  "\t/stats dump trace.json")
+
+        elif arg == "/search":
+            print("Usage: /search [geometry] [lp=N] [ca=element] [page=N]\n"
+                  "       List the valid compounds with the given geometry, number of\n"
+                  "       lone pairs and central atom, a page at a time. Criteria that\n"
+                  "       are left out match anything.\n")
+
+            print("Examples\n"
+                  "\t/search AB3L\n"
+                  "\t/search AB2L2 ca=O\n"
+                  "\t/search lp=2 page=3")
 
         elif arg in ("/exit", "/quit"):
             print("Usage: /exit\n"
@@ -366,6 +680,34 @@ def csg_help(args: list) -> None:
             return
 
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+@traced("parse")
+def parse_formula(chem_form: str) -> tuple:
+    """
+    Parse a chemical formula in a single pass. Returns a tuple of
+    (element, subscript) pairs, or None if the formula is malformed.
+    Results are memoized, so the returned value is immutable.
+
+    Args:
+        chem_form: chemical formula
+
+    Example:
+        parse_formula("H2O") returns (("H", 2), ("O", 1))
+    """
+    if chem_form is None:
+        return
+
+    re_match = formula_re.fullmatch(chem_form.strip())
+    if re_match is None:
+        return
+
+    el1, sub1, el2, sub2 = re_match.groups()
+
+    # A missing subscript means a single atom, as in H2O.
+    return ((el1, int(sub1) if sub1 else 1),
+            (el2, int(sub2) if sub2 else 1))
+
+
 def get_elements(chem_form: str) -> dict:
     """
     Returns a dictionary of elements, with the corresponding number
@@ -377,123 +719,315 @@ def get_elements(chem_form: str) -> dict:
     Example:
         get_elements("H2O") returns {"H": 2, "O": 1}
     """
-
-    if chem_form is None:
+    pairs = parse_formula(chem_form)
+    if pairs is None:
         return
 
-    chem_form = chem_form.strip()
+    # A fresh dict is returned each time, so that callers cannot modify
+    # the cached parse result. If an element is repeated, the last
+    # subscript wins.
+    return dict(pairs)
+
+
+def get_elements_many(chem_forms: Iterable[str]) -> list:
+    """
+    Bulk version of get_elements(). Returns a list with one entry per
+    formula, in the same order.
+
+    Args:
+        chem_forms: iterable of chemical formulae
+    """
+    parse = parse_formula
+    return [None if pairs is None else dict(pairs)
+            for pairs in map(parse, chem_forms)]
+
+
+class CompoundIndex:
+    """
+    Set of every valid two-element compound, with up to `max_subscript`
+    atoms of each element. Entries have the same shape as the values
+    returned by parse_formula(), so that a lookup is a single hash.
+    """
+    def __init__(self, compounds: frozenset, max_subscript: int,
+                 fingerprint: str):
+        """
+        Constructor.
+
+        Args:
+            compounds: frozenset of ((el1, sub1), (el2, sub2)) tuples
+            max_subscript: largest subscript covered by the index
+            fingerprint: compound_index_fingerprint() of the source data
+        """
+        self.compounds = compounds
+        self.max_subscript = max_subscript
+        self.fingerprint = fingerprint
+
+    def __contains__(self, pairs: tuple) -> bool:
+        return pairs in self.compounds
+
+    def __len__(self) -> int:
+        return len(self.compounds)
+
+
+def compound_index_fingerprint(max_subscript: int) -> str:
+    """
+    Return a digest of everything the compound index is derived from, ie.
+    `oxidn_states`, the elements in `pt` and the maximum subscript. A saved
+    index whose fingerprint differs is stale.
+
+    Args:
+        max_subscript: largest subscript covered by the index
+    """
+    source = (
+        COMPOUND_INDEX_VERSION,
+        max_subscript,
+        sorted((el, sorted(states)) for el, states in oxidn_states.items()),
+        [(n_grp, pt.get_group_elements(n_grp))
+         for n_grp in pt.get_group_numbers()]
+    )
+
+    return sha1(repr(source).encode()).hexdigest()
+
+
+def build_compound_index(max_subscript: int = INDEX_MAX_SUBSCRIPT) \
+        -> CompoundIndex:
+    """
+    Build the index of every valid two-element compound, with up to
+    `max_subscript` atoms of each element.
+
+    Args:
+        max_subscript: largest subscript covered by the index
+    """
+    # Elements that are not in the periodic table (as defined in
+    # chemistry.py) are never valid, even if they have oxidation states.
+    elements = [el for el in oxidn_states if pt.check(el)]
+    compounds = set()
+    subs = range(1, max_subscript + 1)
+
+    for el1 in elements:
+        for el2 in elements:
+            if el1 == el2:
+                continue
+
+            for ox1 in oxidn_states[el1]:
+                for ox2 in oxidn_states[el2]:
+                    # Two neutral elements balance with any subscripts.
+                    if ox1 == 0 and ox2 == 0:
+                        compounds.update(((el1, i), (el2, j))
+                                         for i in subs for j in subs)
+
+                    # sub1 * ox1 + sub2 * ox2 == 0 has solutions only for
+                    # opposite charges, and they are all multiples of the
+                    # smallest one.
+                    elif ox1 * ox2 < 0:
+                        g = gcd(ox1, ox2)
+                        sub1, sub2 = abs(ox2) // g, abs(ox1) // g
+                        k = 1
+                        while max(sub1, sub2) * k <= max_subscript:
+                            compounds.add(((el1, sub1 * k), (el2, sub2 * k)))
+                            k += 1
+
+    return CompoundIndex(frozenset(compounds), max_subscript,
+                         compound_index_fingerprint(max_subscript))
+
+
+def save_compound_index(index: CompoundIndex,
+                        path_name: str = None) -> None:
+    """
+    Save the compound index to disk.
+
+    Args:
+        index: index returned by build_compound_index()
+        path_name: path of the index file; defaults to COMPOUND_INDEX_NAME
+                   in the database directory
+    """
+    if path_name is None:
+        path_name = db_file(COMPOUND_INDEX_NAME)
+
+    data = {
+        "fingerprint": index.fingerprint,
+        "max_subscript": index.max_subscript,
+        "compounds": [[el1, sub1, el2, sub2] for (el1, sub1), (el2, sub2)
+                      in sorted(index.compounds)]
+    }
+
+    # Write to a temporary file first, so that a concurrent reader never
+    # sees a half-written index.
+    tmp_path = f"{path_name}.tmp{getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+    replace(tmp_path, path_name)
+
 
-    # Formula should be of the form:
-    #     <Element 1>[Subscript]<Element2>[Subscript]
-    re_match = re.match("^([A-Z][a-z]?\d*){2}", chem_form)
-    if re_match is None or re_match.group() != chem_form:
+def load_compound_index(path_name: str = None,
+                        max_subscript: int = INDEX_MAX_SUBSCRIPT) \
+        -> CompoundIndex:
+    """
+    Load the compound index from disk. Returns None if the file does not
+    exist, cannot be read, or is stale.
+
+    Args:
+        path_name: path of the index file; defaults to COMPOUND_INDEX_NAME
+                   in the database directory
+        max_subscript: largest subscript the index should cover
+    """
+    if path_name is None:
+        path_name = db_file(COMPOUND_INDEX_NAME)
+
+    try:
+        with open(path_name) as f:
+            data = json.load(f)
+
+    except (OSError, ValueError):
         return
 
-    # This stores the final elements dictionary.
-    element_dict = {}
+    fingerprint = compound_index_fingerprint(max_subscript)
+    if data.get("fingerprint") != fingerprint:
+        return
+
+    compounds = frozenset(((el1, sub1), (el2, sub2))
+                          for el1, sub1, el2, sub2 in data["compounds"])
 
-    # The `current` element
-    cur_el = ""
+    return CompoundIndex(compounds, max_subscript, fingerprint)
 
-    # The string to hold number of atoms of the `current` element.
-    # This value is a string, because we need to be able to concatenate
-    # each digit to the end of this variable.
-    cur_el_num_str = "1"
 
-    # This flag is set when a digit is found in the formula.
-    found_digit = False
+@lru_cache(maxsize=1)
+def get_compound_index() -> CompoundIndex:
+    """
+    Return the shared compound index, building it on first use. If
+    PERSIST_COMPOUND_INDEX is set and the database directory exists, the
+    index is loaded from (or saved to) COMPOUND_INDEX_NAME in it. A saved
+    index is rebuilt when `oxidn_states` or the periodic table differ from
+    the ones it was built from, since its fingerprint no longer matches;
+    the in-memory index is dropped whenever `oxidn_states` changes.
+    """
+    persist = PERSIST_COMPOUND_INDEX and persistent() \
+        and path.isdir(get_db_dir())
 
-    for ch in chem_form:
-        if ch.isupper():
-            # If `cur_el` is not empty, it means that
-            # before *this* element, there was another element
-            # in the formula. If `found_digit` is also not set,
-            # it implies that the previous element did not have
-            # any number to go along with it.
-            if cur_el != "" and not found_digit:
-                element_dict[cur_el] = 1
+    if persist:
+        index = load_compound_index()
+        if index is not None:
+            return index
 
-            cur_el = ch
+    index = build_compound_index()
 
-            # Unset `found_digit` when uppercase letter is found
-            found_digit = False
+    if persist:
+        try:
+            save_compound_index(index)
 
-        elif ch.islower():
-            cur_el += ch
+        except OSError:
+            # The index is only a cache; carry on with the in-memory copy.
+            pass
 
-            # Unset `found_digit` when lowercase letter is found
-            found_digit = False
+    return index
 
-        elif ch.isdigit():
-            if not found_digit:
-                found_digit = True
-                cur_el_num_str = ch
-                element_dict[cur_el] = int(cur_el_num_str)
 
-            else:
-                cur_el_num_str += ch
-                element_dict[cur_el] = int(cur_el_num_str)
+def invalidate_compound_index() -> None:
+    """
+    Drop the shared compound index, and everything derived from it. This
+    is called by `oxidn_states` whenever it changes; the periodic table
+    cannot change at runtime.
+    """
+    get_compound_index.cache_clear()
+    get_geometry_index.cache_clear()
+    analyze.cache_clear()
 
-    # If `found_digit` is False after the loop, it means that there was
-    # no number specified for the last element. For example, this
-    # would be true in the case of H2O
-    if not found_digit:
-        element_dict[cur_el] = 1
 
-    return element_dict
+def charge_balances(pairs: tuple) -> bool:
+    """
+    Check if the net charge of a two-element compound can be zero, by
+    trying every combination of the oxidation states of its elements.
 
+    Args:
+        pairs: ((el1, sub1), (el2, sub2)) as returned by parse_formula()
+    """
+    (el1, sub1), (el2, sub2) = pairs
+    if el1 == el2 or el1 not in oxidn_states or el2 not in oxidn_states:
+        return False
 
-# NO IS A BUG
-def validate(chem_form: str) -> bool:
+    if not (pt.check(el1) and pt.check(el2)):
+        return False
+
+    for ox1 in oxidn_states[el1]:
+        for ox2 in oxidn_states[el2]:
+            if sub1 * ox1 + sub2 * ox2 == 0:
+                return True
+
+    return False
+
+
+def in_compound_index(pairs: tuple) -> bool:
     """
-    Checks if
-        (a) Input chemical has only 2 elements
-        (b) They exist, i.e, the constitute a key in the
-            `oxidn_states` dict (which, btw, still requires a hell
-            lotta additions)
-        (c) Their net charge is zero (this condition checking is
-            achieved by taking into account the oxidn states of each
-            element)
+    Check if a two-element compound is valid, by looking it up in the
+    compound index. For all but unusually large subscripts, this is a
+    single lookup.
 
     Args:
-        chem_form: chemical formula
+        pairs: ((el1, sub1), (el2, sub2)) as returned by parse_formula()
     """
+    index = get_compound_index()
+    if pairs in index:
+        return True
 
-    element_dict = get_elements(chem_form)
-    if element_dict is None or len(element_dict) != 2:
+    # The index is exhaustive up to its maximum subscript.
+    (el1, sub1), (el2, sub2) = pairs
+    if sub1 <= index.max_subscript and sub2 <= index.max_subscript:
         return False
 
-    first_element_charges, second_element_charges, element_list = [], [], []
-    net_charge_zero = False
+    return charge_balances(pairs)
 
-    # Populating a list of input elements if they exist
-    # No validation of transition elements
-    for el in element_dict:
-        if not pt.check(el):
+
+@traced("validate")
+def validate(chem_form: str) -> bool:
+    """
+    Checks if either
+        (a) Input chemical has only 2 elements, which exist, i.e, the
+            constitute a key in the `oxidn_states` dict (which, btw,
+            still requires a hell lotta additions), and their net charge
+            is zero (this condition checking is achieved by taking into
+            account the oxidn states of each element)
+        (b) Failing that, it is a condensed formula with several
+            central atoms, such as C2H4, CH3CH2OH or H2SO4, that
+            get_molecule() can make sense of
+
+    A two-element compound with a single central atom, such as H2O, is
+    fully described by (a), so it is never checked against (b).
+
+    Args:
+        chem_form: chemical formula
+    """
+    pairs = parse_formula(chem_form)
+    if pairs is not None:
+        if in_compound_index(pairs):
+            return True
+
+        (el1, sub1), (el2, sub2) = pairs
+        if min(sub1, sub2) == 1:
             return False
-        else:
-            element_list.append(el)
 
-    # Creating lists of total charge on individual elements in order to
-    # be able to equate their sum to zero.
-    for variable_oxidn_state in oxidn_states[element_list[0]]:
-        first_element_charges.append(element_dict[element_list[0]]
-                                     * variable_oxidn_state)
+    return get_molecule(chem_form) is not None
+
 
-    for variable_oxidn_state in oxidn_states[element_list[1]]:
-        second_element_charges.append(element_dict[element_list[1]]
-                                      * variable_oxidn_state)
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+@traced("parse_molecule")
+def get_molecule(chem_form: str) -> Molecule:
+    """
+    Parse a condensed formula with any number of elements and central
+    atoms into a Molecule. Returns None if the formula is malformed, or
+    not chemically sensible. Results are memoized, so the Molecule is
+    shared, and must not be modified.
+
+    Args:
+        chem_form: condensed formula, eg. "CH3CH2OH"
+    """
+    from molecule import parse_molecule, validate_molecule
 
-    # Summation to find the net charge. Validity of input auto-falsifies
-    # if it fails to show zero net charge.
-    for i in range(len(first_element_charges)):
-        for j in range(len(second_element_charges)):
-            net_charge = first_element_charges[i] + second_element_charges[j]
-            if net_charge == 0:
-                net_charge_zero = True
-                break
+    mol = parse_molecule(chem_form)
+    if not validate_molecule(mol):
+        return
 
-    return net_charge_zero
+    return mol
 
 
 def get_compound_stats(element_dict: dict) -> Stats:
@@ -543,15 +1077,17 @@ def get_compound_stats(element_dict: dict) -> Stats:
     return stats
 
 
-def get_lp(element_dict: dict) -> float:
+@traced("get_lp")
+def get_lp(element_dict: dict, stats: Stats = None) -> float:
     """
     Return the number of lone pairs in a given compound.
 
     Args:
         element_dict: dict returned by get_elements()
+        stats: get_compound_stats(element_dict), if already computed
     """
-
-    stats = get_compound_stats(element_dict)
+    if stats is None:
+        stats = get_compound_stats(element_dict)
 
     # 'Lone pairs' is initialized to the number of valence electrons
     # of the central atom.
@@ -601,158 +1137,781 @@ def classify_geometry(element_dict: dict, lp: float) -> str:
     return geometry_str
 
 
+def get_bond_order(nc_atom: str) -> int:
+    """
+    Return the order of the bonds between the central atom and a given
+    non-central atom.
+
+    Args:
+        nc_atom: the non-central atom
+    """
+    nval_e = pt.get_nvalence_electrons(nc_atom)
+    if nval_e == 1:
+        return 1
+
+    return 8 - nval_e
+
+
+class Analysis(NamedTuple):
+    """
+    Everything known about a valid compound, worked out once by analyze()
+    and then passed around, to the REPL printout, the GUI and rendering.
+    Immutable, so that it can be cached and shared.
+    """
+    # Formula, as entered
+    formula: str
+
+    # ((element, subscript), ...), in formula order
+    elements: tuple
+
+    central_atom: str
+    central_atom_sub: int
+    nc_atom: str
+    nc_atom_sub: int
+    lone_pairs: float
+    geometry: str
+    bond_order: int
+
+    # Atoms and bonds of a compound with several central atoms, whose
+    # central atom, lone pairs, geometry and bond order are those of its
+    # main central atom (see analyze_molecule()); None for compounds
+    # with a single central atom
+    molecule: Molecule = None
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+@traced("analyze")
+def analyze(chem_form: str) -> Analysis:
+    """
+    Validate a compound and work out its central atom, lone pairs,
+    geometry and bond order, in a single pass. Returns an Analysis, or None
+    if the formula is not valid. Results are memoized.
+
+    Compounds with several central atoms, such as C2H4 or H2SO4, are
+    analyzed as a Molecule, with analyze_molecule(). So are two-element
+    compounds such as N2H4 that the compound index accepts, but that have
+    more than one central atom, as long as they make sense as a Molecule.
+
+    Args:
+        chem_form: chemical formula
+    """
+    if not validate(chem_form):
+        return
+
+    pairs = parse_formula(chem_form)
+    if pairs is None or min(pairs[0][1], pairs[1][1]) > 1:
+        mol = get_molecule(chem_form)
+        if mol is not None:
+            return analyze_molecule(chem_form, mol)
+
+    element_dict = dict(pairs)
+    stats = get_compound_stats(element_dict)
+    lp = get_lp(element_dict, stats)
+
+    return Analysis(
+        formula=chem_form,
+        elements=pairs,
+        central_atom=stats.c_atom,
+        central_atom_sub=stats.c_atom_sub,
+        nc_atom=stats.nc_atom,
+        nc_atom_sub=stats.nc_atom_sub,
+        lone_pairs=lp,
+        geometry=classify_geometry(element_dict, lp),
+        bond_order=get_bond_order(stats.nc_atom)
+    )
+
+
+def analyze_molecule(chem_form: str, mol: Molecule) -> Analysis:
+    """
+    Work out the Analysis of a compound with several central atoms. Its
+    central atom is the main central atom of the molecule (see
+    main_centre()), with the lone pairs, geometry and highest bond order
+    of that atom. The non-central atom is the element it is bonded to
+    most.
+
+    Args:
+        chem_form: chemical formula
+        mol: Molecule returned by get_molecule()
+    """
+    from molecule import main_centre
+
+    degrees = mol.degrees()
+    centre = main_centre(mol, degrees)
+    atoms, edges = mol.atoms, mol.edges
+
+    # Elements bonded to the central atom, and the orders of its bonds.
+    # Only one atom is needed, so this is cheaper than mol.adjacency().
+    bonded = []
+    orders = []
+    for k, order in enumerate(mol.orders):
+        i, j = edges[2 * k], edges[2 * k + 1]
+        if centre == i or centre == j:
+            bonded.append(atoms[j if centre == i else i])
+            orders.append(order)
+
+    nc_atom = pt.get_symbol(max(bonded, key=bonded.count))
+    central_atom = pt.get_symbol(atoms[centre])
+    composition = mol.composition()
+    lp = (pt.get_nvalence_electrons(central_atom) - sum(orders)) // 2
+
+    return Analysis(
+        formula=chem_form,
+        elements=tuple(composition.items()),
+        central_atom=central_atom,
+        central_atom_sub=composition[central_atom],
+        nc_atom=nc_atom,
+        nc_atom_sub=composition[nc_atom],
+        lone_pairs=float(lp),
+        geometry=geometry_class(degrees[centre], lp),
+        bond_order=max(orders),
+        molecule=mol
+    )
+
+
+def format_formula(pairs: tuple) -> str:
+    """
+    Return the formula of a two-element compound, the inverse of
+    parse_formula().
+
+    Args:
+        pairs: ((el1, sub1), (el2, sub2)) as returned by parse_formula()
+
+    Example:
+        format_formula((("H", 2), ("O", 1))) returns "H2O"
+    """
+    return "".join(el if sub == 1 else f"{el}{sub}" for el, sub in pairs)
+
+
+class GeometryIndex:
+    """
+    Reverse index from geometry, number of lone pairs and central atom to
+    the Analysis of every compound in the compound index. Results come out
+    ordered by central atom, then non-central atom, then subscripts.
+    """
+    def __init__(self, analyses: Iterable[Analysis]):
+        """
+        Constructor.
+
+        Args:
+            analyses: Analysis of each compound to index
+        """
+        def order(analysis: Analysis) -> tuple:
+            return (pt.get_atomic_number(analysis.central_atom),
+                    pt.get_atomic_number(analysis.nc_atom),
+                    analysis.central_atom_sub, analysis.nc_atom_sub,
+                    analysis.formula)
+
+        self.analyses = tuple(sorted(analyses, key=order))
+
+        # {(geometry, lone pairs, central atom): [position in analyses]},
+        # and, for partial queries, each field to the keys that have it
+        self.__by_key = {}
+        self.__keys = ({}, {}, {})
+
+        for i, analysis in enumerate(self.analyses):
+            key = (analysis.geometry, analysis.lone_pairs,
+                   analysis.central_atom)
+            positions = self.__by_key.get(key)
+            if positions is None:
+                positions = self.__by_key[key] = []
+                for field, keys in zip(key, self.__keys):
+                    keys.setdefault(field, []).append(key)
+
+            positions.append(i)
+
+    def __len__(self) -> int:
+        return len(self.analyses)
+
+    def search(self, geometry: str = None, lone_pairs: float = None,
+               central_atom: str = None) -> list:
+        """
+        Return the Analysis of every compound that matches all the given
+        criteria. Criteria that are None match anything.
+
+        Args:
+            geometry: geometry class, eg. "AB3L"
+            lone_pairs: number of lone pairs on the central atom
+            central_atom: the central atom, eg. "N"
+        """
+        query = (geometry, lone_pairs, central_atom)
+        if None not in query:
+            positions = self.__by_key.get(query, [])
+
+        else:
+            keys = None
+            for field, by_field in zip(query, self.__keys):
+                if field is not None:
+                    matches = set(by_field.get(field, ()))
+                    keys = matches if keys is None else keys & matches
+
+            if keys is None:
+                return list(self.analyses)
+
+            # Each key's positions are already in order, so the merge is
+            # cheap.
+            positions = sorted(i for key in keys for i in self.__by_key[key])
+
+        analyses = self.analyses
+        return [analyses[i] for i in positions]
+
+
+@lru_cache(maxsize=1)
+def get_geometry_index() -> GeometryIndex:
+    """
+    Return the shared geometry index, building it from the compound index
+    on first use.
+    """
+    analyses = (analyze(format_formula(pairs))
+                for pairs in get_compound_index().compounds)
+
+    return GeometryIndex(analysis for analysis in analyses
+                         if analysis is not None)
+
+
+def search_compounds(geometry: str = None, lone_pairs: float = None,
+                     central_atom: str = None) -> list:
+    """
+    Return the Analysis of every valid compound with the given geometry,
+    number of lone pairs and central atom. Criteria that are None match
+    anything. Slice the result to page through it.
+
+    Args:
+        geometry: geometry class, eg. "AB3L"
+        lone_pairs: number of lone pairs on the central atom
+        central_atom: the central atom, eg. "N"
+
+    Example:
+        search_compounds("AB3L", central_atom="N")[:2] is the Analysis of
+        H3N and NH3
+    """
+    if geometry is not None:
+        geometry = geometry.upper()
+
+    return get_geometry_index().search(geometry, lone_pairs, central_atom)
+
+
+class GeometryStore:
+    """
+    In-memory copy of the geometry database. The coordinates of each
+    geometry are kept in one contiguous, read-only (N, 3) float array.
+    """
+    def __init__(self, blocks: dict):
+        """
+        Constructor.
+
+        Args:
+            blocks: dictionary of the form {"geometry": (N, 3) array}
+        """
+        self.__blocks = blocks
+
+    def __contains__(self, geometry: str) -> bool:
+        return geometry in self.__blocks
+
+    def __getitem__(self, geometry: str):
+        return self.__blocks[geometry]
+
+    def add(self, geometry: str, block) -> None:
+        """
+        Add the coordinates of a geometry to the store.
+
+        Args:
+            geometry: geometry returned by classify_geometry()
+            block: (N, 3) array of coordinates
+        """
+        block.flags.writeable = False
+        self.__blocks[geometry] = block
+
+    def geometries(self) -> list:
+        """Return the names of all geometries in the store."""
+        return list(self.__blocks.keys())
+
+
+def solve_geometries(geometries: list) -> dict:
+    """
+    Compute the coordinates of the given geometries, in one batch, and
+    save them to the geometry database. Returns {"geometry": (N, 3) array}.
+    Raises ValueError if one of them is not a geometry class.
+
+    Args:
+        geometries: geometries returned by classify_geometry()
+    """
+    from vsepr import parse_geometry_class, solve
+
+    classes = {geometry: parse_geometry_class(geometry)
+               for geometry in geometries}
+    solved = solve(list(classes.values()))
+
+    blocks = {geometry: solved[cls] for geometry, cls in classes.items()}
+    add_geometry_rows([(geometry, f"nca{i + 1}", *map(float, coords))
+                       for geometry, block in blocks.items()
+                       for i, coords in enumerate(block)])
+
+    return blocks
+
+
+def load_geometries() -> GeometryStore:
+    """
+    Read every geometry from the geometry database into a GeometryStore,
+    initializing the database first if necessary. The standard geometries
+    are computed on first use.
+    """
+    import numpy as np
+    from vsepr import STANDARD_CLASSES
+
+    init_geometry_db()
+
+    rows = {}
+    for record in get_geometry_rows():
+        rows.setdefault(record[0], []).append(record[1:])
+
+    store = GeometryStore({})
+    for geometry, coords in rows.items():
+        store.add(geometry, np.array(coords, dtype=float).reshape(-1, 3))
+
+    missing = [geometry_class(*cls) for cls in STANDARD_CLASSES
+               if geometry_class(*cls) not in store]
+    if len(missing) > 0:
+        for geometry, block in solve_geometries(missing).items():
+            store.add(geometry, block)
+
+    return store
+
+
+@lru_cache(maxsize=1)
+def get_geometry_store() -> GeometryStore:
+    """Return the shared geometry store, loading it on first use."""
+    return load_geometries()
+
+
+def reload_geometries() -> None:
+    """
+    Drop the shared geometry store, so that it is read from the geometry
+    database again on next use. Call this after changing the database.
+    """
+    get_geometry_store.cache_clear()
+
+
+@traced("fetch_coordinates")
 def fetch_coordinates(geometry: str) -> tuple:
     """
-    Fetch coordinates for a given geometry.
+    Fetch coordinates for a given geometry, as read-only x, y and z arrays.
+    Geometries that are not in the geometry database yet are computed and
+    added to it. Raises ValueError if `geometry` is not a geometry class.
 
     Args:
         geometry: geometry returned by classify_geometry()
     """
-    x, y, z = [], [], []
+    block = get_geometry_block(geometry)
 
-    conn = sqlite3.connect('.db/geometry.db')
-    cur = conn.cursor()
-    try:
-        cur.execute(f'''select * from {geometry}''')
+    return block[:, 0], block[:, 1], block[:, 2]
+
+
+def get_geometry_block(geometry: str):
+    """
+    Return the coordinates of a given geometry as a read-only (N, 3)
+    array, computing them if they are not in the geometry database yet.
+    Raises ValueError if `geometry` is not a geometry class.
+
+    Args:
+        geometry: geometry returned by classify_geometry()
+    """
+    store = get_geometry_store()
+    if geometry not in store:
+        store.add(geometry, solve_geometries([geometry])[geometry])
+
+    return store[geometry]
+
+
+# Line style of each bond order, in each theme. Bonds of a higher order
+# are drawn as triple bonds.
+BOND_STYLES = {
+    1: {'dark': 'royalblue', 'light': 'g', 'lw': 1, 'bo': 'single'},
+    2: {'dark': 'g', 'light': 'navy', 'lw': 2.5, 'bo': 'double'},
+    3: {'dark': 'b', 'light': 'red', 'lw': 3.5, 'bo': 'triple'}
+}
+
+
+class RenderSession:
+    """
+    Keeps a figure, its 3D axes and all of its artists alive across
+    renders. Rendering another compound only updates the marker and bond
+    data, the colors and the legends, instead of rebuilding the scene.
+    """
+    def __init__(self, fig=None):
+        """
+        Constructor.
+
+        Args:
+            fig: matplotlib figure to draw on. May also be set later, with
+                 reset().
+        """
+        self.fig = None
+        self.reset(fig)
+
+    def reset(self, fig) -> None:
+        """
+        Start over on a new figure. The scene is built on the next draw().
+
+        Args:
+            fig: matplotlib figure to draw on
+        """
+        self.fig = fig
+        self.ax = None
+        self.markers = []
+        self.bonds = []
+        self.element_legend = None
+        self.bond_legend = None
+
+    def draw(self, analysis: Analysis, theme: str) -> None:
+        """
+        Draw the 3D structure of a given compound.
+
+        Args:
+            analysis: Analysis returned by analyze()
+            theme: "dark" or "light"
+        """
+        if analysis.molecule is None:
+            x, y, z = fetch_coordinates(analysis.geometry)
+
+            # (element, x, y, z) of each set of atoms drawn alike, and
+            # ((x1, x2), (y1, y2), (z1, z2), order) of each bond
+            atoms = [(analysis.nc_atom, x, y, z),
+                     (analysis.central_atom, [0], [0], [0])]
+            bonds = [((0, x[i]), (0, y[i]), (0, z[i]), analysis.bond_order)
+                     for i in range(len(x))]
+
+        else:
+            atoms, bonds = molecule_scene(analysis.molecule)
 
-    except sqlite3.OperationalError as ex:
-        if "no such table" in str(ex):
-            init_geometry_db()
-            cur.execute(f'''select * from {geometry}''')
+        # Storing the hexadecimal color values as per user preference.
+        # To be used for background color while rendering in matplotlib
+        if theme == 'dark':
+            facecolor = '#171717'
         else:
-            raise
+            facecolor = '#E9E9E9'
+
+        if self.ax is None:
+            self.ax = self.fig.add_subplot(111, projection='3d')
+            self.ax.set_axis_off()
+
+        ax = self.ax
+        ax.set_facecolor(facecolor)
+        self.fig.patch.set_facecolor(facecolor)
+
+        # Marker and bond artists are kept around, and hidden when a
+        # compound has fewer elements or bonds than the previous one.
+        while len(self.markers) < len(atoms):
+            self.markers += ax.plot([], [], [], 'o')
+
+        for i, marker in enumerate(self.markers):
+            if i < len(atoms):
+                element, x, y, z = atoms[i]
+                marker.set_data_3d(x, y, z)
+                marker.set_color(pt.get_markercolor(element))
+                marker.set_markersize(pt.get_markersize(element))
+                marker.set_visible(True)
+
+            else:
+                marker.set_visible(False)
 
-    for record in cur.fetchall():
-        x.append(float(record[1]))
-        y.append(float(record[2]))
-        z.append(float(record[3]))
+        # Plotting Bonds
+        while len(self.bonds) < len(bonds):
+            self.bonds += ax.plot([0, 0], [0, 0], [0, 0], '-', alpha=0.75)
 
-    return x, y, z
+        for i, bond in enumerate(self.bonds):
+            if i < len(bonds):
+                x, y, z, order = bonds[i]
+                style = BOND_STYLES[min(order, 3)]
+                bond.set_data_3d(x, y, z)
+                bond.set_linewidth(style['lw'])
+                bond.set_color(style[theme])
+                bond.set_visible(True)
 
+            else:
+                bond.set_visible(False)
+
+        # Fit the view to the new compound. A molecule is scaled alike
+        # along every axis, so that rings and chains keep their shape.
+        limits = [[c for atom in atoms for c in atom[axis]]
+                  for axis in (1, 2, 3)]
+        if analysis.molecule is not None:
+            half = max(max(c) - min(c) for c in limits) / 2
+            limits = [[(max(c) + min(c)) / 2 - half,
+                       (max(c) + min(c)) / 2 + half] for c in limits]
+
+        ax.auto_scale_xyz(*limits, had_data=False)
+
+        # Updating Legends
+        elements = [atom[0] for atom in atoms]
+        orders = sorted({min(bond[3], 3) for bond in bonds})
+        if self.element_legend is None \
+                or len(legend_handles(self.element_legend)) != len(elements) \
+                or len(legend_handles(self.bond_legend)) != len(orders):
+            self.__build_legends(len(elements), len(orders))
+
+        element_handles = legend_handles(self.element_legend)
+        element_texts = self.element_legend.get_texts()
+        for handle, text, ele in zip(element_handles, element_texts,
+                                     elements):
+            handle.set_markerfacecolor(pt.get_markercolor(ele))
+            text.set_text(ele)
+
+        bond_handles = legend_handles(self.bond_legend)
+        bond_texts = self.bond_legend.get_texts()
+        for handle, text, order in zip(bond_handles, bond_texts, orders):
+            style = BOND_STYLES[order]
+            handle.set_color(style[theme])
+            handle.set_markerfacecolor(style[theme])
+            handle.set_linewidth(style['lw'])
+            text.set_text(style['bo'])
+
+    def __build_legends(self, n_elements: int, n_orders: int) -> None:
+        from matplotlib.lines import Line2D
+
+        ax = self.ax
+        if self.element_legend is not None:
+            self.element_legend.remove()
+            self.bond_legend.remove()
+
+        # Placing Legends. Labels and colors are filled in by draw().
+        element_handles = [
+            Line2D([0], [0], marker='o', color='w', label=' ',
+                   markersize=15)
+            for _ in range(n_elements)
+        ]
+
+        bond_handles = [
+            Line2D([0], [0], label=' ', markersize=15)
+            for _ in range(n_orders)
+        ]
+
+        self.element_legend = ax.legend(handles=element_handles, loc=1,
+                                        bbox_to_anchor=(1.3, 1.15))
+
+        # Adding `legend` artist to facilitate multiple legends on the same
+        # axes
+        ax.add_artist(self.element_legend)
+
+        # One row, however many bond orders there are, so that the title
+        # stays inside the figure
+        self.bond_legend = ax.legend(handles=bond_handles, title='Bond Order',
+                                     loc=4, bbox_to_anchor=(1.12, 0.987),
+                                     ncol=n_orders)
+
+
+def molecule_scene(mol: Molecule) -> tuple:
+    """
+    Return the atoms and bonds of a molecule, as RenderSession.draw()
+    draws them: [(element, x, y, z), ...], with one entry per element, and
+    [((x1, x2), (y1, y2), (z1, z2), order), ...], with one entry per bond.
 
-def render(chem_form: str) -> None:
+    Args:
+        mol: Molecule returned by get_molecule()
     """
-    Render the 3D structure of a given compound.
+    from molecule import molecule_coordinates
+
+    coords = molecule_coordinates(mol)
+    symbols = mol.symbols()
+
+    atoms = []
+    for element in mol.composition():
+        x, y, z = coords[[s == element for s in symbols]].T
+        atoms.append((element, x, y, z))
+
+    edges = mol.edges
+    bonds = [(*zip(coords[edges[2 * k]], coords[edges[2 * k + 1]]), order)
+             for k, order in enumerate(mol.orders)]
+
+    return atoms, bonds
+
+
+def legend_handles(legend) -> list:
+    """
+    Return the handles of a legend.
 
     Args:
-        chem_form: chemical formula
+        legend: matplotlib legend
     """
-    element_dict = get_elements(chem_form)
-    geometry = classify_geometry(element_dict, get_lp(element_dict))
+    # Renamed in matplotlib 3.7
+    handles = getattr(legend, "legend_handles", None)
+    if handles is None:
+        handles = legend.legendHandles
 
-    x, y, z = fetch_coordinates(geometry)
+    return handles
 
-    ca, nca = '', ''
-    element_list = []
-    for ele in element_dict:
-        element_list.append(ele)
 
-    for ele in element_dict:
-        if element_dict[ele] == 1:
-            ca = ele
-            element_list.remove(ca)
-            break
+def draw_structure(fig, analysis: Analysis, theme: str) -> None:
+    """
+    Draw the 3D structure of a given compound on a new matplotlib figure.
 
-    nca = element_list[0]
+    Args:
+        fig: matplotlib figure to draw on
+        analysis: Analysis returned by analyze()
+        theme: "dark" or "light"
+    """
+    RenderSession(fig).draw(analysis, theme)
+
+
+@lru_cache(maxsize=1)
+def get_render_session() -> RenderSession:
+    """Return the render session shared by calls to render()."""
+    return RenderSession()
+
+
+def render(analysis: Analysis, save_history: bool = True,
+           block: bool = True) -> None:
+    """
+    Render the 3D structure of a given compound in a window. The figure
+    is reused by the next render for as long as the window stays open.
+
+    Args:
+        analysis: Analysis returned by analyze()
+        save_history: add the formula to the history table after rendering
+        block: wait until the window is closed; otherwise return at once,
+               and leave the window open for the next render to redraw
+    """
+    # matplotlib takes a while to import, so it is only imported once
+    # something is actually rendered.
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
 
     # Get rid of the default toolbar
     mpl.rcParams['toolbar'] = 'None'
 
-    fig = plt.figure(f'{chem_form} ({geometry} type)')
-    ax = fig.add_subplot(111, projection='3d')
-    ax.set_axis_off()
-
-    ax.plot(x, y, z, 'o', c=pt.get_markercolor(nca),
-            markersize=pt.get_markersize(nca))
-    ax.plot(0, 0, 0, 'o', c=pt.get_markercolor(ca),
-            markersize=pt.get_markersize(ca))
-
-    conn = sqlite3.connect('.db/csg_db.db')
-    cur = conn.cursor()
-    cur.execute('select theme from user_preferences')
-    theme = cur.fetchone()[0]
-    conn.close()
-
-    # Storing the hexadecimal color values as per user preference.
-    # To be used for background color while rendering in matplotlib
-    if theme == 'dark':
-        facecolor = '#171717'
-    else:
-        facecolor = '#E9E9E9'
+    # Reuse the figure of the previous render, if its window is still open.
+    session = get_render_session()
+    if session.fig is None or not plt.fignum_exists(session.fig.number):
+        with span("figure"):
+            session.reset(plt.figure())
 
-    ax.set_facecolor(facecolor)
-    fig.patch.set_facecolor(facecolor)
+    with span("draw"):
+        session.draw(analysis, get_theme())
+
+    session.fig.canvas.manager.set_window_title(
+        f'{analysis.formula} ({analysis.geometry} type)')
+    session.fig.canvas.draw_idle()
+
+    if block:
+        plt.show()
 
-    # Determining Bond Order and populating bond_params
-    # for use in plotting bonds and placing legends
-    if pt.get_nvalence_electrons(nca) == 1:
-        bond_order = 1
-    else:
-        bond_order = 8 - pt.get_nvalence_electrons(nca)
-
-    if bond_order == 1:
-        bond_params = {
-            'dark': 'royalblue', 'light': 'g', 'lw': 1, 'bo': 'single'
-        }
-    elif bond_order == 2:
-        bond_params = {
-            'dark': 'g', 'light': 'navy', 'lw': 2.5, 'bo': 'double'
-        }
     else:
-        bond_params = {
-            'dark': 'b', 'light': 'red', 'lw': 3.5, 'bo': 'triple'
-        }
+        # Paint the window, and return. At a terminal prompt, the Qt and
+        # Tk backends keep handling its events while input() waits.
+        plt.show(block=False)
+        plt.pause(0.001)
 
-    # Plotting Bonds
-    for i in range(len(x)):
-        ax.plot([0, x[i]], [0, y[i]], [0, z[i]], '-',
-                linewidth=bond_params['lw'], c=bond_params[theme], alpha=0.75)
+    if save_history:
+        queue_write(add_formula_to_history, analysis.formula)
 
-    # Placing Legends
-    element_handles = [
-        Line2D([0], [0], marker='o', color='w', label=nca,
-               markerfacecolor=pt.get_markercolor(nca), markersize=15),
 
-        Line2D([0], [0], marker='o', color='w', label=ca,
-               markerfacecolor=pt.get_markercolor(ca), markersize=15)
-    ]
+def render_image(chem_form: str, fmt: str = "png", dpi: int = EXPORT_DPI,
+                 theme: str = None, use_cache: bool = True) -> bytes:
+    """
+    Render the 3D structure of a given compound to an image, without a
+    display, and return the encoded image. Images are served from the
+    image cache when possible. Nothing is written to the history table.
 
-    bond_handles = [
-        Line2D([0], [0], color=bond_params[theme], lw=bond_params['lw'],
-               label=bond_params['bo'], markerfacecolor=bond_params[theme],
-               markersize=15)
-    ]
+    Args:
+        chem_form: chemical formula
+        fmt: image format, eg. "png" or "svg"
+        dpi: resolution, in dots per inch
+        theme: "dark" or "light". Defaults to the theme in the user
+               preferences.
+        use_cache: look up and store the image in the image cache
+    """
+    # Surrounding whitespace is ignored when parsing, so it must not make
+    # a separate cache entry either.
+    chem_form = chem_form.strip()
 
-    element_legend = plt.legend(handles=element_handles, loc=1,
-                                bbox_to_anchor=(1.3, 1.15))
+    if theme is None:
+        theme = get_theme()
 
-    # Adding `legend` artist to facilitate multiple legends on the same axes
-    plt.gca().add_artist(element_legend)
+    if use_cache:
+        cache = get_image_cache()
+        key = cache.make_key(RENDERER_VERSION, chem_form, theme,
+                             EXPORT_FIGSIZE, dpi, fmt)
+        data = cache.get(key)
+        if data is not None:
+            return data
 
-    plt.legend(handles=bond_handles, title='Bond Order', loc=4,
-               bbox_to_anchor=(1.12, 0.987))
+    # A bare Figure on the Agg canvas does not involve pyplot, and so
+    # does not need a GUI backend. matplotlib is not even imported if the
+    # image is in the cache.
+    analysis = analyze(chem_form)
+    if analysis is None:
+        raise ValueError(f"Invalid formula: '{chem_form}'")
 
-    plt.show()
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    conn = sqlite3.connect(".db/csg_db.db")
-    cur = conn.cursor()
-    cur.execute("SELECT command FROM history WHERE type='formula';")
-    all_recs = cur.fetchall()
+    with span("figure"):
+        fig = Figure(figsize=EXPORT_FIGSIZE)
+        FigureCanvasAgg(fig)
 
-    if len(all_recs) == 0:
-        cur.execute("INSERT INTO history VALUES(NULL, ?, ?);",
-                    (chem_form, "formula"))
-        conn.commit()
+    with span("draw"):
+        draw_structure(fig, analysis, theme)
 
-    else:
-        chem_forms = []
-        for rec in all_recs:
-            chem_forms.append(rec[0])
+    with span("rasterize"):
+        buf = BytesIO()
+        fig.savefig(buf, format=fmt, dpi=dpi, facecolor=fig.get_facecolor())
+        data = buf.getvalue()
+
+    if use_cache:
+        cache.put(key, data)
+
+    return data
+
+
+def render_to_file(chem_form: str, path_name: str, fmt: str = None,
+                   dpi: int = EXPORT_DPI, theme: str = "dark",
+                   use_cache: bool = True) -> None:
+    """
+    Render the 3D structure of a given compound to an image file, without
+    a display. Nothing is written to the history table.
+
+    Args:
+        chem_form: chemical formula
+        path_name: path of the image file
+        fmt: image format, eg. "png" or "svg". Defaults to the extension
+             of `path_name`.
+        dpi: resolution, in dots per inch
+        theme: "dark" or "light"
+        use_cache: look up and store the image in the image cache
+    """
+    if fmt is None:
+        fmt = path.splitext(path_name)[1][1:].lower()
+
+    data = render_image(chem_form, fmt, dpi, theme, use_cache)
+    with open(path_name, "wb") as f:
+        f.write(data)
 
 
-        if chem_form not in chem_forms:
-            cur.execute("INSERT INTO history VALUES(NULL, ?, ?);",
-                        (chem_form, "formula"))
-            conn.commit()
+@lru_cache(maxsize=1)
+def get_image_cache() -> ImageCache:
+    """
+    Return the shared image cache, in the database directory. With the
+    databases in memory, images are not cached.
+    """
+    return ImageCache(db_file(IMAGE_CACHE_DIR_NAME))
+
+
+def warm_image_cache(fmt: str = "png", dpi: int = EXPORT_DPI,
+                     theme: str = None) -> int:
+    """
+    Render every formula in the history table into the image cache.
+    Returns the number of images that had to be rendered.
+
+    Args:
+        fmt: image format, eg. "png" or "svg"
+        dpi: resolution, in dots per inch
+        theme: "dark" or "light". Defaults to the theme in the user
+               preferences.
+    """
+    cache = get_image_cache()
+    misses = cache.misses
+
+    for chem_form in get_formula_history():
+        if validate(chem_form):
+            render_image(chem_form, fmt, dpi, theme)
 
-    conn.close()
+    return cache.misses - misses
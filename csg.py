@@ -19,21 +19,49 @@
 #   along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-from sys import argv
+from sys import argv, stderr, stdin, stdout
+from typing import Iterator
+from time import perf_counter
+import json
+import os
 
-import sqlite3
-
-from core import (init_csg_db, validate, run_builtin_cmd, get_elements, get_lp,
-                 classify_geometry, render)
+from db import (csg_db, add_history, add_formula_to_history, queue_write,
+                flush_writes, set_db_dir, MEMORY_DB_DIR)
+from core import (init_csg_db, validate, analyze, run_builtin_cmd, render,
+                  render_to_file, get_geometry_store, get_image_cache, tick,
+                  EXPORT_DPI)
 
 
 VERSION = "v0.1-alpha.3"
 
 
 def main():
+    # Before anything opens a database
+    if "--no-persist" in argv:
+        set_db_dir(MEMORY_DB_DIR)
+
+    elif "--db-dir" in argv:
+        set_db_dir(get_opt_value("--db-dir"))
+
     if "--cli" in argv:
         repl()
 
+    elif "--export-format" in argv:
+        export_structures(get_opt_value("--export-format"))
+        exit()
+
+    elif "--export" in argv:
+        export(get_opt_value("--export"))
+        exit()
+
+    elif "--batch" in argv:
+        batch(get_opt_value("--batch"))
+        exit()
+
+    elif "--serve" in argv:
+        serve()
+        exit()
+
     elif "--help" in argv or "-h" in argv:
         usage()
         exit()
@@ -44,8 +72,11 @@ def main():
 
     try:
         from ui import ui_init
-        if len(argv) > 1:
-            print("[!] Ignoring extra argument(s): ", ", ".join(argv[1:]))
+        extra_args = [arg for arg in argv[1:]
+                      if arg not in ("--no-persist", "--db-dir")
+                      and arg != get_opt_value("--db-dir")]
+        if len(extra_args) > 0:
+            print("[!] Ignoring extra argument(s): ", ", ".join(extra_args))
 
         ui_init()
 
@@ -62,8 +93,6 @@ def repl() -> None:
     print("Type '/help' for help on command usage.\n")
 
     init_csg_db()
-    conn = sqlite3.connect(".db/csg_db.db")
-    cur = conn.cursor()
 
     while True:
         try:
@@ -72,7 +101,7 @@ def repl() -> None:
         # Exit on Ctrl-D
         except EOFError:
             print("Exiting...")
-            conn.close()
+            flush_writes()
             exit()
 
         # Ignore Ctrl-C
@@ -87,25 +116,308 @@ def repl() -> None:
 
         if chem_form.strip()[0] == '/':
             run_builtin_cmd(chem_form.split())
-            cur.execute("INSERT INTO history VALUES(NULL, ?, ?);",
-                        (chem_form, cmd_type))
-            conn.commit()
+            queue_write(add_history, chem_form, cmd_type)
             continue
 
-        valid = validate(chem_form)
+        analysis = analyze(chem_form)
 
-        if valid:
-            element_dict = get_elements(chem_form)
-            lp = get_lp(element_dict)
-            geometry = classify_geometry(element_dict, lp)
+        if analysis is not None:
+            print("{:<10} : {:<6}".format("Lone Pairs", analysis.lone_pairs))
+            print("{:<10} : {:<6}".format("Geometry", analysis.geometry))
 
-            print("{:<10} : {:<6}".format("Lone Pairs", lp))
-            print("{:<10} : {:<6}".format("Geometry", geometry))
+            # Without blocking, the window stays open, and the next formula
+            # is drawn in it. A valid formula can still have more domains
+            # than coordinates can be computed for (ValueError).
+            try:
+                render(analysis, block=False)
 
-            render(chem_form)
+            except ValueError as ex:
+                print(f"[!] {ex}")
 
         else:
-            print("Enter a valid compound with exactly 2 elements.")
+            print("Enter a valid compound, eg. H2O, C2H4 or H2SO4.")
+
+
+def get_opt_value(*opts: str, default: str = None) -> str:
+    """
+    Return the value following the first of `opts` found in argv.
+
+    Args:
+        opts: option names, e.g. "--jobs", "-j"
+        default: value returned if none of the options is present
+    """
+    for opt in opts:
+        if opt in argv:
+            i = argv.index(opt)
+            if i + 1 >= len(argv) or argv[i + 1].startswith("-"):
+                print(f"[!] Option '{opt}' requires a value.")
+                exit(1)
+
+            return argv[i + 1]
+
+    return default
+
+
+def iter_formulas(path_name: str = None) -> Iterator[str]:
+    """
+    Read formulas, one per line, lazily. Blank lines and '#' comments are
+    skipped.
+
+    Args:
+        path_name: file to read from; standard input if None or '-'
+    """
+    if path_name is None or path_name == "-":
+        f = stdin
+
+    else:
+        f = open(path_name)
+
+    try:
+        for line in f:
+            line = line.strip()
+            if line != "" and not line.startswith("#"):
+                yield line
+
+    finally:
+        if f is not stdin:
+            f.close()
+
+
+def read_formulas(path_name: str = None) -> list:
+    """
+    Read formulas, one per line. Blank lines and '#' comments are skipped.
+
+    Args:
+        path_name: file to read from; standard input if None or '-'
+    """
+    return list(iter_formulas(path_name))
+
+
+def get_n_jobs() -> int:
+    """Return the number of worker processes to use."""
+    return int(get_opt_value("--jobs", "-j", default=str(os.cpu_count())))
+
+
+def batch_analyze(chem_form: str) -> dict:
+    """
+    Analyze a single formula. Runs in a worker process in batch mode.
+
+    Args:
+        chem_form: chemical formula
+    """
+    result = {
+        "formula": chem_form,
+        "valid": False,
+        "lone_pairs": None,
+        "geometry": None
+    }
+
+    try:
+        analysis = analyze(chem_form)
+        if analysis is not None:
+            result["valid"] = True
+            result["lone_pairs"] = analysis.lone_pairs
+            result["geometry"] = analysis.geometry
+
+    # A single bad line should not take the whole batch down with it.
+    except Exception as ex:
+        result["valid"] = False
+        result["error"] = str(ex)
+
+    return result
+
+
+def batch(batch_file: str) -> None:
+    """
+    Analyze every formula in `batch_file` on a pool of worker processes.
+    Writes one JSON line per formula, in input order.
+
+    Args:
+        batch_file: path to a file with one formula per line
+    """
+    from multiprocessing import Pool
+
+    n_jobs = get_n_jobs()
+    out_path = get_opt_value("--output", "-o")
+    do_render = "--render" in argv
+    save_history = "--history" in argv
+
+    formulas = read_formulas(batch_file)
+
+    out = open(out_path, "w") if out_path is not None else None
+    valid_formulas = []
+
+    # Hand out work in chunks, so that IPC does not dominate for the
+    # tiny per-formula workload.
+    chunksize = max(1, len(formulas) // (n_jobs * 4))
+
+    start = perf_counter()
+    with Pool(n_jobs) as pool:
+        for result in pool.imap(batch_analyze, formulas, chunksize):
+            print(json.dumps(result), file=out)
+            if result["valid"]:
+                valid_formulas.append(result["formula"])
+
+    elapsed = perf_counter() - start
+
+    if out is not None:
+        out.close()
+
+    rate = len(formulas) / elapsed if elapsed > 0 else 0
+    print(f"[{tick}] Analyzed {len(formulas)} formula(s) "
+          f"({len(valid_formulas)} valid) in {elapsed:.3f}s "
+          f"using {n_jobs} process(es): {rate:.1f} formulas/s", file=stderr)
+
+    if save_history:
+        init_csg_db()
+        with csg_db().transaction():
+            for chem_form in valid_formulas:
+                add_formula_to_history(chem_form)
+
+    if do_render:
+        for chem_form in valid_formulas:
+            try:
+                render(analyze(chem_form), save_history)
+
+            except ValueError as ex:
+                print(f"[!] Skipping '{chem_form}': {ex}", file=stderr)
+
+
+def export_image(job: tuple) -> tuple:
+    """
+    Render a single formula to an image file. Runs in a worker process in
+    export mode. Returns (formula, error, cached), where error is None on
+    success, and cached is True if the image came from the image cache.
+
+    Args:
+        job: (formula, path, format, dpi, theme)
+    """
+    chem_form, path_name, fmt, dpi, theme = job
+    if not validate(chem_form):
+        return chem_form, "invalid formula", False
+
+    cache = get_image_cache()
+    hits = cache.hits
+
+    try:
+        render_to_file(chem_form, path_name, fmt, dpi, theme)
+
+    except Exception as ex:
+        return chem_form, str(ex), False
+
+    return chem_form, None, cache.hits > hits
+
+
+def export(out_dir: str) -> None:
+    """
+    Render every formula from --input (or standard input) to an image file
+    in `out_dir`, on a pool of worker processes. History is not touched.
+
+    Args:
+        out_dir: directory to write the images to
+    """
+    from multiprocessing import Pool
+
+    n_jobs = get_n_jobs()
+    fmt = get_opt_value("--format", default="png").lower()
+    dpi = int(get_opt_value("--dpi", default=str(EXPORT_DPI)))
+    theme = get_opt_value("--theme", default="dark")
+
+    if fmt not in ("png", "svg"):
+        print(f"[!] Unsupported image format: '{fmt}'")
+        exit(1)
+
+    if theme not in ("dark", "light"):
+        print(f"[!] Invalid theme: '{theme}'")
+        exit(1)
+
+    formulas = read_formulas(get_opt_value("--input", "-i"))
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Load the geometries up front, so that forked workers inherit them
+    # instead of each reading the database.
+    init_csg_db()
+    get_geometry_store()
+
+    jobs = [(chem_form, os.path.join(out_dir, f"{chem_form}.{fmt}"), fmt, dpi,
+             theme) for chem_form in dict.fromkeys(formulas)]
+    n_images = 0
+    n_cached = 0
+
+    start = perf_counter()
+    with Pool(n_jobs) as pool:
+        for chem_form, error, cached in pool.imap_unordered(export_image,
+                                                            jobs):
+            if error is None:
+                n_images += 1
+                n_cached += cached
+
+            else:
+                print(f"[!] Skipping '{chem_form}': {error}", file=stderr)
+
+    elapsed = perf_counter() - start
+
+    rate = n_images / elapsed if elapsed > 0 else 0
+    print(f"[{tick}] Exported {n_images} image(s) ({n_cached} cached) to "
+          f"'{out_dir}' in {elapsed:.3f}s using {n_jobs} process(es): "
+          f"{rate:.1f} images/s", file=stderr)
+
+
+def export_structures(fmt: str) -> None:
+    """
+    Write the structure of every formula from --input (or standard input)
+    to a single multi-record file, or standard output. Formulas are read,
+    and structures written, one at a time.
+
+    Args:
+        fmt: "xyz", "pdb" or "sdf"
+    """
+    from contextlib import redirect_stdout
+    from molfile import EXPORT_FORMATS, open_output, write_structures
+
+    fmt = fmt.lower()
+    if fmt not in EXPORT_FORMATS:
+        print(f"[!] Unsupported structure format: '{fmt}'")
+        exit(1)
+
+    out_path = get_opt_value("--output", "-o")
+
+    # Standard output may be the export itself.
+    with redirect_stdout(stderr):
+        init_csg_db()
+
+    def skip(chem_form: str, error: str) -> None:
+        print(f"[!] Skipping '{chem_form}': {error}", file=stderr)
+
+    start = perf_counter()
+    out = open_output(out_path, "--compress" in argv)
+    try:
+        n_written = write_structures(
+            iter_formulas(get_opt_value("--input", "-i")), out, fmt, skip)
+
+    finally:
+        if out is stdout:
+            out.flush()
+
+        else:
+            out.close()
+
+    elapsed = perf_counter() - start
+
+    rate = n_written / elapsed if elapsed > 0 else 0
+    print(f"[{tick}] Exported {n_written} structure(s) to "
+          f"'{out_path or '-'}' in {elapsed:.3f}s: {rate:.1f} structures/s",
+          file=stderr)
+
+
+def serve() -> None:
+    """Serve CSG over HTTP until interrupted."""
+    from server import CSGServer, SERVE_HOST, SERVE_PORT
+
+    host = get_opt_value("--host", default=SERVE_HOST)
+    port = int(get_opt_value("--port", default=str(SERVE_PORT)))
+
+    CSGServer(host, port, get_n_jobs()).serve()
 
 
 def usage():
@@ -114,6 +426,42 @@ def usage():
 
     print("Options:")
     print("\t{:<21}{:<20}".format("--cli", "Run in the terminal"))
+    print("\t{:<21}{:<20}".format("--batch FILE",
+                                  "Analyze every formula in FILE (one per line)"))
+    print("\t{:<15}{:<6}{:<20}".format("--jobs,", "-j N",
+                                       "Number of worker processes"))
+    print("\t{:<15}{:<6}{:<20}".format("--output,", "-o FILE",
+                                       "Write --batch or --export-format "
+                                       "results to FILE"))
+    print("\t{:<21}{:<20}".format("--render",
+                                  "Render valid formulas after --batch"))
+    print("\t{:<21}{:<20}".format("--history",
+                                  "Save valid --batch formulas to history"))
+    print("\t{:<21}{:<20}".format("--export DIR",
+                                  "Render formulas to image files in DIR"))
+    print("\t{:<15}{:<6}{:<20}".format("--input,", "-i FILE",
+                                       "Read --export(-format) formulas from FILE"))
+    print("\t{:<21}{:<20}".format("--format png|svg",
+                                  "Image format for --export (default: png)"))
+    print("\t{:<21}{:<20}".format("--dpi N",
+                                  "Image resolution for --export"))
+    print("\t{:<21}{:<20}".format("--theme dark|light",
+                                  "Image theme for --export (default: dark)"))
+    print("\t{:<21}{:<20}".format("--export-format FMT",
+                                  "Write structures as xyz, pdb or sdf"))
+    print("\t{:<21}{:<20}".format("--compress",
+                                  "Gzip --export-format output"))
+    print("\t{:<21}{:<20}".format("--serve",
+                                  "Serve CSG over HTTP/JSON"))
+    print("\t{:<21}{:<20}".format("--host ADDR",
+                                  "Address for --serve (default: 127.0.0.1)"))
+    print("\t{:<21}{:<20}".format("--port N",
+                                  "Port for --serve (default: 8080)"))
+    print("\t{:<21}{:<20}".format("--db-dir DIR",
+                                  "Keep databases and caches in DIR "
+                                  "(default: $CSG_DB_DIR or .db)"))
+    print("\t{:<21}{:<20}".format("--no-persist",
+                                  "Keep databases in memory; write nothing"))
     print("\t{:<15}{:<6}{:<20}".format("--help,", "-h", "Show this help message and exit"))
     print("\t{:<15}{:<6}{:<20}".format("--version,", "-V", "Show version information and exit"))
 
@@ -0,0 +1,768 @@
+# db.py: The data-access layer for CSG
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+import atexit
+import threading
+from os import environ, getpid, path
+from queue import Queue, Empty
+from time import perf_counter, monotonic, sleep, time
+from contextlib import contextmanager
+from typing import Iterator
+
+from tracing import traced
+
+
+# Directory that holds the databases and caches, unless set with
+# set_db_dir() or the CSG_DB_DIR environment variable. MEMORY_DB_DIR
+# keeps the databases in memory instead, and nothing is written to disk.
+DB_DIR = ".db"
+DB_DIR_ENV = "CSG_DB_DIR"
+MEMORY_DB_DIR = ":memory:"
+
+CSG_DB_NAME = "csg_db.db"
+GEOMETRY_DB_NAME = "geometry.db"
+
+# Journal mode of database files. With write-ahead logging, readers do
+# not block the writer, nor the writer readers, so several CSG processes
+# can share a database directory.
+DB_JOURNAL_MODE = "WAL"
+
+# Seconds a connection waits for another to release a lock, before a
+# statement fails as "database is locked"
+DB_BUSY_TIMEOUT = 10.0
+
+# A statement that still finds the database locked is retried this many
+# times, after DB_RETRY_DELAY seconds, doubled each time, with jitter.
+DB_RETRIES = 5
+DB_RETRY_DELAY = 0.05
+
+# Applied to every new connection. CSG's databases are small and rebuilt
+# easily, so durability is traded for fewer fsyncs.
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;"
+)
+
+# Size of sqlite3's per-connection prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+# The history table keeps at most HISTORY_MAX_ROWS records; the least
+# recently used ones are evicted first. The size is checked once every
+# HISTORY_PRUNE_INTERVAL inserts.
+HISTORY_MAX_ROWS = 10000
+HISTORY_PRUNE_INTERVAL = 100
+
+# History queries hand out rows as they are read, HISTORY_FETCH_SIZE at a
+# time, instead of loading the whole table first.
+HISTORY_FETCH_SIZE = 256
+
+# The full-text index on commands matches substrings of at least this
+# many characters; shorter search terms are matched by scanning.
+HISTORY_FTS_MIN_CHARS = 3
+
+# Queued writes are committed in one transaction once WRITE_BATCH_SIZE of
+# them are waiting, or WRITE_BATCH_DELAY seconds after the first one.
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_DELAY = 0.25
+
+# compact_db() rebuilds a database file once at least COMPACT_MIN_PAGES
+# pages, and COMPACT_FREE_RATIO of the file, are unused.
+COMPACT_MIN_PAGES = 64
+COMPACT_FREE_RATIO = 0.25
+
+
+class Database:
+    """
+    A long-lived connection to one SQLite database, per thread. Statements
+    run in autocommit mode, unless they are inside a transaction() block,
+    and are retried if another process keeps the database locked. The
+    time spent in database calls is counted.
+    """
+    def __init__(self, path_name: str):
+        """
+        Constructor.
+
+        Args:
+            path_name: path of the database file, or a "file:" URI
+        """
+        self.path_name = path_name
+        self.n_calls = 0
+        self.time_spent = 0.0
+        self.__local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it if necessary."""
+        local = self.__local
+
+        # A connection must not be used by a forked child process, or by
+        # another thread, so they open their own.
+        if getattr(local, "pid", None) != getpid():
+            uri = self.path_name.startswith("file:")
+            conn = sqlite3.connect(self.path_name, timeout=DB_BUSY_TIMEOUT,
+                                   isolation_level=None, uri=uri,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+
+            # The journal mode is stored in the file, so this only takes
+            # a lock the first time. In-memory databases keep theirs.
+            if not uri:
+                retry(conn.execute,
+                      f"PRAGMA journal_mode = {DB_JOURNAL_MODE};")
+
+            local.conn = conn
+            local.pid = getpid()
+
+        return local.conn
+
+    def __call(self, func, *args):
+        """
+        Call a database function, counting the call and the time spent in
+        it. Outside a transaction, it is retried if the database is
+        locked; inside one, the whole transaction has to be.
+        """
+        start = perf_counter()
+        try:
+            if self.conn.in_transaction:
+                return func(*args)
+
+            return retry(func, *args)
+
+        finally:
+            self.n_calls += 1
+            self.time_spent += perf_counter() - start
+
+    def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """
+        Execute a single statement.
+
+        Args:
+            sql: SQL statement, with '?' placeholders
+            params: values for the placeholders
+        """
+        return self.__call(self.conn.execute, sql, params)
+
+    def executemany(self, sql: str, seq_of_params) -> sqlite3.Cursor:
+        """
+        Execute a statement once for each set of parameters. A generator
+        cannot be replayed, so the statement is only retried if
+        `seq_of_params` is a list or tuple.
+
+        Args:
+            sql: SQL statement, with '?' placeholders
+            seq_of_params: iterable of parameter tuples
+        """
+        if isinstance(seq_of_params, (list, tuple)):
+            return self.__call(self.conn.executemany, sql, seq_of_params)
+
+        start = perf_counter()
+        try:
+            return self.conn.executemany(sql, seq_of_params)
+
+        finally:
+            self.n_calls += 1
+            self.time_spent += perf_counter() - start
+
+    def fetchall(self, sql: str, params: tuple = ()) -> list:
+        """
+        Execute a query and return all resulting rows.
+
+        Args:
+            sql: SQL query, with '?' placeholders
+            params: values for the placeholders
+        """
+        return self.__call(
+            lambda: self.conn.execute(sql, params).fetchall())
+
+    def fetchone(self, sql: str, params: tuple = ()) -> tuple:
+        """
+        Execute a query and return the first resulting row, or None.
+
+        Args:
+            sql: SQL query, with '?' placeholders
+            params: values for the placeholders
+        """
+        return self.__call(
+            lambda: self.conn.execute(sql, params).fetchone())
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the statements in a `with` block as one transaction. The write
+        lock is taken up front, so concurrent writers queue up instead of
+        failing half-way.
+        """
+        self.execute("BEGIN IMMEDIATE;")
+        try:
+            yield self
+
+        except BaseException:
+            self.execute("ROLLBACK;")
+            raise
+
+        self.execute("COMMIT;")
+
+    def close(self) -> None:
+        """Close this thread's connection, if it is open."""
+        local = self.__local
+        if getattr(local, "pid", None) == getpid():
+            local.conn.close()
+
+        local.conn = None
+        local.pid = None
+
+
+def retry(func, *args):
+    """
+    Call `func(*args)`, and if it fails because the database is locked,
+    even after the busy timeout, try again up to DB_RETRIES times, backing
+    off in between.
+
+    Args:
+        func: function that runs a statement
+        args: arguments for `func`
+    """
+    delay = DB_RETRY_DELAY
+    for _ in range(DB_RETRIES):
+        try:
+            return func(*args)
+
+        except sqlite3.OperationalError as ex:
+            if "locked" not in str(ex):
+                raise
+
+        # Jitter keeps processes that collided from colliding again.
+        from random import random
+        sleep(delay * (1 + random()))
+        delay *= 2
+
+    return func(*args)
+
+
+class WriteQueue:
+    """
+    Write-behind queue. Writes are run on a background thread, and
+    committed in batches of up to WRITE_BATCH_SIZE, at most
+    WRITE_BATCH_DELAY seconds after they were queued, so that callers
+    never wait for a commit.
+    """
+    # Markers, put on the queue by flush() and close()
+    FLUSH = object()
+    STOP = object()
+
+    def __init__(self, db: Database):
+        """
+        Constructor.
+
+        Args:
+            db: the database that queued writes go to
+        """
+        self.db = db
+        self.__queue = Queue()
+        self.__pending = 0
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="csg-write-queue", daemon=True)
+        self.__thread.start()
+
+    def submit(self, func, *args) -> None:
+        """
+        Queue a write. `func(*args)` is called on the writer thread, inside
+        a transaction.
+
+        Args:
+            func: function that writes to the database
+            args: arguments for `func`
+        """
+        with self.__lock:
+            self.__pending += 1
+
+        self.__queue.put((func, args))
+
+    def depth(self) -> int:
+        """Return the number of queued writes that are not committed yet."""
+        return self.__pending
+
+    def flush(self) -> None:
+        """Commit all queued writes, and wait until that is done."""
+        if self.__thread.is_alive():
+            self.__queue.put(self.FLUSH)
+            self.__queue.join()
+
+    def close(self) -> None:
+        """Commit all queued writes, and stop the writer thread."""
+        if self.__thread.is_alive():
+            self.__queue.put(self.STOP)
+            self.__thread.join()
+
+    def __run(self) -> None:
+        while True:
+            item = self.__queue.get()
+            batch = [item]
+            deadline = monotonic() + WRITE_BATCH_DELAY
+
+            # Collect more writes, unless asked to flush or stop.
+            while item is not self.FLUSH and item is not self.STOP \
+                    and len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = self.__queue.get(timeout=timeout)
+
+                except Empty:
+                    break
+
+                batch.append(item)
+
+            writes = [i for i in batch
+                      if i is not self.FLUSH and i is not self.STOP]
+            if len(writes) > 0:
+                self.__commit(writes)
+
+            for _ in batch:
+                self.__queue.task_done()
+
+            if batch[-1] is self.STOP:
+                self.db.close()
+                return
+
+    def __commit(self, writes: list) -> None:
+        try:
+            with self.db.transaction():
+                for func, args in writes:
+                    func(*args)
+
+        # Losing a history record is no reason to take CSG down.
+        except Exception as ex:
+            print(f"[!] Failed to write to {self.db.path_name}: {ex}")
+
+        finally:
+            with self.__lock:
+                self.__pending -= len(writes)
+
+
+# Database directory, once set, or read from the environment
+db_dir = None
+
+# Open databases, by path
+databases = {}
+
+# Write-behind queues, by process ID
+write_queues = {}
+
+# User preferences that have been read or written, by name
+preferences = {}
+
+
+def set_db_dir(dir_path: str) -> None:
+    """
+    Set the directory that holds the databases and caches, or
+    MEMORY_DB_DIR to keep everything in memory. Call this at startup,
+    before anything is read. Child processes inherit the setting through
+    the environment.
+
+    Args:
+        dir_path: path of the directory, which is created by init_csg_db()
+    """
+    global db_dir
+
+    db_dir = dir_path
+    environ[DB_DIR_ENV] = dir_path
+
+
+def get_db_dir() -> str:
+    """Return the directory that holds the databases and caches."""
+    global db_dir
+
+    if db_dir is None:
+        db_dir = environ.get(DB_DIR_ENV) or DB_DIR
+
+    return db_dir
+
+
+def persistent() -> bool:
+    """Return False if the databases are kept in memory only."""
+    return get_db_dir() != MEMORY_DB_DIR
+
+
+def db_file(name: str) -> str:
+    """
+    Return the path of a file in the database directory, or None if
+    nothing is written to disk.
+
+    Args:
+        name: name of the file, eg. "image_cache"
+    """
+    if not persistent():
+        return
+
+    return path.join(get_db_dir(), name)
+
+
+def get_db(path_name: str) -> Database:
+    """
+    Return the shared Database for a given path.
+
+    Args:
+        path_name: path of the database file
+    """
+    db = databases.get(path_name)
+    if db is None:
+        db = databases[path_name] = Database(path_name)
+
+    return db
+
+
+def database_path(name: str) -> str:
+    """
+    Return the path of a database in the database directory. In memory,
+    it is a URI naming an in-memory database that every connection in the
+    process shares; it lasts as long as one of them is open.
+
+    Args:
+        name: name of the database file, eg. "csg_db.db"
+    """
+    if not persistent():
+        return f"file:/{name}?vfs=memdb"
+
+    return path.join(get_db_dir(), name)
+
+
+def csg_db() -> Database:
+    """Return the shared Database for the CSG database."""
+    return get_db(database_path(CSG_DB_NAME))
+
+
+def geometry_db() -> Database:
+    """Return the shared Database for the geometry database."""
+    return get_db(database_path(GEOMETRY_DB_NAME))
+
+
+def get_write_queue() -> WriteQueue:
+    """Return the write-behind queue for the CSG database."""
+    # Forked children do not inherit the writer thread.
+    write_queue = write_queues.get(getpid())
+    if write_queue is None:
+        write_queue = write_queues[getpid()] = WriteQueue(csg_db())
+
+    return write_queue
+
+
+def queue_write(func, *args) -> None:
+    """
+    Run a write to the CSG database on the write-behind queue.
+
+    Args:
+        func: function that writes to the database
+        args: arguments for `func`
+    """
+    get_write_queue().submit(func, *args)
+
+
+def write_queue_depth() -> int:
+    """Return the number of queued writes that are not committed yet."""
+    write_queue = write_queues.get(getpid())
+
+    return 0 if write_queue is None else write_queue.depth()
+
+
+def flush_writes() -> None:
+    """Commit all queued writes, and wait until that is done."""
+    write_queue = write_queues.get(getpid())
+    if write_queue is not None and write_queue.depth() > 0:
+        write_queue.flush()
+
+
+@atexit.register
+def close_all() -> None:
+    """Commit all queued writes and close every open database."""
+    write_queue = write_queues.pop(getpid(), None)
+    if write_queue is not None:
+        write_queue.close()
+
+    for db in databases.values():
+        db.close()
+
+
+def get_db_stats() -> dict:
+    """
+    Return the number of calls and the time spent in them, in seconds, for
+    each database, as {"path": (n_calls, time_spent)}.
+    """
+    return {path_name: (db.n_calls, db.time_spent)
+            for path_name, db in databases.items()}
+
+
+def table_exists(db: Database, table: str) -> bool:
+    """
+    Check if a table exists in a database.
+
+    Args:
+        db: the database to check
+        table: name of the table
+    """
+    return db.fetchone("SELECT 1 FROM sqlite_master "
+                       "WHERE type='table' AND name=?;", (table,)) is not None
+
+
+def add_history(command: str, cmd_type: str) -> None:
+    """
+    Add a command to the history table.
+
+    Args:
+        command: the command, as entered
+        cmd_type: "formula" or "builtin"
+    """
+    if cmd_type == "formula":
+        add_formula_to_history(command)
+        return
+
+    cur = csg_db().execute("INSERT INTO history(command, type, last_used) "
+                           "VALUES(?, ?, ?);", (command, cmd_type, time()))
+
+    if cur.lastrowid % HISTORY_PRUNE_INTERVAL == 0:
+        prune_history()
+
+
+@traced("history_write")
+def add_formula_to_history(chem_form: str) -> bool:
+    """
+    Add a formula to the history table, or mark it as just used if it is
+    already there. Returns True if it was added.
+
+    Args:
+        chem_form: chemical formula
+    """
+    db = csg_db()
+    now = time()
+
+    # The unique index on formulae makes both of these a single lookup.
+    cur = db.execute("INSERT INTO history(command, type, last_used) "
+                     "VALUES(?, 'formula', ?) "
+                     "ON CONFLICT(command) WHERE type='formula' DO NOTHING;",
+                     (chem_form, now))
+
+    if cur.rowcount == 0:
+        db.execute("UPDATE history SET last_used=? "
+                   "WHERE type='formula' AND command=?;", (now, chem_form))
+        return False
+
+    if cur.lastrowid % HISTORY_PRUNE_INTERVAL == 0:
+        prune_history()
+
+    return True
+
+
+def prune_history(max_rows: int = None) -> int:
+    """
+    Evict the least recently used records from the history table, until
+    at most `max_rows` are left. Returns the number of records evicted.
+
+    Args:
+        max_rows: defaults to HISTORY_MAX_ROWS
+    """
+    if max_rows is None:
+        max_rows = HISTORY_MAX_ROWS
+
+    db = csg_db()
+    excess = db.fetchone("SELECT count(*) FROM history;")[0] - max_rows
+    if excess <= 0:
+        return 0
+
+    db.execute("DELETE FROM history WHERE number IN ("
+               "    SELECT number FROM history"
+               "    ORDER BY last_used, number LIMIT ?"
+               ");", (excess,))
+
+    return excess
+
+
+def compact_db(db: Database) -> bool:
+    """
+    Rebuild a database file if enough of it is unused, eg. after history
+    records have been evicted. Returns True if the file was rebuilt.
+
+    Args:
+        db: the database to compact
+    """
+    n_pages = db.fetchone("PRAGMA page_count;")[0]
+    n_free = db.fetchone("PRAGMA freelist_count;")[0]
+
+    if n_free < COMPACT_MIN_PAGES or n_free < n_pages * COMPACT_FREE_RATIO:
+        return False
+
+    try:
+        db.execute("VACUUM;")
+
+    # Another process is using the database; try again next time.
+    except sqlite3.OperationalError:
+        return False
+
+    return True
+
+
+def iter_history(cmd_type: str = None, limit: int = None, offset: int = 0,
+                 since: int = None, text: str = None) -> Iterator[tuple]:
+    """
+    Yield history records as (number, command, type) tuples, oldest first.
+    Rows are read HISTORY_FETCH_SIZE at a time, so the first ones arrive
+    without waiting for the rest of the table.
+
+    Args:
+        cmd_type: if given, only yield commands of this type
+        limit: yield at most this many records
+        offset: skip this many matching records first
+        since: only yield records numbered after this one, eg. the last
+               number of the previous page
+        text: only yield commands that contain this text, ignoring case
+    """
+    flush_writes()
+
+    db = csg_db()
+    source = "history"
+    where = []
+    params = []
+
+    # Rows come out in the order of this column, and `since` applies to
+    # it. For a full-text search, it is the index's own rowid, which it
+    # can return in order without sorting.
+    number = "history.number"
+
+    if text is not None:
+        if len(text) >= HISTORY_FTS_MIN_CHARS \
+                and table_exists(db, "history_fts"):
+            # The trigram index matches a quoted phrase as a substring.
+            source = "history_fts JOIN history " \
+                     "ON history.number = history_fts.rowid"
+            number = "history_fts.rowid"
+            where.append("history_fts MATCH ?")
+            params.append('"' + text.replace('"', '""') + '"')
+
+        else:
+            where.append("instr(lower(history.command), lower(?)) > 0")
+            params.append(text)
+
+    if cmd_type is not None:
+        where.append("history.type=?")
+        params.append(cmd_type)
+
+    if since is not None:
+        where.append(f"{number}>?")
+        params.append(since)
+
+    sql = ("SELECT history.number, history.command, history.type "
+           f"FROM {source}")
+    if len(where) > 0:
+        sql += " WHERE " + " AND ".join(where)
+
+    # A negative LIMIT means no limit.
+    sql += f" ORDER BY {number} LIMIT ? OFFSET ?;"
+    params += [-1 if limit is None else limit, offset]
+
+    cur = db.execute(sql, tuple(params))
+    try:
+        while True:
+            rows = cur.fetchmany(HISTORY_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+
+            yield from rows
+
+    finally:
+        cur.close()
+
+
+def get_formula_history() -> list:
+    """Return every formula in the history table, oldest first."""
+    flush_writes()
+
+    return [rec[0] for rec in csg_db().fetchall(
+        "SELECT command FROM history WHERE type='formula' ORDER BY number;")]
+
+
+def clear_history() -> None:
+    """Delete every record in the history table."""
+    # Queued records would otherwise be written after the table is cleared.
+    flush_writes()
+
+    with csg_db().transaction() as db:
+        db.execute("DELETE FROM history;")
+        db.execute("DELETE FROM sqlite_sequence WHERE name='history';")
+
+
+def get_theme() -> str:
+    """Return the theme from the user preferences."""
+    theme = preferences.get("theme")
+    if theme is None:
+        theme = csg_db().fetchone("SELECT theme FROM user_preferences;")[0]
+        preferences["theme"] = theme
+
+    return theme
+
+
+def set_theme(theme: str) -> None:
+    """
+    Set the theme in the user preferences.
+
+    Args:
+        theme: "dark" or "light"
+    """
+    preferences["theme"] = theme
+    csg_db().execute("UPDATE user_preferences SET theme=?;", (theme,))
+
+
+def queue_set_theme(theme: str) -> None:
+    """
+    Set the theme in the user preferences, on the write-behind queue.
+    get_theme() returns the new theme right away.
+
+    Args:
+        theme: "dark" or "light"
+    """
+    preferences["theme"] = theme
+    queue_write(set_theme, theme)
+
+
+def add_geometry_rows(rows: list) -> None:
+    """
+    Add coordinates to the geometry table. Coordinates that are already
+    there, e.g. added by another process in the meantime, are kept.
+
+    Args:
+        rows: list of (class, atom, x, y, z) tuples
+    """
+    db = geometry_db()
+    with db.transaction():
+        db.executemany("INSERT OR IGNORE INTO geometry VALUES(?, ?, ?, ?, ?);",
+                       rows)
+
+
+def get_geometry_rows() -> list:
+    """
+    Return every row of the geometry table as (class, x, y, z) tuples,
+    grouped by class.
+    """
+    return geometry_db().fetchall(
+        "SELECT class, x, y, z FROM geometry ORDER BY class, rowid;")
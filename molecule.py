@@ -0,0 +1,688 @@
+# molecule.py: Condensed formulae with any number of central atoms
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# parse_molecule() reads a condensed formula, such as CH3CH2OH, C(CH3)4
+# or H2SO4, into a Molecule and assigns its bond orders. validate_molecule()
+# then checks it against valencies and the octet rule, and
+# molecule_coordinates() lays it out in 3D, with the VSEPR geometry around
+# each central atom. analyze() falls back on this for the compounds that
+# the two-element model cannot describe.
+
+import heapq
+import re
+from array import array
+from math import cos, pi, sin, sqrt
+
+from chemistry import Molecule, geometry_class, pt
+
+
+# Condensed formulae, as read by parse_molecule(), are a sequence of
+# elements and parenthesized groups, each with an optional subscript.
+molecule_token_re = re.compile(r"([A-Z][a-z]?)(\d*)|(\()|\)(\d*)")
+
+# Atoms up to this atomic number (hydrogen to neon) obey the octet rule,
+# or, for hydrogen and helium, the duet rule. Heavier atoms may expand
+# their octet.
+OCTET_MAX_Z = 10
+
+# A run of at least this many identical atoms, as in C6H6, is closed into
+# a ring if the other atoms can be shared out evenly between its atoms.
+# Shorter runs are read as chains, eg. C3H6 as propene.
+RING_MIN_SIZE = 5
+
+
+def tokenize_molecule(chem_form: str) -> list:
+    """
+    Split a condensed formula into a nested list of (atomic number,
+    subscript) and (group, subscript) items, where a group is itself such
+    a list. Returns None if the formula is malformed.
+
+    Args:
+        chem_form: condensed formula, eg. "CH3(CH2)2OH"
+
+    Example:
+        tokenize_molecule("C(CH3)4") returns [(6, 1), ([(6, 1), (1, 3)], 4)]
+    """
+    chem_form = chem_form.strip()
+    stack = [[]]
+    pos = 0
+
+    while pos < len(chem_form):
+        re_match = molecule_token_re.match(chem_form, pos)
+        if re_match is None:
+            return
+
+        element, sub, opening, group_sub = re_match.groups()
+        pos = re_match.end()
+
+        if element is not None:
+            if not pt.check(element) or sub.startswith("0"):
+                return
+
+            stack[-1].append((pt.get_atomic_number(element),
+                              int(sub) if sub else 1))
+
+        elif opening is not None:
+            stack.append([])
+
+        else:
+            if len(stack) == 1 or len(stack[-1]) == 0 \
+                    or group_sub.startswith("0"):
+                return
+
+            group = stack.pop()
+            stack[-1].append((group, int(group_sub) if group_sub else 1))
+
+    if len(stack) != 1 or len(stack[0]) == 0:
+        return
+
+    return stack[0]
+
+
+def group_free_valence(items: list) -> int:
+    """
+    Return the number of bonds a group can form with the rest of the
+    molecule, if its atoms are joined by single bonds.
+
+    Args:
+        items: group returned by tokenize_molecule()
+    """
+    valencies = pt.get_valency_table()
+
+    def count(items: list) -> tuple:
+        n_atoms = 0
+        valence = 0
+        for item, sub in items:
+            if isinstance(item, list):
+                item_atoms, item_valence = count(item)
+
+            else:
+                item_atoms, item_valence = 1, valencies[item]
+
+            n_atoms += sub * item_atoms
+            valence += sub * item_valence
+
+        return n_atoms, valence
+
+    n_atoms, valence = count(items)
+
+    return valence - 2 * (n_atoms - 1)
+
+
+def build_molecule(mol: Molecule, items: list, centre: int) -> tuple:
+    """
+    Add the atoms of a condensed formula to a molecule, reading it left
+    to right:
+        - An atom that can form more than one bond (eg. C, O, N) and has
+          no subscript is a central atom, bonded to the previous central
+          atom, as in CH3CH2OH.
+        - Any other atom is bonded to the current central atom, as the H
+          and Cl atoms of CH2Cl2. Atoms before the first central atom are
+          bonded to it, as the H atoms of H2O.
+        - A repeated group that can form two bonds, such as (CH2)4,
+          continues the chain, as in CH3(CH2)4CH3. Any other group is a
+          branch off the current central atom, once per subscript, as in
+          C(CH3)4 or CH3C(O)OH.
+    Returns (first central atom, last central atom, atoms not bonded to a
+    central atom yet); the central atoms are -1 if there are none.
+
+    Args:
+        mol: molecule to add the atoms to
+        items: list returned by tokenize_molecule()
+        centre: index of the central atom the formula continues from, or
+                -1 for none
+    """
+    valencies = pt.get_valency_table()
+    first = -1
+    pending = []
+
+    for item, sub in items:
+        if isinstance(item, list):
+            branch = sub == 1 or group_free_valence(item) != 2
+            for _ in range(sub):
+                group_first, group_last, group_pending = \
+                    build_molecule(mol, item, centre)
+                pending += group_pending
+                if group_first < 0:
+                    continue
+
+                if centre < 0 and branch:
+                    pending.append(group_first)
+
+                elif centre < 0:
+                    for i in pending:
+                        mol.add_bond(i, group_first)
+
+                    pending = []
+                    first = group_first
+                    centre = group_last
+
+                elif not branch:
+                    if first < 0:
+                        first = group_first
+
+                    centre = group_last
+
+            continue
+
+        atoms = mol.atoms
+        if sub == 1 and valencies[item] != 1:
+            atoms.append(item)
+            atom = len(atoms) - 1
+            if centre >= 0:
+                mol.add_bond(centre, atom)
+
+            for i in pending:
+                mol.add_bond(i, atom)
+
+            pending = []
+            if first < 0:
+                first = atom
+
+            centre = atom
+            continue
+
+        for _ in range(sub):
+            atoms.append(item)
+            atom = len(atoms) - 1
+            if centre >= 0:
+                mol.add_bond(centre, atom)
+
+            else:
+                pending.append(atom)
+
+    return first, centre, pending
+
+
+def is_run(items: list) -> bool:
+    """
+    Check if a formula is a molecular formula such as C2H4, C6H6 or
+    C2H3Cl: several atoms of an element that can form more than one bond,
+    followed only by atoms that form a single bond.
+
+    Args:
+        items: list returned by tokenize_molecule()
+    """
+    valencies = pt.get_valency_table()
+    if any(isinstance(item, list) for item, _ in items):
+        return False
+
+    (z, n), rest = items[0], items[1:]
+
+    return n > 1 and valencies[z] > 1 \
+        and all(valencies[item] == 1 for item, _ in rest)
+
+
+def build_run(mol: Molecule, items: list) -> None:
+    """
+    Add the atoms of a molecular formula, as recognized by is_run(), to a
+    molecule. The atoms of the first element are bonded into a chain, or a
+    ring (see RING_MIN_SIZE). The other atoms are then handed out one at a
+    time, each to the atom with the most bonds to spare, or the earliest
+    one on a tie. The bonds left to spare become multiple bonds in
+    assign_bond_orders(), as the C=C bond of C2H4, or the alternating
+    double bonds of the benzene ring.
+
+    Args:
+        mol: empty molecule to add the atoms to
+        items: list returned by tokenize_molecule()
+    """
+    valencies = pt.get_valency_table()
+    (z, n), rest = items[0], items[1:]
+    n_others = sum(sub for _, sub in rest)
+    ring = n >= RING_MIN_SIZE and n_others % n == 0 \
+        and n_others // n <= valencies[z] - 2
+
+    mol.atoms.extend([z] * n)
+    for i in range(1, n):
+        mol.add_bond(i - 1, i)
+
+    if ring:
+        mol.add_bond(n - 1, 0)
+
+    degrees = mol.degrees()
+
+    # (-bonds to spare, atom), so that the heap pops the atom with the
+    # most bonds to spare first, and the earliest one on a tie
+    spare = [(degrees[i] - valencies[z], i) for i in range(n)]
+    heapq.heapify(spare)
+
+    for item, sub in rest:
+        for _ in range(sub):
+            n_spare, i = heapq.heappop(spare)
+            mol.atoms.append(item)
+            mol.add_bond(i, len(mol.atoms) - 1)
+            heapq.heappush(spare, (n_spare + 1, i))
+
+
+def attach_acidic_hydrogens(mol: Molecule, n_hydrogens: int,
+                            centre: int) -> None:
+    """
+    Move the hydrogen atoms written before a central atom onto its
+    terminal atoms that form two bonds, as in H2SO4 or H3PO4, where they
+    are bonded to oxygen. This is only done if there are more such atoms
+    than hydrogen atoms, since an oxoacid keeps at least one oxygen atom
+    without a hydrogen. Otherwise, as in H2O, they stay on the central
+    atom.
+
+    Args:
+        mol: molecule built by build_molecule(), before bond orders are
+             assigned
+        n_hydrogens: number of hydrogen atoms, which are the first atoms of
+                     the molecule
+        centre: index of the central atom they are bonded to
+    """
+    valencies = pt.get_valency_table()
+    atoms = mol.atoms
+    offsets, neighbours = mol.adjacency()
+    degrees = mol.degrees()
+
+    terminals = [j for j in neighbours[offsets[centre]:offsets[centre + 1]]
+                 if degrees[j] == 1 and valencies[atoms[j]] == 2]
+    if len(terminals) <= n_hydrogens:
+        return
+
+    edges = mol.edges
+    for k in range(0, len(edges), 2):
+        if edges[k] < n_hydrogens and edges[k + 1] == centre:
+            edges[k + 1] = terminals[edges[k]]
+
+
+def assign_bond_orders(mol: Molecule) -> None:
+    """
+    Turn single bonds into multiple bonds where both atoms have bonds to
+    spare, as in CO2 or HCCH. Then atoms that still have too few bonds take
+    them from neighbours that can expand their octet, as in SO2.
+
+    Args:
+        mol: molecule whose bond orders are to be assigned
+    """
+    valencies = pt.get_valency_table()
+    nval_e = pt.get_nvalence_electrons_table()
+    atoms, edges, orders = mol.atoms, mol.edges, mol.orders
+    sums = mol.bond_order_sums()
+
+    for k in range(len(orders)):
+        i, j = edges[2 * k], edges[2 * k + 1]
+        extra = min(valencies[atoms[i]] - sums[i],
+                    valencies[atoms[j]] - sums[j])
+        if extra > 0:
+            orders[k] += extra
+            sums[i] += extra
+            sums[j] += extra
+
+    for k in range(len(orders)):
+        i, j = edges[2 * k], edges[2 * k + 1]
+        for a, b in ((i, j), (j, i)):
+            if atoms[b] <= OCTET_MAX_Z:
+                continue
+
+            extra = min(valencies[atoms[a]] - sums[a],
+                        nval_e[atoms[b]] - sums[b])
+            if extra > 0:
+                orders[k] += extra
+                sums[a] += extra
+                sums[b] += extra
+
+
+def parse_molecule(chem_form: str) -> Molecule:
+    """
+    Parse a condensed formula with any number of elements and central
+    atoms into a Molecule, with bonds and bond orders assigned. Returns
+    None if the formula is malformed. Use validate_molecule() to check
+    that the result is chemically sensible.
+
+    See build_molecule() for how the formula is read, build_run() for
+    molecular formulae such as C2H4, and attach_acidic_hydrogens() for
+    oxoacids such as H2SO4.
+
+    Args:
+        chem_form: condensed formula, eg. "H2O", "CH3CH2OH" or "C(CH3)4"
+    """
+    if chem_form is None:
+        return
+
+    items = tokenize_molecule(chem_form)
+    if items is None:
+        return
+
+    mol = Molecule()
+    if is_run(items):
+        build_run(mol, items)
+        assign_bond_orders(mol)
+
+        return mol
+
+    first, _, pending = build_molecule(mol, items, -1)
+
+    # Without an obvious central atom, as in HCl or IF7, the atom with
+    # the most valence electrons is the central atom. It must be the only
+    # atom of its element, as in those, or there is no telling which one
+    # it is, as in I4Cl4; such a molecule is left unbonded, and so it is
+    # not valid. Cl2 is fine.
+    if first < 0:
+        atoms = mol.atoms
+        nval_e = pt.get_nvalence_electrons_table()
+        centre = max(pending, key=lambda i: nval_e[atoms[i]])
+        if len(atoms) > 2 and atoms.count(atoms[centre]) > 1:
+            return mol
+
+        for i in pending:
+            if i != centre:
+                mol.add_bond(centre, i)
+
+    elif items[0][0] == 1:
+        attach_acidic_hydrogens(mol, items[0][1], first)
+
+    assign_bond_orders(mol)
+
+    return mol
+
+
+def validate_molecule(mol: Molecule) -> bool:
+    """
+    Checks if
+        (a) The molecule has at least 2 atoms, and they are all connected
+        (b) Every atom has at least as many bonds as its valency, and no
+            more than its valence electrons allow
+        (c) Every atom has a whole number of lone pairs
+        (d) Atoms up to neon obey the octet rule
+
+    Args:
+        mol: molecule returned by parse_molecule()
+    """
+    if mol is None or len(mol) < 2:
+        return False
+
+    valencies = pt.get_valency_table()
+    nval_e = pt.get_nvalence_electrons_table()
+
+    for z, bonds in zip(mol.atoms, mol.bond_order_sums()):
+        if not valencies[z] <= bonds <= nval_e[z] \
+                or (nval_e[z] - bonds) % 2 != 0:
+            return False
+
+        if z <= OCTET_MAX_Z and bonds + nval_e[z] > (2 if z <= 2 else 8):
+            return False
+
+    offsets, neighbours = mol.adjacency()
+    seen = bytearray(len(mol))
+    seen[0] = 1
+    stack = [0]
+    while stack:
+        i = stack.pop()
+        for j in neighbours[offsets[i]:offsets[i + 1]]:
+            if not seen[j]:
+                seen[j] = 1
+                stack.append(j)
+
+    return all(seen)
+
+
+def classify_centres(mol: Molecule) -> list:
+    """
+    Classify the geometry around each central atom of a molecule. Returns
+    a list of (atom index, geometry) pairs.
+
+    Args:
+        mol: molecule returned by parse_molecule()
+    """
+    return [(i, geometry_class(n_bonds, n_lp))
+            for i, n_bonds, n_lp in mol.centres()]
+
+
+def main_centre(mol: Molecule, degrees: array = None) -> int:
+    """
+    Return the index of the atom bonded to the most other atoms, or the
+    earliest one on a tie. Its geometry stands for that of the whole
+    molecule where only one can be given, and molecule_coordinates() puts
+    it at the origin.
+
+    Args:
+        mol: molecule returned by parse_molecule()
+        degrees: mol.degrees(), if it has already been computed
+    """
+    if degrees is None:
+        degrees = mol.degrees()
+
+    return degrees.index(max(degrees))
+
+
+def find_ring(mol: Molecule, offsets: array, neighbours: array) -> list:
+    """
+    Return the atoms of a ring of the molecule, in order around it, or an
+    empty list if it has no ring.
+
+    Args:
+        mol: molecule returned by parse_molecule()
+        offsets, neighbours: mol.adjacency()
+    """
+    n_atoms = len(mol)
+
+    # A connected molecule without a ring has one bond less than atoms.
+    if mol.n_bonds < n_atoms:
+        return []
+
+    parents = array("i", [-1]) * n_atoms
+    seen = bytearray(n_atoms)
+
+    for start in range(n_atoms):
+        if seen[start]:
+            continue
+
+        seen[start] = 1
+        stack = [start]
+        while stack:
+            i = stack.pop()
+            for j in neighbours[offsets[i]:offsets[i + 1]]:
+                if j == parents[i]:
+                    continue
+
+                if not seen[j]:
+                    seen[j] = 1
+                    parents[j] = i
+                    stack.append(j)
+                    continue
+
+                # The bond i-j closes a ring, through the nearest atom
+                # that both are reached from.
+                path_i = [i]
+                while path_i[-1] != start:
+                    path_i.append(parents[path_i[-1]])
+
+                on_path_i = set(path_i)
+                path_j = [j]
+                while path_j[-1] not in on_path_i:
+                    path_j.append(parents[path_j[-1]])
+
+                return (path_i[:path_i.index(path_j[-1]) + 1]
+                        + path_j[-2::-1])
+
+    return []
+
+
+def molecule_coordinates(mol: Molecule):
+    """
+    Compute 3D coordinates for every atom of a molecule, as an (N, 3)
+    array, with bonds of unit length and main_centre() at the origin.
+    Each central atom gets its VSEPR geometry, turned so that one of its
+    bonds points back along the bond it was reached by, and so that a
+    chain continues anti to the atom before, as in the zigzag of an
+    alkane. A ring, as in C6H6, is laid out as a regular polygon first,
+    and the rest of the molecule grows out from it. Raises ValueError if an
+    atom has more bonds than valence electrons.
+
+    Args:
+        mol: molecule returned by parse_molecule()
+    """
+    import numpy as np
+    from collections import deque
+    from core import get_geometry_block
+
+    n_atoms = len(mol)
+    if n_atoms < 2:
+        return np.zeros((n_atoms, 3))
+
+    offsets, neighbours = mol.adjacency()
+    degrees = mol.degrees()
+    lone_pairs = mol.lone_pairs()
+
+    # Bond directions of each (bonds, lone pairs) class that occurs, in
+    # the frame of its first two bonds
+    local_blocks = {}
+
+    # Plain tuples: per atom, this is much cheaper than numpy.
+    coords = [None] * n_atoms
+    parents = array("i", [-1]) * n_atoms
+
+    root = main_centre(mol, degrees)
+    ring = find_ring(mol, offsets, neighbours)
+    if ring:
+        # Unit sides, in the xy plane
+        radius = 0.5 / sin(pi / len(ring))
+        for k, i in enumerate(ring):
+            angle = 2 * pi * k / len(ring)
+            coords[i] = (radius * cos(angle), radius * sin(angle), 0.0)
+
+        queue = deque(ring)
+
+    else:
+        coords[root] = (0.0, 0.0, 0.0)
+        queue = deque([root])
+
+    while queue:
+        atom = queue.popleft()
+        parent = parents[atom]
+
+        cls = (degrees[atom], lone_pairs[atom])
+        if cls[1] < 0:
+            raise ValueError(f"Atom {atom} ({pt.get_symbol(mol.atoms[atom])})"
+                             " has more bonds than valence electrons")
+
+        local = local_blocks.get(cls)
+        if local is None:
+            local = local_blocks[cls] = local_frame(
+                get_geometry_block(geometry_class(*cls)))
+
+        bonded = neighbours[offsets[atom]:offsets[atom + 1]]
+        placed = [j for j in bonded if coords[j] is not None]
+
+        # Central atoms first, so that the chain takes the direction
+        # that is anti to the atom before.
+        others = sorted((j for j in bonded if coords[j] is None),
+                        key=lambda j: degrees[j] < 2)
+
+        ox, oy, oz = coords[atom]
+        if not placed:
+            axes = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0))
+
+        else:
+            # The first bond points back to an atom that is already
+            # placed, and the second towards the next one, in a ring, or
+            # else away from the grandparent, or from the first other atom
+            # bonded to the parent if that is the first atom placed.
+            back = bond_vector(coords[atom], coords[placed[0]])
+            if len(placed) > 1:
+                toward = bond_vector(coords[atom], coords[placed[1]])
+
+            elif parents[parent] >= 0:
+                toward = bond_vector(coords[parents[parent]],
+                                     coords[parent])
+
+            else:
+                toward = back
+                for j in neighbours[offsets[parent]:offsets[parent + 1]]:
+                    if j != atom:
+                        toward = bond_vector(coords[j], coords[parent])
+                        break
+
+            side = perpendicular(back, toward)
+            axes = (back, side, cross(back, side))
+            local = local[len(placed):]
+
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = axes
+        for j, (u, v, w) in zip(others, local):
+            coords[j] = (ox + u * ax + v * bx + w * cx,
+                         oy + u * ay + v * by + w * cy,
+                         oz + u * az + v * bz + w * cz)
+
+            if degrees[j] > 1:
+                parents[j] = atom
+                queue.append(j)
+
+    if None in coords:
+        raise ValueError("Molecule is not connected")
+
+    coords = np.array(coords)
+
+    return coords - coords[root]
+
+
+def bond_vector(start: tuple, end: tuple) -> tuple:
+    """
+    Return the vector from one (x, y, z) point to another. All bonds have
+    unit length, so between bonded atoms, this is a unit vector.
+    """
+    return end[0] - start[0], end[1] - start[1], end[2] - start[2]
+
+
+def local_frame(block) -> list:
+    """
+    Return the bond directions of a geometry as [u, v, w] lists, in the
+    frame whose first axis is the first bond, and whose second axis is
+    towards the second bond.
+
+    Args:
+        block: (N, 3) array returned by get_geometry_block()
+    """
+    import numpy as np
+
+    first = tuple(map(float, block[0]))
+    toward = tuple(map(float, block[1])) if len(block) > 1 else first
+    side = perpendicular(first, toward)
+    axes = np.array([first, side, cross(first, side)])
+
+    return (block @ axes.T).tolist()
+
+
+def perpendicular(axis: tuple, v: tuple) -> tuple:
+    """
+    Return the unit vector along the part of `v` that is perpendicular to
+    `axis`, or any unit vector perpendicular to `axis` if `v` is along it.
+    `axis` must be a unit vector.
+
+    Args:
+        axis: (x, y, z) unit vector
+        v: (x, y, z) vector
+    """
+    for ref in (v, (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)):
+        dot = axis[0] * ref[0] + axis[1] * ref[1] + axis[2] * ref[2]
+        p = (ref[0] - dot * axis[0], ref[1] - dot * axis[1],
+             ref[2] - dot * axis[2])
+        norm = sqrt(p[0] * p[0] + p[1] * p[1] + p[2] * p[2])
+        if norm > 1e-6:
+            return p[0] / norm, p[1] / norm, p[2] / norm
+
+
+def cross(a: tuple, b: tuple) -> tuple:
+    """Return the cross product of two (x, y, z) vectors."""
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2],
+            a[0] * b[1] - a[1] * b[0])
@@ -0,0 +1,305 @@
+# molfile.py: Streaming XYZ, PDB and SDF writers
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Each structure is written as one record, line by line, straight to the
+# output file, so that exporting a long list of formulas takes the same
+# memory as exporting one. Multi-record files are the usual way to hand
+# many structures to other tools: concatenated XYZ frames, one PDB MODEL
+# per structure, and SDF records separated by "$$$$".
+
+import gzip
+import io
+from typing import Iterable, Iterator, NamedTuple, TextIO
+
+from chemistry import Molecule, pt
+from core import analyze, get_geometry_block
+from molecule import molecule_coordinates
+
+
+EXPORT_FORMATS = ("xyz", "pdb", "sdf")
+
+# Coordinates are computed with bonds of unit length. Every bond is
+# scaled to this length, in angstroms, which is typical of the bonds CSG
+# draws, but not exact for any particular one.
+EXPORT_BOND_LENGTH = 1.5
+
+# gzip compression level for compressed output. Higher levels are much
+# slower, for little gain on text this repetitive.
+EXPORT_GZIP_LEVEL = 6
+
+# Largest structures that fit the fixed-width fields of each format
+SDF_MAX_ATOMS = 999
+PDB_MAX_ATOMS = 99999
+
+# Bond orders that V2000 molfiles have a bond type for. Anything higher
+# is written as type 8, "any".
+SDF_MAX_BOND_ORDER = 3
+
+
+class Structure(NamedTuple):
+    """A molecule with 3D coordinates, ready to be written out."""
+    # Formula, as entered
+    title: str
+
+    mol: Molecule
+
+    # [(x, y, z), ...] in angstroms, one per atom
+    coords: list
+
+
+def build_structure(chem_form: str) -> Structure:
+    """
+    Work out the atoms, bonds and coordinates of a compound. A compound
+    with a single central atom gets its VSEPR geometry, with the central
+    atom at the origin; a compound with several central atoms is laid out
+    atom by atom. Raises ValueError if the formula is not valid.
+
+    Args:
+        chem_form: chemical formula
+    """
+    analysis = analyze(chem_form)
+    if analysis is None:
+        raise ValueError("invalid formula")
+
+    if analysis.molecule is not None:
+        mol = analysis.molecule
+        coords = (molecule_coordinates(mol) * EXPORT_BOND_LENGTH).tolist()
+
+        return Structure(chem_form, mol, coords)
+
+    block = get_geometry_block(analysis.geometry)
+    n_bonds = len(block)
+
+    nc_z = pt.get_atomic_number(analysis.nc_atom)
+    mol = Molecule([pt.get_atomic_number(analysis.central_atom)]
+                   + [nc_z] * n_bonds,
+                   [i for k in range(1, n_bonds + 1) for i in (0, k)],
+                   [analysis.bond_order] * n_bonds)
+
+    coords = [(0.0, 0.0, 0.0)] + (block * EXPORT_BOND_LENGTH).tolist()
+
+    return Structure(chem_form, mol, coords)
+
+
+def xyz_record(structure: Structure, index: int = 1) -> Iterator[str]:
+    """
+    Generate the lines of an XYZ record: the number of atoms, a comment
+    line with the formula, then one line per atom.
+
+    Args:
+        structure: structure returned by build_structure()
+        index: position of the record in the file, from 1 (unused)
+    """
+    symbols = structure.mol.symbols()
+
+    yield f"{len(symbols)}\n"
+    yield f"{structure.title}\n"
+
+    for symbol, (x, y, z) in zip(symbols, structure.coords):
+        yield "%-2s %12.6f %12.6f %12.6f\n" % (symbol, x, y, z)
+
+
+def pdb_atom_name(symbol: str, serial: int) -> str:
+    """
+    Return a 4-character PDB atom name, eg. " F3 " or "XE1 ". One-letter
+    elements start in the second column, as the PDB format expects.
+
+    Args:
+        symbol: element symbol
+        serial: number of the atom among atoms of its element, from 1
+    """
+    name = f"{symbol.upper()}{serial}"
+    if len(symbol) == 1:
+        return f" {name[:3]:<3}"
+
+    return f"{name[:4]:<4}"
+
+
+def pdb_record(structure: Structure, index: int = 1) -> Iterator[str]:
+    """
+    Generate the lines of a PDB MODEL: a HETATM line per atom, then
+    CONECT lines for the bonds. Raises ValueError if there are too many
+    atoms for the format.
+
+    Args:
+        structure: structure returned by build_structure()
+        index: model number, from 1
+    """
+    mol = structure.mol
+    if len(mol) > PDB_MAX_ATOMS:
+        raise ValueError(f"more than {PDB_MAX_ATOMS} atoms for PDB")
+
+    yield "MODEL     %4d\n" % index
+    yield f"COMPND    {structure.title[:70]}\n"
+
+    counts = {}
+    for serial, (symbol, (x, y, z)) in enumerate(
+            zip(mol.symbols(), structure.coords), 1):
+        counts[symbol] = counts.get(symbol, 0) + 1
+        yield ("HETATM%5d %s UNL A   1    %8.3f%8.3f%8.3f%6.2f%6.2f"
+               "          %2s\n" % (serial, pdb_atom_name(symbol,
+                                                        counts[symbol]),
+                                    x, y, z, 1.0, 0.0, symbol.upper()))
+
+    # Each bond is listed from both ends, at most four to a line.
+    offsets, neighbours = mol.adjacency()
+    for i in range(len(mol)):
+        bonded = neighbours[offsets[i]:offsets[i + 1]]
+        for k in range(0, len(bonded), 4):
+            yield "CONECT%5d%s\n" % (i + 1, "".join(
+                "%5d" % (j + 1) for j in bonded[k:k + 4]))
+
+    yield "ENDMDL\n"
+
+
+def sdf_record(structure: Structure, index: int = 1) -> Iterator[str]:
+    """
+    Generate the lines of an SDF record: a V2000 molfile with atom and
+    bond blocks, a formula data item and the "$$$$" terminator. Raises
+    ValueError if there are too many atoms for the format.
+
+    Args:
+        structure: structure returned by build_structure()
+        index: position of the record in the file, from 1 (unused)
+    """
+    mol = structure.mol
+    if len(mol) > SDF_MAX_ATOMS or mol.n_bonds > SDF_MAX_ATOMS:
+        raise ValueError(f"more than {SDF_MAX_ATOMS} atoms for SDF")
+
+    yield f"{structure.title[:80]}\n"
+    yield "  CSG               3D\n"
+    yield "\n"
+    yield "%3d%3d  0  0  0  0  0  0  0  0999 V2000\n" % (len(mol),
+                                                        mol.n_bonds)
+
+    for symbol, (x, y, z) in zip(mol.symbols(), structure.coords):
+        yield ("%10.4f%10.4f%10.4f %-3s 0  0  0  0  0  0  0  0  0  0  0  0\n"
+               % (x, y, z, symbol))
+
+    edges = mol.edges
+    for k, order in enumerate(mol.orders):
+        yield "%3d%3d%3d  0  0  0  0\n" % (
+            edges[2 * k] + 1, edges[2 * k + 1] + 1,
+            order if order <= SDF_MAX_BOND_ORDER else 8)
+
+    yield "M  END\n"
+    yield "> <FORMULA>\n"
+    yield f"{structure.title}\n"
+    yield "\n"
+    yield "$$$$\n"
+
+
+RECORD_WRITERS = {
+    "xyz": xyz_record,
+    "pdb": pdb_record,
+    "sdf": sdf_record
+}
+
+# Written once, after the last record
+TRAILERS = {
+    "pdb": "END\n"
+}
+
+
+def format_structure(chem_form: str, fmt: str) -> str:
+    """
+    Return a single compound as the text of a file in a given format.
+    Raises ValueError if the formula is not valid, or does not fit the
+    format.
+
+    Args:
+        chem_form: chemical formula
+        fmt: "xyz", "pdb" or "sdf"
+    """
+    record = "".join(RECORD_WRITERS[fmt](build_structure(chem_form)))
+
+    return record + TRAILERS.get(fmt, "")
+
+
+def open_output(path_name: str = None, compress: bool = False) -> TextIO:
+    """
+    Open a text stream to write structures to. The output is gzip
+    compressed if `compress` is set, or if `path_name` ends in ".gz".
+
+    Args:
+        path_name: file to write to; standard output if None or '-'
+        compress: whether to compress the output
+    """
+    from sys import stdout
+
+    to_stdout = path_name is None or path_name == "-"
+    compress = compress or (not to_stdout and path_name.endswith(".gz"))
+
+    if not compress:
+        if to_stdout:
+            return stdout
+
+        return open(path_name, "w", encoding="ascii", newline="\n")
+
+    if to_stdout:
+        binary = gzip.GzipFile(fileobj=stdout.buffer, mode="wb",
+                               compresslevel=EXPORT_GZIP_LEVEL)
+
+    else:
+        binary = gzip.open(path_name, "wb", compresslevel=EXPORT_GZIP_LEVEL)
+
+    return io.TextIOWrapper(binary, encoding="ascii", newline="\n")
+
+
+def write_structures(formulas: Iterable[str], out: TextIO, fmt: str,
+                     on_error=None) -> int:
+    """
+    Write the structure of every formula to `out`, one record after
+    another, in a given format. Formulas are read and written one at a
+    time, so `formulas` can be a generator over a file of any size.
+    Returns the number of structures written.
+
+    Args:
+        formulas: chemical formulas
+        out: text stream, eg. returned by open_output()
+        fmt: "xyz", "pdb" or "sdf"
+        on_error: called with (formula, error message) for each formula
+                  that is skipped
+    """
+    writer = RECORD_WRITERS[fmt]
+    n_written = 0
+
+    for chem_form in formulas:
+        try:
+            structure = build_structure(chem_form)
+
+            # Build the whole record before writing any of it, so that a
+            # structure that does not fit the format leaves no partial
+            # record behind.
+            record = "".join(writer(structure, n_written + 1))
+
+        except ValueError as ex:
+            if on_error is not None:
+                on_error(chem_form, str(ex))
+
+            continue
+
+        out.write(record)
+        n_written += 1
+
+    out.write(TRAILERS.get(fmt, ""))
+
+    return n_written
@@ -0,0 +1,472 @@
+# server.py: HTTP/JSON front-end for CSG
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import json
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count, getpid
+from sys import stderr
+from urllib.parse import urlsplit, parse_qsl
+
+from core import (init_csg_db, validate, analyze, fetch_coordinates,
+                  render_image, get_geometry_store, tick, EXPORT_DPI)
+
+
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+
+# Requests with a larger header block or body are refused.
+MAX_HEADER_BYTES = 8 * 1024
+MAX_BODY_BYTES = 8 * 1024
+
+# Idle keep-alive connections are closed after this many seconds.
+KEEPALIVE_TIMEOUT = 15
+
+# Longest time graceful shutdown waits for requests in progress
+SHUTDOWN_TIMEOUT = 10
+
+# Range of resolutions that /png will render at. Below about 4 DPI, the
+# legend fonts are too small for FreeType to render at all.
+MIN_DPI = 10
+MAX_DPI = 300
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error"
+}
+
+
+class HTTPError(Exception):
+    """An error that is reported to the client as an HTTP status."""
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def analyze_formula(chem_form: str) -> dict:
+    """
+    Return the lone pairs and geometry of a given compound.
+
+    Args:
+        chem_form: chemical formula
+    """
+    analysis = analyze(chem_form)
+    if analysis is None:
+        return {"formula": chem_form, "valid": False}
+
+    return {
+        "formula": chem_form,
+        "valid": True,
+        "lone_pairs": analysis.lone_pairs,
+        "geometry": analysis.geometry
+    }
+
+
+def get_coordinates(chem_form: str) -> dict:
+    """
+    Return the geometry of a given compound and the coordinates of its
+    non-central atoms. The central atom is at the origin. For a compound
+    with several central atoms, these are the atoms bonded to its main
+    central atom, as laid out by its geometry.
+
+    Args:
+        chem_form: chemical formula
+    """
+    analysis = analyze_formula(chem_form)
+    if not analysis["valid"]:
+        raise HTTPError(422, f"Invalid formula: '{chem_form}'")
+
+    try:
+        x, y, z = fetch_coordinates(analysis["geometry"])
+
+    except ValueError as ex:
+        raise HTTPError(422, str(ex))
+
+    analysis["coordinates"] = [[float(c) for c in atom]
+                               for atom in zip(x, y, z)]
+
+    return analysis
+
+
+def render_png(chem_form: str, dpi: int, theme: str) -> bytes:
+    """
+    Render a given compound to a PNG image. Runs in a worker process.
+
+    Args:
+        chem_form: chemical formula
+        dpi: resolution, in dots per inch
+        theme: "dark" or "light"
+    """
+    return render_image(chem_form, "png", dpi, theme)
+
+
+def warm_up() -> None:
+    """
+    Run in each worker process as it starts, before it takes any work, to
+    import what render_image() needs ahead of the first request.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def worker_pid() -> int:
+    """Return the process ID of the worker that runs this."""
+    return getpid()
+
+
+class CSGServer:
+    """
+    Minimal HTTP/1.1 server on asyncio streams. Cheap lookups are answered
+    on the event loop, and rendering is handed to a pool of worker
+    processes.
+
+    Endpoints (GET with a query string, or POST with a JSON object body):
+        /validate?formula=H2O
+        /analyze?formula=H2O
+        /coordinates?formula=H2O
+        /png?formula=H2O[&dpi=100][&theme=dark|light]
+    """
+    def __init__(self, host: str = SERVE_HOST, port: int = SERVE_PORT,
+                 n_jobs: int = None):
+        """
+        Constructor.
+
+        Args:
+            host: address to listen on
+            port: port to listen on
+            n_jobs: number of worker processes for rendering
+        """
+        self.host = host
+        self.port = port
+        self.n_jobs = n_jobs
+        self.pool = None
+        self.server = None
+        self.stopping = False
+
+        # Connection tasks, by whether they are in the middle of a request
+        self.busy = set()
+        self.idle = set()
+
+        self.routes = {
+            "/validate": self.validate,
+            "/analyze": self.analyze,
+            "/coordinates": self.coordinates,
+            "/png": self.png
+        }
+
+    async def validate(self, params: dict) -> tuple:
+        chem_form = get_formula(params)
+        return json_response({"formula": chem_form,
+                              "valid": validate(chem_form)})
+
+    async def analyze(self, params: dict) -> tuple:
+        return json_response(analyze_formula(get_formula(params)))
+
+    async def coordinates(self, params: dict) -> tuple:
+        return json_response(get_coordinates(get_formula(params)))
+
+    async def png(self, params: dict) -> tuple:
+        chem_form = get_formula(params)
+        theme = params.get("theme", "dark")
+
+        # A JSON body may hold any type, eg. a list.
+        try:
+            dpi = int(params.get("dpi", EXPORT_DPI))
+
+        except (ValueError, TypeError):
+            raise HTTPError(400, "'dpi' must be an integer")
+
+        if not MIN_DPI <= dpi <= MAX_DPI:
+            raise HTTPError(400, f"'dpi' must be between {MIN_DPI} and "
+                                 f"{MAX_DPI}")
+
+        if theme not in ("dark", "light"):
+            raise HTTPError(400, f"Invalid theme: '{theme}'")
+
+        # Check up front, so that the error is not lost in a worker.
+        get_coordinates(chem_form)
+
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self.pool, render_png, chem_form,
+                                          dpi, theme)
+
+        return 200, "image/png", data
+
+    async def handle_request(self, method: str, target: str,
+                             body: bytes) -> tuple:
+        """
+        Route a request. Returns (status, content type, body).
+
+        Args:
+            method: request method
+            target: request target, i.e. the path and query string
+            body: request body
+        """
+        url = urlsplit(target)
+        handler = self.routes.get(url.path)
+        if handler is None:
+            raise HTTPError(404, f"No such endpoint: '{url.path}'")
+
+        if method == "GET":
+            params = dict(parse_qsl(url.query))
+
+        elif method == "POST":
+            try:
+                params = json.loads(body or b"{}")
+
+            except ValueError:
+                raise HTTPError(400, "Request body is not valid JSON")
+
+            if not isinstance(params, dict):
+                raise HTTPError(400, "Request body must be a JSON object")
+
+        else:
+            raise HTTPError(405, f"Method not allowed: '{method}'")
+
+        return await handler(params)
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """Serve requests on a connection until either side closes it."""
+        conn = asyncio.current_task()
+        self.idle.add(conn)
+
+        try:
+            keep_alive = True
+            while keep_alive and not self.stopping:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+
+                except asyncio.LimitOverrunError:
+                    await send_response(writer, *error_response(
+                        HTTPError(431, "Request header is too large")), False)
+                    break
+
+                self.idle.discard(conn)
+                self.busy.add(conn)
+
+                try:
+                    status, content_type, body, keep_alive = \
+                        await self.process(reader, head)
+
+                finally:
+                    self.busy.discard(conn)
+                    self.idle.add(conn)
+
+                keep_alive = keep_alive and not self.stopping
+                await send_response(writer, status, content_type, body,
+                                    keep_alive)
+
+        except ConnectionError:
+            pass
+
+        # Idle connections are cancelled on shutdown.
+        except asyncio.CancelledError:
+            pass
+
+        finally:
+            self.idle.discard(conn)
+            writer.close()
+
+    async def process(self, reader: asyncio.StreamReader,
+                      head: bytes) -> tuple:
+        """
+        Read the body of a request and handle it. Returns (status, content
+        type, body, keep-alive).
+
+        Args:
+            reader: stream to read the body from
+            head: request line and headers
+        """
+        try:
+            request_line, *header_lines = \
+                head.decode("latin-1").rstrip("\r\n").split("\r\n")
+            method, target, version = request_line.split(" ")
+
+        except ValueError:
+            return (*error_response(HTTPError(400, "Malformed request")),
+                    False)
+
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+
+        else:
+            keep_alive = connection == "keep-alive"
+
+        try:
+            length = int(headers.get("content-length", 0))
+
+        except ValueError:
+            return (*error_response(HTTPError(400, "Bad Content-Length")),
+                    False)
+
+        if length < 0:
+            return (*error_response(HTTPError(400, "Bad Content-Length")),
+                    False)
+
+        # The body is not read, so the connection cannot be reused.
+        if length > MAX_BODY_BYTES:
+            return (*error_response(HTTPError(413, "Request body is too "
+                                              "large")), False)
+
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length),
+                                          KEEPALIVE_TIMEOUT)
+
+        except asyncio.TimeoutError:
+            return (*error_response(HTTPError(408, "Timed out reading the "
+                                              "request body")), False)
+
+        # The client closed the connection part-way through the body, so
+        # there is no one to respond to.
+        except asyncio.IncompleteReadError as ex:
+            raise ConnectionResetError("Connection closed while reading the "
+                                       "request body") from ex
+
+        try:
+            return (*await self.handle_request(method, target, body),
+                    keep_alive)
+
+        except HTTPError as ex:
+            return (*error_response(ex), keep_alive)
+
+        except Exception as ex:
+            print(f"[!] Error handling '{target}': {ex!r}", file=stderr)
+            return (*error_response(HTTPError(500, "Internal server error")),
+                    keep_alive)
+
+    async def run(self) -> None:
+        """Serve until SIGINT or SIGTERM, then shut down gracefully."""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port,
+            limit=MAX_HEADER_BYTES)
+
+        print(f"[{tick}] Serving on http://{self.host}:{self.port}/ "
+              f"with {self.n_jobs} worker process(es)", file=stderr)
+
+        await stop.wait()
+
+        print("[-] Shutting down...", file=stderr)
+        self.stopping = True
+        self.server.close()
+        await self.server.wait_closed()
+
+        # Let requests in progress finish, but not wait on idle clients.
+        for conn in list(self.idle):
+            conn.cancel()
+
+        if self.busy:
+            await asyncio.wait(list(self.busy), timeout=SHUTDOWN_TIMEOUT)
+
+        print(f"[{tick}] Done!", file=stderr)
+
+    def serve(self) -> None:
+        """Start the worker processes, and serve until interrupted."""
+        # Load everything before forking, so that the workers inherit it
+        # instead of each reading the databases.
+        init_csg_db()
+        get_geometry_store()
+
+        self.pool = ProcessPoolExecutor(self.n_jobs, initializer=warm_up)
+        try:
+            # Start the workers now, rather than on the first requests, and
+            # wait until they have warmed up.
+            for future in [self.pool.submit(worker_pid)
+                           for _ in range(self.n_jobs or cpu_count())]:
+                future.result()
+
+            asyncio.run(self.run())
+
+        finally:
+            self.pool.shutdown()
+
+
+def get_formula(params: dict) -> str:
+    """
+    Return the formula parameter of a request.
+
+    Args:
+        params: request parameters
+    """
+    chem_form = params.get("formula")
+    if not isinstance(chem_form, str) or chem_form == "":
+        raise HTTPError(400, "Missing 'formula' parameter")
+
+    return chem_form
+
+
+def json_response(obj) -> tuple:
+    """Return (status, content type, body) for a JSON response."""
+    return 200, "application/json", json.dumps(obj).encode()
+
+
+def error_response(ex: HTTPError) -> tuple:
+    """Return (status, content type, body) for an error."""
+    return (ex.status, "application/json",
+            json.dumps({"error": ex.message}).encode())
+
+
+async def send_response(writer: asyncio.StreamWriter, status: int,
+                        content_type: str, body: bytes,
+                        keep_alive: bool) -> None:
+    """
+    Write a response to a connection.
+
+    Args:
+        writer: connection to write to
+        status: HTTP status code
+        content_type: type of the body
+        body: body of the response
+        keep_alive: whether the connection stays open afterwards
+    """
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n")
+
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
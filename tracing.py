@@ -0,0 +1,211 @@
+# tracing.py: Lightweight timing spans
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import atexit
+import json
+from collections import deque
+from contextlib import nullcontext
+from functools import wraps
+from math import ceil
+from os import environ, getpid
+from threading import Lock, get_ident
+from time import perf_counter_ns
+
+
+# Set CSG_TRACE=1 to record spans. If CSG_TRACE_FILE is also set, the
+# spans are written to it as a Chrome trace (chrome://tracing, Perfetto)
+# on exit.
+TRACE_ENV = "CSG_TRACE"
+TRACE_FILE_ENV = "CSG_TRACE_FILE"
+
+# Percentiles are computed over the most recent TRACE_MAX_SAMPLES spans of
+# each stage, and at most TRACE_MAX_EVENTS spans are kept for the trace.
+TRACE_MAX_SAMPLES = 10000
+TRACE_MAX_EVENTS = 100000
+
+enabled = environ.get(TRACE_ENV, "") not in ("", "0")
+
+# {stage: [count, total_ns, deque of recent durations in ns]}
+stages = {}
+
+# Spans are also recorded by the database write-behind thread.
+stages_lock = Lock()
+
+# (stage, start_ns, duration_ns, pid, thread id)
+events = deque(maxlen=TRACE_MAX_EVENTS)
+
+# Handed out by span() when tracing is disabled
+NULL_SPAN = nullcontext()
+
+
+class Span:
+    """Times the enclosed block and records it under a stage name."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = perf_counter_ns() - self.start
+        record(self.name, self.start, duration)
+
+
+def record(name: str, start: int, duration: int) -> None:
+    """
+    Record a finished span.
+
+    Args:
+        name: stage name
+        start: start time, in perf_counter_ns() nanoseconds
+        duration: duration, in nanoseconds
+    """
+    with stages_lock:
+        stage = stages.get(name)
+        if stage is None:
+            stage = stages[name] = [0, 0, deque(maxlen=TRACE_MAX_SAMPLES)]
+
+        stage[0] += 1
+        stage[1] += duration
+        stage[2].append(duration)
+
+    events.append((name, start, duration, getpid(), get_ident()))
+
+
+def span(name: str):
+    """
+    Return a context manager that times the enclosed block as `name`. When
+    tracing is disabled, this is a shared no-op context manager.
+
+    Args:
+        name: stage name
+    """
+    if not enabled:
+        return NULL_SPAN
+
+    return Span(name)
+
+
+def traced(name: str):
+    """
+    Decorator that times every call of a function as `name`. When tracing
+    is disabled, the function is returned as is, so it costs nothing.
+
+    Args:
+        name: stage name
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """
+    Return the `pct`th percentile of a sorted list, by nearest rank.
+
+    Args:
+        sorted_values: values, in ascending order
+        pct: percentile, between 0 and 100
+    """
+    if len(sorted_values) == 0:
+        return 0
+
+    rank = ceil(pct / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def get_stats() -> dict:
+    """
+    Return {stage: {"count", "mean", "p50", "p99"}} for every stage, with
+    times in milliseconds.
+    """
+    with stages_lock:
+        snapshot = [(name, count, total, list(samples))
+                    for name, (count, total, samples) in stages.items()]
+
+    stats = {}
+    for name, count, total, samples in snapshot:
+        samples.sort()
+        stats[name] = {
+            "count": count,
+            "mean": total / count / 1e6,
+            "p50": percentile(samples, 50) / 1e6,
+            "p99": percentile(samples, 99) / 1e6
+        }
+
+    return stats
+
+
+def clear() -> None:
+    """Forget every recorded span."""
+    with stages_lock:
+        stages.clear()
+
+    events.clear()
+
+
+def dump_trace(path_name: str) -> int:
+    """
+    Write the recorded spans to a file in the Chrome trace event format.
+    Returns the number of spans written.
+
+    Args:
+        path_name: file to write to
+    """
+    trace_events = [{
+        "name": name,
+        "cat": "csg",
+        "ph": "X",
+        "ts": start / 1e3,
+        "dur": duration / 1e3,
+        "pid": pid,
+        "tid": tid
+    } for name, start, duration, pid, tid in list(events)]
+
+    with open(path_name, "w") as f:
+        json.dump({"traceEvents": trace_events,
+                   "displayTimeUnit": "ms"}, f)
+
+    return len(trace_events)
+
+
+def dump_trace_at_exit() -> None:
+    """Write the trace to $CSG_TRACE_FILE, if set, on exit."""
+    path_name = environ.get(TRACE_FILE_ENV)
+    if path_name and len(events) > 0:
+        dump_trace(path_name)
+
+
+if enabled:
+    atexit.register(dump_trace_at_exit)
@@ -20,14 +20,35 @@
 #
 
 from sys import argv
+from time import perf_counter
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import QFont
 from PyQt5.QtCore import *
 
 from core import *
+from db import (add_formula_to_history, get_formula_history, clear_history,
+                get_theme, queue_set_theme, queue_write)
 
 DEFAULT_TITLE = "CSG: Chemical Structure Generator"
 
+HOME_SIZE = (600, 300)
+STRUCTURE_SIZE = (700, 560)
+
+# Validation of the formula field waits for this long after the last
+# keystroke, so that a burst of typing or a paste is validated only once.
+# analyze() is memoized, so strings seen before are not analyzed again.
+VALIDATE_DEBOUNCE_MS = 120
+
+VALID_STYLESHEET = """
+    border: 1px solid green;
+    border-radius: 3px;
+"""
+
+INVALID_STYLESHEET = """
+    border: 1px solid red;
+    border-radius: 3px;
+"""
+
 DARK_STYLESHEET = ""
 LIGHT_STYLESHEET = ""
 STYLESHEET = ""
@@ -36,16 +57,20 @@ STYLESHEET = ""
 class StackHolder(QWidget):
     def __init__(self):
         super().__init__()
-        self.setFixedSize(600, 300)
+        self.setFixedSize(*HOME_SIZE)
         self.setWindowTitle(DEFAULT_TITLE)
         self.setStyleSheet(STYLESHEET)
 
         layout = QVBoxLayout()
         back_btn_layout = QHBoxLayout()
         self.stackw = QStackedWidget()
-        self.stackw.addWidget(Home())
+        self.home = Home(self)
+        self.stackw.addWidget(self.home)
         self.stackw.addWidget(PreferencesPage(self, self.stackw))
 
+        # Created on the first render, since it pulls in matplotlib
+        self.structure_page = None
+
         # Populate the menubar
         menubar = QMenuBar()
         emenu_actions = menubar.addMenu("Edit")
@@ -72,19 +97,46 @@ class StackHolder(QWidget):
     def set_preferences(self):
         self.back_btn.show()
         self.setWindowTitle("CSG: Preferences")
-        i = self.stackw.currentIndex()
-        if i == 0:
+        if self.stackw.currentIndex() != 1:
+            self.setFixedSize(*HOME_SIZE)
             self.stackw.setCurrentIndex(1)
 
+    def show_structure(self, analysis: Analysis) -> float:
+        """
+        Draw the 3D structure of a given compound on the structure page,
+        and switch to it. Returns the time taken, in seconds, until the
+        pixels are ready.
+
+        Args:
+            analysis: Analysis returned by analyze()
+        """
+        start = perf_counter()
+
+        if self.structure_page is None:
+            self.structure_page = StructurePage()
+            self.stackw.addWidget(self.structure_page)
+
+        self.structure_page.draw(analysis)
+
+        self.setWindowTitle(
+            f"CSG: {analysis.formula} ({analysis.geometry} type)")
+        self.setFixedSize(*STRUCTURE_SIZE)
+        self.stackw.setCurrentWidget(self.structure_page)
+        self.back_btn.show()
+
+        return perf_counter() - start
+
     def go_back(self):
+        self.setFixedSize(*HOME_SIZE)
         self.stackw.setCurrentIndex(0)
         self.setWindowTitle(DEFAULT_TITLE)
         self.back_btn.hide()
 
 
 class Home(QWidget):
-    def __init__(self):
+    def __init__(self, stackh: StackHolder):
         super().__init__()
+        self.stackh = stackh
 
         self.init_UI()
         self.show()
@@ -106,6 +158,25 @@ class Home(QWidget):
         self.formula_field.setFixedHeight(25)
         self.formula_field.textChanged.connect(self.formula_field_text_changed)
 
+        self.validate_timer = QTimer(self)
+        self.validate_timer.setSingleShot(True)
+        self.validate_timer.setInterval(VALIDATE_DEBOUNCE_MS)
+        self.validate_timer.timeout.connect(self.update_validity)
+
+        # None until the field is first validated, then whether the text in
+        # the field is a valid formula.
+        self.is_valid = None
+
+        # Analysis of the text in the field, or None if it is not valid
+        self.analysis = None
+
+        # Keystroke-to-feedback latency, for profiling: time from the first
+        # keystroke of a burst until the field shows whether it is valid.
+        self.edit_start = None
+        self.n_feedbacks = 0
+        self.feedback_time = 0.0
+        self.last_feedback_latency = 0.0
+
         self.go_btn = QPushButton("Go!")
         self.go_btn.setObjectName("go_btn")
         self.go_btn.setFixedHeight(25)
@@ -123,20 +194,12 @@ class Home(QWidget):
         self.clear_recents_btn.setCursor(Qt.PointingHandCursor)
 
         init_csg_db()
-        conn = sqlite3.connect(".db/csg_db.db")
-        cur = conn.cursor()
-        cur.execute("SELECT command FROM history WHERE type='formula';")
-
-        i = 0
-        all_recs = cur.fetchall()
-        items = []
-        for rec in all_recs:
-            items.append(rec[0])
-
-        items = items[::-1]
-
+        items = get_formula_history()[::-1]
         self.recents_list.addItems(items)
-        conn.close()
+
+        # History is written in the background, so keep track of what is
+        # in the recents list here.
+        self.recent_forms = set(items)
 
         self.main_layout.addWidget(self.recents_label)
         self.main_layout.addWidget(self.recents_list)
@@ -152,58 +215,121 @@ class Home(QWidget):
         self.setLayout(self.layout)
 
     def formula_field_text_changed(self):
-        is_valid = validate(self.formula_field.text())
-        if is_valid:
-            self.formula_field.setStyleSheet("""
-                border: 1px solid green;
-                border-radius: 3px;
-            """)
-            self.go_btn.setEnabled(True)
-            self.go_btn.setCursor(Qt.PointingHandCursor)
-
-        else:
-            self.formula_field.setStyleSheet("""
-                border: 1px solid red;
-                border-radius: 3px;
-            """)
-            self.go_btn.setDisabled(True)
-
-    def do_render(self, chem_form):
-        conn = sqlite3.connect(".db/csg_db.db")
-        cur = conn.cursor()
-        cur.execute("SELECT command FROM history WHERE type='formula';")
-        all_rec = cur.fetchall()
-        all_chem_forms = []
-        for rec in all_rec:
-            all_chem_forms.append(rec[0])
-
-        if len(all_chem_forms) == 0 or chem_form not in all_chem_forms:
-            cur.execute("INSERT INTO history VALUES(NULL, ?, ?);",
-                        (chem_form, "formula"))
-            conn.commit()
+        if self.edit_start is None:
+            self.edit_start = perf_counter()
+
+        # (Re)start the debounce timer
+        self.validate_timer.start()
+
+    def update_validity(self) -> bool:
+        """
+        Validate the text in the formula field, and restyle the field if it
+        went from valid to invalid or back. Returns whether it is valid.
+        """
+        self.validate_timer.stop()
+        self.analysis = analyze(self.formula_field.text())
+        is_valid = self.analysis is not None
+
+        if is_valid != self.is_valid:
+            self.is_valid = is_valid
+            if is_valid:
+                self.formula_field.setStyleSheet(VALID_STYLESHEET)
+                self.go_btn.setEnabled(True)
+                self.go_btn.setCursor(Qt.PointingHandCursor)
+
+            else:
+                self.formula_field.setStyleSheet(INVALID_STYLESHEET)
+                self.go_btn.setDisabled(True)
+
+        if self.edit_start is not None:
+            self.last_feedback_latency = perf_counter() - self.edit_start
+            self.feedback_time += self.last_feedback_latency
+            self.n_feedbacks += 1
+            self.edit_start = None
+
+        return is_valid
+
+    def feedback_latency_stats(self) -> dict:
+        """Return keystroke-to-feedback latency counters, in seconds."""
+        mean = self.feedback_time / self.n_feedbacks if self.n_feedbacks else 0
+        return {
+            "count": self.n_feedbacks,
+            "mean": mean,
+            "last": self.last_feedback_latency
+        }
+
+    def do_render(self, analysis: Analysis):
+        # Valid, but with more domains than coordinates can be computed
+        # for
+        try:
+            self.stackh.show_structure(analysis)
+
+        except ValueError as ex:
+            QMessageBox.warning(self, "CSG", str(ex))
+            return
+
+        chem_form = analysis.formula
+        if chem_form not in self.recent_forms:
+            self.recent_forms.add(chem_form)
             self.recents_list.insertItem(0, chem_form)
 
-        render(chem_form)
-        conn.close()
+        queue_write(add_formula_to_history, chem_form)
 
     def go_btn_clicked(self):
-        chem_form = self.formula_field.text()
-        is_valid = validate(chem_form)
-        if is_valid:
-            self.do_render(chem_form)
+        # Enter may be pressed before the debounce timer has fired.
+        if self.update_validity():
+            self.do_render(self.analysis)
 
     def clear_recents_btn_clicked(self):
         self.recents_list.clear()
-
-        conn = sqlite3.connect(".db/csg_db.db")
-        cur = conn.cursor()
-        cur.execute("DELETE FROM history;")
-        cur.execute("DELETE FROM sqlite_sequence WHERE name='history';")
-        conn.commit()
-        conn.close()
+        self.recent_forms.clear()
+        clear_history()
 
     def recent_clicked(self, item):
-        self.do_render(item.text())
+        analysis = analyze(item.text())
+        if analysis is not None:
+            self.do_render(analysis)
+
+
+class StructurePage(QWidget):
+    """
+    Page with a single embedded matplotlib canvas. Every render redraws
+    the same figure in place, through a RenderSession, instead of opening
+    a new window. The canvas is interactive, so it does not use the image
+    cache, which only holds encoded images.
+    """
+    def __init__(self):
+        super().__init__()
+
+        # matplotlib takes a while to import, so it is only imported once
+        # something is actually rendered.
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        with span("figure"):
+            self.canvas = FigureCanvasQTAgg(Figure())
+            self.session = RenderSession(self.canvas.figure)
+
+        layout.addWidget(self.canvas)
+        self.setLayout(layout)
+
+    def draw(self, analysis: Analysis) -> None:
+        """
+        Draw the 3D structure of a given compound.
+
+        Args:
+            analysis: Analysis returned by analyze()
+        """
+        with span("draw"):
+            self.session.draw(analysis, get_theme())
+
+        # Draw right away rather than on the next idle tick, so that the
+        # pixels are ready by the time the page is shown.
+        with span("rasterize"):
+            self.canvas.draw()
 
 
 class PreferencesPage(QWidget):
@@ -238,11 +364,7 @@ class PreferencesPage(QWidget):
     def change_to_dark_theme(self):
         global STYLESHEET
         global DARK_STYLESHEET
-        conn = sqlite3.connect(".db/csg_db.db")
-        cur = conn.cursor()
-        cur.execute("UPDATE user_preferences SET theme='dark';")
-        conn.commit()
-        conn.close()
+        queue_set_theme("dark")
 
         STYLESHEET = DARK_STYLESHEET
         self.stackh.setStyleSheet(STYLESHEET)
@@ -250,11 +372,7 @@ class PreferencesPage(QWidget):
     def change_to_light_theme(self):
         global STYLESHEET
         global LIGHT_STYLESHEET
-        conn = sqlite3.connect(".db/csg_db.db")
-        cur = conn.cursor()
-        cur.execute("UPDATE user_preferences SET theme='light';")
-        conn.commit()
-        conn.close()
+        queue_set_theme("light")
 
         STYLESHEET = LIGHT_STYLESHEET
         self.stackh.setStyleSheet(STYLESHEET)
@@ -267,47 +385,25 @@ def ui_init():
 
     init_csg_db()
 
+    # Build the compound index up front, so that the first keystroke in
+    # the formula field does not have to.
+    get_compound_index()
+
     with open("styles/light_theme.css") as light_theme:
         LIGHT_STYLESHEET = light_theme.read()
 
     with open("styles/dark_theme.css") as dark_theme:
         DARK_STYLESHEET = dark_theme.read()
 
-    conn = sqlite3.connect(".db/csg_db.db")
-    cur = conn.cursor()
-
     app = QApplication(argv)
 
-    try:
-        cur.execute("SELECT * FROM user_preferences;")
-
-    except sqlite3.OperationalError as ex:
-        if "no such table" in str(ex):
-            print("[!] Initializing User Preferences table...")
-            user_preferences_table = """
-                user_preferences (
-                    theme TEXT NOT NULL
-                )
-            """
-            cur.execute(f"CREATE TABLE {user_preferences_table};")
-            cur.execute("INSERT INTO user_preferences VALUES('dark');")
-            conn.commit()
-            print(f"[{tick}] Done!")
-
-        else:
-            raise
-
-    cur.execute("SELECT theme FROM user_preferences;")
-    theme_result = cur.fetchall()
-    if theme_result[0][0] == "dark":
+    if get_theme() == "dark":
         STYLESHEET = DARK_STYLESHEET
 
     else:
         STYLESHEET = LIGHT_STYLESHEET
 
     w = StackHolder()
-
-    conn.close()
     w.show()
     app.exec_()
 
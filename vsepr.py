@@ -0,0 +1,207 @@
+# vsepr.py: VSEPR geometries from a points-on-a-sphere repulsion model
+
+#
+#   Copyright (C) 2020-2021 Jithin Renji, Kannan MD, Pranav Pujar
+#
+#   This file is part of CSG.
+#
+#   CSG is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   CSG is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with CSG.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Each electron domain around the central atom (a bond or a lone pair) is
+# a point on the unit sphere, and the points repel each other. Lone pairs
+# are bulkier, so, as in VSEPR, lone pair - lone pair repulsion is the
+# strongest, then lone pair - bond, then bond - bond. Minimizing the total
+# repulsion gives the VSEPR geometry, e.g. the lone pair of a seesaw
+# (AB4L) ends up equatorial, and the two of a square plane (AB4L2) end up
+# opposite each other.
+
+import re
+
+import numpy as np
+
+
+# Strength of lone pair - lone pair and lone pair - bond repulsion,
+# relative to bond - bond repulsion. These reproduce the textbook shapes:
+# seesaw, T-shaped, linear AB2L3, square planar, square pyramidal and
+# pentagonal planar, with H2O at about 105 degrees.
+LONE_PAIR_REPULSION = 2.0
+BOND_LONE_PAIR_REPULSION = 1.3
+
+# Repulsion between two domains falls off as 1 / distance ** this. With
+# Coulomb-like repulsion, AB7 comes out as a pentagonal bipyramid.
+REPULSION_EXPONENT = 1
+
+# Gradient descent parameters. Each class is solved from several random
+# starts, in the same batch, and the lowest-energy result is kept.
+SOLVER_STEPS = 300
+SOLVER_STEP_SIZE = 0.1
+SOLVER_RESTARTS = 10
+SOLVER_SEED = 0
+
+# Largest number of domains (bonds and lone pairs) solved for
+MAX_DOMAINS = 32
+
+# (bonds, lone pairs) classes that are computed up front, all at once.
+# Other classes are computed when they are first needed.
+STANDARD_CLASSES = [(n_bonds, n_lp) for n_bonds in range(1, 9)
+                    for n_lp in range(4)]
+
+geometry_class_re = re.compile(r"A(?:B(\d*))?(?:L(\d*))?")
+
+
+def parse_geometry_class(geometry: str) -> tuple:
+    """
+    Return (bonds, lone pairs) for a geometry class, eg. "AB4L2" gives
+    (4, 2). Raises ValueError if it is not a geometry class.
+
+    Args:
+        geometry: geometry returned by classify_geometry()
+    """
+    match = geometry_class_re.fullmatch(geometry)
+    if match is None or match.group(1) is None and "B" not in geometry:
+        raise ValueError(f"Not a geometry class: '{geometry}'")
+
+    n_bonds, n_lp = match.groups()
+    n_bonds = int(n_bonds or 1)
+    n_lp = 0 if "L" not in geometry else int(n_lp or 1)
+
+    if n_bonds == 0 or n_bonds + n_lp > MAX_DOMAINS:
+        raise ValueError(f"No coordinates for geometry '{geometry}'")
+
+    return n_bonds, n_lp
+
+
+def solve(classes: list) -> dict:
+    """
+    Compute the geometry of every (bonds, lone pairs) class in `classes`,
+    all in one batch. Returns {(bonds, lone pairs): (bonds, 3) array} of
+    unit-length bond directions, with the central atom at the origin.
+
+    Args:
+        classes: list of (bonds, lone pairs) tuples
+    """
+    classes = list(dict.fromkeys(classes))
+    if len(classes) == 0:
+        return {}
+
+    n_domains = max(b + lp for b, lp in classes)
+    n_configs = len(classes) * SOLVER_RESTARTS
+
+    # Domain kinds: bonds (0) first, then lone pairs (1), then padding
+    # (2) up to the largest class in the batch. Padding does not repel.
+    kinds = np.full((n_configs, n_domains), 2)
+    for i, (n_bonds, n_lp) in enumerate(classes):
+        rows = slice(i * SOLVER_RESTARTS, (i + 1) * SOLVER_RESTARTS)
+        kinds[rows, :n_bonds] = 0
+        kinds[rows, n_bonds:n_bonds + n_lp] = 1
+
+    repulsion = np.array([
+        [1, BOND_LONE_PAIR_REPULSION, 0],
+        [BOND_LONE_PAIR_REPULSION, LONE_PAIR_REPULSION, 0],
+        [0, 0, 0]
+    ])
+    pair_weights = repulsion[kinds[:, :, None], kinds[:, None, :]]
+
+    # Pairs that do not interact: a domain with itself, and padding
+    ignored = (pair_weights == 0) | np.eye(n_domains, dtype=bool)
+
+    # Each class starts from its own seed, so that its result does not
+    # depend on what else is in the batch.
+    points = np.zeros((n_configs, n_domains, 3))
+    points[:, :, 2] = 1
+    for i, (n_bonds, n_lp) in enumerate(classes):
+        rng = np.random.default_rng((SOLVER_SEED, n_bonds, n_lp))
+        rows = slice(i * SOLVER_RESTARTS, (i + 1) * SOLVER_RESTARTS)
+        points[rows, :n_bonds + n_lp] = rng.normal(
+            size=(SOLVER_RESTARTS, n_bonds + n_lp, 3))
+
+    points /= np.linalg.norm(points, axis=2, keepdims=True)
+
+    # Working with squared distances avoids square roots in the loop.
+    half_k = REPULSION_EXPONENT / 2
+    for step in range(SOLVER_STEPS):
+        diff = points[:, :, None, :] - points[:, None, :, :]
+        dist2 = np.einsum("cijd,cijd->cij", diff, diff)
+        dist2[ignored] = np.inf
+
+        # Force on each point, i.e. minus the gradient of the energy
+        scale = pair_weights * dist2 ** -(half_k + 1)
+        force = np.einsum("cij,cijd->cid", scale, diff)
+
+        # Only the component along the sphere moves the point.
+        force -= np.sum(force * points, axis=2, keepdims=True) * points
+
+        # Step in proportion to the force, but never by more than a
+        # fraction of the sphere, and less and less as it settles.
+        norm = np.linalg.norm(force, axis=2, keepdims=True)
+        largest = np.max(norm, axis=1, keepdims=True)
+        step_size = SOLVER_STEP_SIZE * (1 - step / SOLVER_STEPS)
+        points += step_size * force / np.maximum(largest, 1e-12)
+        points /= np.linalg.norm(points, axis=2, keepdims=True)
+
+    diff = points[:, :, None, :] - points[:, None, :, :]
+    dist2 = np.einsum("cijd,cijd->cij", diff, diff)
+    dist2[ignored] = np.inf
+    energy = np.sum(pair_weights * dist2 ** -half_k, axis=(1, 2))
+
+    result = {}
+    for i, (n_bonds, n_lp) in enumerate(classes):
+        rows = slice(i * SOLVER_RESTARTS, (i + 1) * SOLVER_RESTARTS)
+        best = i * SOLVER_RESTARTS + int(np.argmin(energy[rows]))
+        domains = orient(points[best, :n_bonds + n_lp], n_bonds)
+
+        bonds = domains[:n_bonds]
+        bonds.flags.writeable = False
+        result[(n_bonds, n_lp)] = bonds
+
+    return result
+
+
+def orient(domains, n_bonds: int):
+    """
+    Rotate a solved geometry into a standard orientation: the lone pairs
+    point up (+z) as a group, or, without lone pairs, the first bond does.
+    The first bond that is not along the z axis lies in the xz plane.
+
+    Args:
+        domains: (N, 3) array of bonds, followed by lone pairs
+        n_bonds: number of bonds
+    """
+    lone_pairs = domains[n_bonds:]
+
+    z_axis = np.sum(lone_pairs, axis=0)
+    if np.linalg.norm(z_axis) < 1e-6:
+        z_axis = domains[n_bonds] if len(lone_pairs) > 0 else domains[0]
+
+    z_axis = z_axis / np.linalg.norm(z_axis)
+
+    # Any other domain that is not along the z axis sets the x axis. If
+    # they all are, as in a linear molecule, any perpendicular axis does.
+    # Anything closer to the z axis than solver noise counts as along it,
+    # or the axes come out skewed.
+    candidates = [*domains, np.array([1.0, 0.0, 0.0]),
+                  np.array([0.0, 1.0, 0.0])]
+    for domain in candidates:
+        rest = domain - np.dot(domain, z_axis) * z_axis
+        if np.linalg.norm(rest) > 1e-3:
+            x_axis = rest / np.linalg.norm(rest)
+            break
+
+    y_axis = np.cross(z_axis, x_axis)
+    oriented = domains @ np.stack([x_axis, y_axis, z_axis]).T
+
+    # Round off solver noise, so that eg. a linear molecule is exactly
+    # linear.
+    return np.round(oriented, 6) + 0.0